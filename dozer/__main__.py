@@ -7,34 +7,27 @@ import asyncio
 import uvloop
 from .db import db_init
 from . import db
+from . import migrations
+from .config import default_config
+from .handoff import restart_args
+from .perf import perf_stats
 
 # switch to uvloop for event loops
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-config = {
-    'prefix': '&', 'developers': [],
-    'tba': {
-        'key': ''
-    },
-    'toa': {
-        'key': 'Put TOA API key here',
-        'app_name': 'Dozer',
-        'teamdata_url': ''
-    },
-    'log_level': 'INFO',
-    'db_url': 'sqlite:///dozer.db',
-    'gmaps_key': "PUT GOOGLE MAPS API KEY HERE",
-    'tz_url': '',
-    'discord_token': "Put Discord API Token here.",
-    'is_backup': False
-}
+config = default_config()
 config_file = 'config.json'
 
 if os.path.isfile(config_file):
     with open(config_file) as f:
         config.update(json.load(f))
 
-db_init(config['db_url'])
+db_init(config['db_url'], write_batch_rows=config['db_write_batch']['max_rows'],
+        write_batch_delay=config['db_write_batch']['max_delay_ms'] / 1000,
+        slow_query_threshold=config['db_slow_query_ms'] / 1000, settings_cache_entries=config['db_settings_cache_entries'])
+
+perf_stats.enabled = config['perf_stats']['enabled']
+perf_stats.window_minutes = config['perf_stats']['window_minutes']
 
 with open('config.json', 'w') as f:
     json.dump(config, f, indent='\t')
@@ -42,28 +35,23 @@ with open('config.json', 'w') as f:
 if 'discord_token' not in config:
     sys.exit('Discord token must be supplied in configuration')
 
-if sys.version_info < (3, 6):
-    sys.exit('Dozer requires Python 3.6 or higher to run. This is version %s.' % '.'.join(sys.version_info[:3]))
+if sys.version_info < (3, 7):
+    sys.exit('Dozer requires Python 3.7 or higher to run. This is version %s.' % '.'.join(map(str, sys.version_info[:3])))
 
 from . import Dozer  # After version check
+from .bot import dozer_log_listener
 
 bot = Dozer(config)
 
 for ext in os.listdir('dozer/cogs'):
     if not ext.startswith(('_', '.')):
-        bot.load_extension('dozer.cogs.' + ext[:-3])  # Remove '.py'
+        bot.extension_loader.add('dozer.cogs.' + ext[:-3])  # Remove '.py'
 
-db.DatabaseObject.metadata.create_all()
+migrations.migrate(db.engine)
 bot.run()
+db.write_queue.flush_blocking()  # anything still queued if the loop stopped without going through shutdown
 
 # restart the bot if the bot flagged itself to do so
 if bot._restarting:
-    script = sys.argv[0]
-    if script.startswith(os.getcwd()):
-        script = script[len(os.getcwd()):].lstrip(os.sep)
-
-    if script.endswith('__main__.py'):
-        args = [sys.executable, '-m', script[:-len('__main__.py')].rstrip(os.sep).replace(os.sep, '.')]
-    else:
-        args = [sys.executable, script]
-    os.execv(sys.executable, args + sys.argv[1:])
+    dozer_log_listener.stop()  # exec skips atexit handlers, so write out the queued records first
+    os.execv(sys.executable, restart_args())
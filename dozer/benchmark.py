@@ -0,0 +1,395 @@
+"""
+Benchmarks for Dozer.
+Fills a local SQLite file with synthetic data for every table defined in the cogs, times the cogs' own query functions
+against it, along with mention cleaning on long paginated output, and writes the results as JSON so they can be
+compared between releases.
+
+Usage: python -m dozer.benchmark [--db PATH] [--scale FACTOR] [--iterations N] [--output FILE] [--baseline FILE] [--reuse]
+"""
+
+import argparse
+import asyncio
+import datetime
+import importlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+import types
+
+import sqlalchemy
+
+from . import db
+from . import migrations
+from . import utils
+from .pipeline import MessagePipeline
+
+# Row counts at --scale 1. Tables not listed here get DEFAULT_ROWS rows of generic data.
+TARGET_ROWS = {
+    'word_filter_infraction': 1000000,
+    'team_numbers': 500000,
+    'starboard_messages': 100000,
+    'missing_members': 50000,
+    'namegame_leaderboard': 20000,
+    'punishment_timers': 1000,
+}
+DEFAULT_ROWS = 1000
+GUILDS = 100
+USERS = 250000
+GUILD_SIZE = 5000  # members passed to onteam top
+INSERT_CHUNK = 10000
+
+DISCORD_EPOCH = 1420070400000
+WORDS = ['robot', 'team', 'match', 'field', 'alliance', 'score', 'drive', 'auton', 'intake', 'lift', 'gear', 'ball',
+         'climb', 'bumper', 'pit', 'judge', 'award', 'sponsor', 'mentor', 'code']
+
+
+def snowflake(rng, days_back=3 * 365):
+    """Returns a random Discord snowflake from within the last days_back days."""
+    created = time.time() - rng.random() * days_back * 86400
+    return (int(created * 1000) - DISCORD_EPOCH) << 22 | rng.getrandbits(22)
+
+
+def sentence(rng, words=8):
+    """Returns a random sentence made of robotics words."""
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, words)))
+
+
+class Dataset:
+    """Generates the synthetic data and remembers the ids the benchmarks need to pick from."""
+    def __init__(self, scale, seed=0):
+        self.scale = scale
+        self.rng = random.Random(seed)
+        self.guild_ids = [snowflake(self.rng) for _ in range(GUILDS)]
+        self.user_ids = [snowflake(self.rng) for _ in range(int(USERS * max(scale, 0.01)))]
+        self.missing_members = set()
+        self.rows = {}
+
+    def size(self, table):
+        """Returns how many rows to generate for a table."""
+        return max(1, int(TARGET_ROWS.get(table, DEFAULT_ROWS) * self.scale))
+
+    def generate(self, table):
+        """Yields rows for a table, using a realistic generator if there is one and generic values otherwise."""
+        generator = getattr(self, 'rows_' + table.name, None)
+        if generator is not None:
+            return generator(self.size(table.name))
+        return self.generic_rows(table, self.size(table.name))
+
+    def generic_rows(self, table, count):
+        """Random values by column type, for tables without a dedicated generator. Rows repeating a primary key are skipped,
+        so tables keyed by guild get at most one row per guild."""
+        primary_key = [column.name for column in table.primary_key]
+        seen = set()
+        for _ in range(count):
+            row = {}
+            for column in table.columns:
+                if column.primary_key and isinstance(column.type, sqlalchemy.Integer) and \
+                        not isinstance(column.type, sqlalchemy.BigInteger) and column.autoincrement in (True, 'auto'):
+                    continue
+                if isinstance(column.type, sqlalchemy.Boolean):
+                    row[column.name] = self.rng.random() < 0.5
+                elif isinstance(column.type, sqlalchemy.DateTime):
+                    row[column.name] = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.rng.randint(0, 10 ** 8))
+                elif isinstance(column.type, sqlalchemy.Integer):
+                    row[column.name] = self.rng.choice(self.guild_ids) if 'guild' in column.name else snowflake(self.rng)
+                else:
+                    row[column.name] = sentence(self.rng, 3)[:getattr(column.type, 'length', None) or 100]
+            key = tuple(row.get(name) for name in primary_key)
+            if None in key or key not in seen:
+                seen.add(key)
+                yield row
+
+    def rows_word_filters(self, count):
+        """A handful of filters per guild, mostly enabled."""
+        for filter_id in range(1, count + 1):
+            yield {'id': filter_id, 'guild_id': self.rng.choice(self.guild_ids), 'enabled': self.rng.random() < 0.9,
+                   'friendly_name': self.rng.choice(WORDS), 'pattern': rf'\b{self.rng.choice(WORDS)}\b'}
+
+    def rows_word_filter_infraction(self, count):
+        """Infractions by a skewed set of repeat offenders against the generated filters."""
+        filters = self.size('word_filters')
+        offenders = self.user_ids[:max(1, len(self.user_ids) // 20)]
+        for _ in range(count):
+            yield {'member_id': self.rng.choice(offenders), 'filter_id': self.rng.randint(1, filters),
+                   'timestamp': datetime.datetime.utcnow() - datetime.timedelta(seconds=self.rng.randint(0, 2 * 365 * 86400)),
+                   'message': sentence(self.rng, 20)}
+
+    def rows_team_numbers(self, count):
+        """Users on one to three teams each, with popular low-numbered teams much larger than others."""
+        seen = set()
+        while len(seen) < count:
+            key = (self.rng.choice(self.user_ids), int(self.rng.paretovariate(0.6)) % 20000, self.rng.choice(('frc', 'ftc')))
+            if key not in seen:
+                seen.add(key)
+                yield {'user_id': key[0], 'team_number': key[1], 'team_type': key[2]}
+
+    def rows_starboard_messages(self, count):
+        """Starred messages spread over the last three years."""
+        for _ in range(count):
+            yield {'message_id': snowflake(self.rng), 'starboard_message_id': snowflake(self.rng),
+                   'reaction_count': self.rng.randint(3, 40)}
+
+    def rows_missing_members(self, count):
+        """Departed members; their roles are generated with them, see rows_missing_roles."""
+        while len(self.missing_members) < count:
+            self.missing_members.add((self.rng.choice(self.guild_ids), self.rng.choice(self.user_ids)))
+        for guild_id, member_id in self.missing_members:
+            yield {'guild_id': guild_id, 'member_id': member_id,
+                   'left_at': datetime.datetime.utcnow() - datetime.timedelta(seconds=self.rng.randint(0, 365 * 86400))}
+
+    def rows_missing_roles(self, _count):
+        """Zero to eight saved roles for each departed member."""
+        for guild_id, member_id in self.missing_members:
+            for role_id in {self.rng.randint(1, 50) for _ in range(self.rng.randint(0, 8))}:
+                yield {'guild_id': guild_id, 'member_id': member_id, 'role_id': guild_id + role_id,
+                       'role_name': self.rng.choice(WORDS)}
+
+    def rows_namegame_leaderboard(self, count):
+        """Wins per player per mode, mostly small."""
+        seen = set()
+        while len(seen) < count:
+            key = (self.rng.choice(self.user_ids), self.rng.choice(('frc', 'ftc')))
+            if key not in seen:
+                seen.add(key)
+                yield {'user_id': key[0], 'game_mode': key[1], 'wins': int(self.rng.expovariate(0.2)) + 1}
+
+    def rows_punishment_timers(self, count):
+        """Mutes and deafens that expire within the next day."""
+        for _ in range(count):
+            yield {'guild_id': self.rng.choice(self.guild_ids), 'actor_id': self.rng.choice(self.user_ids),
+                   'target_id': self.rng.choice(self.user_ids), 'orig_channel_id': snowflake(self.rng), 'type': self.rng.randint(1, 2),
+                   'reason': sentence(self.rng), 'target_ts': int(time.time()) + self.rng.randint(60, 86400)}
+
+    def rows_word_filter_role_whitelist(self, _count):
+        """Up to three whitelisted roles per guild."""
+        for guild_id in self.guild_ids:
+            for role_id in {self.rng.randint(1, 50) for _ in range(self.rng.randint(0, 3))}:
+                yield {'guild_id': guild_id, 'role_id': guild_id + role_id}
+
+    def fill(self, engine, tables):
+        """Inserts the generated rows for each table in chunks, and records how many rows each table got."""
+        # Parents before children, so generators that depend on earlier tables (missing_roles) see their data
+        for table in sorted(tables, key=lambda table: table.name != 'missing_members'):
+            count = 0
+            chunk = []
+            with engine.begin() as conn:
+                for row in self.generate(table):
+                    chunk.append(row)
+                    if len(chunk) >= INSERT_CHUNK:
+                        conn.execute(table.insert(), chunk)
+                        count += len(chunk)
+                        chunk = []
+                if chunk:
+                    conn.execute(table.insert(), chunk)
+                    count += len(chunk)
+            self.rows[table.name] = count
+
+
+def paginated_output(rng, pages=50, lines=40):
+    """
+    Returns a fake context for a large guild and pages of leaderboard-style output for it. Half the pages are plain text
+    and the rest mention members, roles and channels, like the bot's longer paginated embeds and messages.
+    """
+    roles = [types.SimpleNamespace(id=snowflake(rng), name=rng.choice(WORDS).title() + ' ' + str(i)) for i in range(250)]
+    channels = [types.SimpleNamespace(id=snowflake(rng), name=rng.choice(WORDS) + '-' + str(i)) for i in range(100)]
+    members = {}
+    for _ in range(GUILD_SIZE):
+        member_id = snowflake(rng)
+        members[member_id] = types.SimpleNamespace(id=member_id, display_name=rng.choice(WORDS).title() + str(member_id % 10000))
+    guild = types.SimpleNamespace(id=snowflake(rng), roles=roles, channels=channels, get_member=members.get,
+                                  get_channel={channel.id: channel for channel in channels}.get)
+    member_ids = list(members)
+    output = []
+    for page in range(pages):
+        page_lines = []
+        for line in range(lines):
+            if page % 2:
+                page_lines.append(f'`{line + 1}.` <@{rng.choice(member_ids)}> of <@&{rng.choice(roles).id}> won '
+                                  f'{rng.randrange(100)} games in <#{rng.choice(channels).id}>')
+            else:
+                page_lines.append(f'`{line + 1}.` Team {rng.randrange(20000)} ({sentence(rng, 3)}) - {rng.randrange(100)}')
+        output.append('\n'.join(page_lines))
+    return types.SimpleNamespace(guild=guild), output
+
+
+def load_cogs():
+    """Imports every cog module so that all of their tables are defined, and returns the modules by name."""
+    cogs_dir = os.path.join(os.path.dirname(__file__), 'cogs')
+    return {ext[:-3]: importlib.import_module('dozer.cogs.' + ext[:-3])
+            for ext in sorted(os.listdir(cogs_dir)) if ext.endswith('.py') and not ext.startswith(('_', '.'))}
+
+
+def summarize(timings):
+    """Turns a list of durations in seconds into millisecond statistics."""
+    timings = sorted(timings)
+    return {
+        'iterations': len(timings),
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'median_ms': timings[len(timings) // 2] * 1000,
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        'min_ms': timings[0] * 1000,
+        'max_ms': timings[-1] * 1000,
+    }
+
+
+async def measure(func, iterations, setup=None):
+    """Times iterations awaits of func(*setup()), running setup outside of the timed section."""
+    timings = []
+    for _ in range(iterations):
+        args = (await setup()) if setup is not None else ()
+        start = time.perf_counter()
+        await func(*args)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+
+async def run_benchmarks(cogs, data, iterations):
+    """Runs each benchmark and returns their statistics by name."""
+    rng = random.Random(1)
+    results = {}
+
+    # The cog registers its pipeline stage when it's constructed, so it gets a stand-in bot with a pipeline of its own
+    filter_cog = cogs['filter'].Filter(types.SimpleNamespace(message_pipeline=MessagePipeline(None)))
+
+    async def cold_guild():
+        guild_id = rng.choice(data.guild_ids)
+        filter_cog.filter_dict.pop(guild_id, None)
+        db.settings_cache.clear()
+        return (guild_id,)
+
+    async def check_filter_lookups(guild_id):
+        await db.settings_cache.get_all(cogs['filter'].WordFilterRoleWhitelist, guild_id=guild_id)
+        await filter_cog.load_filters(guild_id)
+    results['filter.check_filters_cold_lookups'] = await measure(check_filter_lookups, iterations, cold_guild)
+
+    async def infraction_batch():
+        infraction = cogs['filter'].WordFilterInfraction
+        db.write_queue.add(*(infraction(member_id=rng.choice(data.user_ids), filter_id=1, timestamp=datetime.datetime.utcnow(),
+                                        message=sentence(rng)) for _ in range(100)))
+        await db.write_queue.flush()
+    results['filter.infraction_write_100'] = await measure(infraction_batch, iterations)
+
+    async def guild_members():
+        return (set(rng.sample(data.user_ids, min(GUILD_SIZE, len(data.user_ids)))),)
+    results['teams.onteam_top'] = await measure(cogs['teams'].Teams.team_counts, iterations, guild_members)
+
+    async def game_mode():
+        return (rng.choice(('frc', 'ftc')),)
+    results['namegame.leaderboard'] = await measure(cogs['namegame'].NameGame.leaderboard_entries, iterations, game_mode)
+
+    missing = list(data.missing_members)
+    rng.shuffle(missing)
+
+    async def departed_member():
+        return missing.pop() if missing else (rng.choice(data.guild_ids), rng.choice(data.user_ids))
+    results['roles.on_member_join_restore'] = await measure(cogs['roles'].Roles.pop_saved_roles, iterations, departed_member)
+
+    timers = cogs['moderation'].PunishmentTimerRecord.__table__
+
+    async def saved_timers():
+        def refill():
+            with db.engine.begin() as conn:
+                conn.execute(timers.delete())
+                conn.execute(timers.insert(), list(data.rows_punishment_timers(data.size('punishment_timers'))))
+        await db.run_sync(refill)
+        return (data.guild_ids,)
+    results['moderation.punishment_timer_reload'] = await measure(cogs['moderation'].Moderation.pop_punishment_timers,
+                                                                  max(1, iterations // 10), saved_timers)
+
+    ctx, pages = paginated_output(rng)
+
+    async def clean_pages():
+        for page in pages:
+            utils.clean(ctx, page)
+    results['utils.clean_paginated_output'] = await measure(clean_pages, iterations)
+
+    async def send_pages():
+        for page in pages:  # what DozerContext.send does to every message
+            utils.clean(ctx, page, mass=True, member=False, role=False, channel=False)
+    results['utils.clean_send_pages'] = await measure(send_pages, iterations)
+    return results
+
+
+def git_revision():
+    """Returns the current commit hash, or None if it can't be determined."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file):
+    """Adds the change in median time from a previous run's results to each benchmark."""
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    for name, stats in results.items():
+        if name in baseline and baseline[name]['median_ms']:
+            stats['baseline_median_ms'] = baseline[name]['median_ms']
+            stats['median_change_pct'] = (stats['median_ms'] / baseline[name]['median_ms'] - 1) * 100
+
+
+def main():
+    """Parses arguments, prepares the dataset and writes the results."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', default='dozer_benchmark.db', help='SQLite file to generate and benchmark against')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the number of generated rows')
+    parser.add_argument('--iterations', type=int, default=100, help='timed runs of each benchmark')
+    parser.add_argument('--output', default='-', help='file to write the JSON results to, or - for stdout')
+    parser.add_argument('--baseline', help='results of a previous run to compare against')
+    parser.add_argument('--reuse', action='store_true', help='benchmark an existing file instead of regenerating it')
+    args = parser.parse_args()
+
+    reuse = args.reuse and os.path.isfile(args.db)
+    if not reuse and os.path.isfile(args.db):
+        os.remove(args.db)
+    db.db_init('sqlite:///' + args.db)
+    cogs = load_cogs()
+    migrations.migrate(db.engine)
+
+    data = Dataset(args.scale)
+    start = time.perf_counter()
+    if reuse:
+        # Pick ids from the existing data rather than the freshly generated ones
+        missing_member, team_numbers = cogs['roles'].MissingMember, cogs['teams'].TeamNumbers
+        with db.engine.connect() as conn:
+            data.missing_members = {tuple(row) for row in conn.execute(sqlalchemy.select([missing_member.guild_id,
+                                                                                          missing_member.member_id]))}
+            data.guild_ids = list({guild_id for guild_id, _ in data.missing_members}) or data.guild_ids
+            data.user_ids = [row[0] for row in conn.execute(sqlalchemy.select([team_numbers.user_id]).distinct().limit(USERS))] \
+                or data.user_ids
+    else:
+        print(f'Generating data in {args.db}...', file=sys.stderr)
+        data.fill(db.engine, db.DatabaseObject.metadata.sorted_tables)
+    generation_time = time.perf_counter() - start
+
+    results = asyncio.get_event_loop().run_until_complete(run_benchmarks(cogs, data, args.iterations))
+    if args.baseline:
+        compare(results, args.baseline)
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'scale': args.scale,
+        'rows': data.rows,
+        'generation_seconds': None if reuse else generation_time,
+        'results': results,
+    }
+    output = json.dumps(report, indent='\t')
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,49 @@
 """Bot object for Dozer"""
 
+import asyncio
+import atexit
 import logging
+import os
+import queue
 import re
+import signal
+import subprocess
 import sys
+import time
 import traceback
 import discord
 from discord.ext import commands
 
+from . import db
+from . import handoff
 from . import utils
+from .capture import EventRecorder
+from .eventfilter import EventFilter
+from .extensions import ExtensionLoader
+from .ipc import LocalIPC, ShardIPC, SHARD_ID_ENV, SHARD_COUNT_ENV, IPC_PORT_ENV
+from .logs import LogQueueHandler, LogListener, JSONFormatter, TEXT_FORMAT
+from .loopmonitor import LoopMonitor
+from .memory import trim_members, SnapshotStore
+from .metrics import Metrics, MetricsServer
+from .perf import perf_stats, handler_owner
+from .pipeline import MessagePipeline
+from .ratelimit import RateLimiter
 
 # why on earth should logging objects be capitalized?
 dozer_logger = logging.getLogger('dozer')
-dozer_logger.level = logging.DEBUG
+dozer_logger.level = logging.INFO
 discord_logger = logging.getLogger('discord')
-discord_logger.level = logging.DEBUG
+discord_logger.level = logging.INFO  # below this, discord.py's gateway logging isn't even formatted
 
+# Records are written out by the listener's thread, so a slow stdout (a pipe to journald or docker) doesn't block the loop
 dozer_log_handler = logging.StreamHandler(stream=sys.stdout)
-dozer_log_handler.level = logging.INFO
-dozer_logger.addHandler(dozer_log_handler)
-discord_logger.addHandler(dozer_log_handler)
-dozer_log_handler.setFormatter(fmt=logging.Formatter('[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s'))
+dozer_log_handler.setFormatter(fmt=logging.Formatter(TEXT_FORMAT))
+dozer_queue_handler = LogQueueHandler(queue.Queue(maxsize=10000))
+dozer_logger.addHandler(dozer_queue_handler)
+discord_logger.addHandler(dozer_queue_handler)
+dozer_log_listener = LogListener(dozer_queue_handler.queue, dozer_log_handler, queue_handler=dozer_queue_handler)
+dozer_log_listener.start()
+atexit.register(dozer_log_listener.stop)
 
 if discord.version_info.major < 1:
     dozer_logger.error("Your installed discord.py version is too low "
@@ -29,6 +53,19 @@ if discord.version_info.major < 1:
                        discord.version_info.micro)
     sys.exit(1)
 
+# Points the bot at another Discord API, such as the fake one in dozer/fakegateway.py for load testing
+API_BASE_ENV = 'DOZER_API_BASE'
+if API_BASE_ENV in os.environ:
+    discord.http.Route.BASE = os.environ[API_BASE_ENV].rstrip('/')
+    dozer_logger.warning('Using the Discord API at %s', discord.http.Route.BASE)
+
+# discord.py only dispatches these events for messages in its cache; the bot dispatches the uncached_ ones for the rest
+UNCACHED_EVENTS = {
+    'raw_message_delete': 'uncached_message_delete',
+    'raw_message_edit': 'uncached_message_edit',
+    'raw_reaction_add': 'uncached_reaction_add',
+}
+
 
 class InvalidContext(commands.CheckFailure):
     """
@@ -47,34 +84,227 @@ class DozerContext(commands.Context):
 
 class Dozer(commands.Bot):
     """Botty things that are critical to Dozer working"""
-    _global_cooldown = commands.Cooldown(1, 1, commands.BucketType.user)  # One command per second per user
 
     def __init__(self, config):
-        super().__init__(command_prefix=config['prefix'])
+        memory = config['memory']
+        options = {'command_prefix': config['prefix'], 'max_messages': memory['max_messages'],
+                   'fetch_offline_members': memory['fetch_offline_members']}
+        if SHARD_ID_ENV in os.environ:  # started by the shard launcher
+            shard_id = int(os.environ[SHARD_ID_ENV])
+            super().__init__(shard_id=shard_id, shard_count=int(os.environ[SHARD_COUNT_ENV]), **options)
+            self.ipc = ShardIPC(shard_id, int(os.environ[IPC_PORT_ENV]), timeout=config['shards']['ipc_timeout_seconds'])
+        else:
+            super().__init__(**options)
+            self.ipc = LocalIPC()
         self.config = config
+        self.event_filter = self.configure_event_filter(self._connection, config)
         self._restarting = False
+        self._warmed_up = asyncio.Event()
+        # A replacement process for a restart stays in standby, ignoring events, until the old process hands over to it
+        self._standby = handoff.HANDOFF_FILE_ENV in os.environ
+        self._replacement = None
+        self.handoff_file = config['restart']['handoff_file']
+        if self.shard_id is not None:
+            root, ext = os.path.splitext(self.handoff_file)
+            self.handoff_file = f'{root}.shard{self.shard_id}{ext}'
+        self.ipc.handler('guild_count', self.guild_count)
+        self.ipc.subscribe('shutdown', self.shutdown)
+        self.ipc.subscribe('guilds_changed', self.update_presence)
+        self.loop.create_task(self.ipc.connect())
+        self.message_pipeline = MessagePipeline(self)
+        self.message_pipeline.add_stage('commands', 100, self.command_stage)
+        self.extension_loader = ExtensionLoader(self, lazy=config['lazy_cogs'])
+        rate_limit = config['rate_limit']
+        self.rate_limiter = RateLimiter(rate=rate_limit['rate'], per=rate_limit['per_seconds'], burst=rate_limit['burst'],
+                                        scope=rate_limit['scope'], max_keys=rate_limit['max_keys'])
+        monitor_config = config['loop_monitor']
+        self.loop_monitor = LoopMonitor(self.loop, interval=monitor_config['interval_ms'] / 1000,
+                                        threshold=monitor_config['stall_threshold_ms'] / 1000,
+                                        history_minutes=monitor_config['history_minutes'])
+        self.loop_monitor.start()
+        self.snapshots = None
+        self.configure_memory(config)
+        capture = config['event_capture']
+        self.event_recorder = EventRecorder(capture['path'], config['prefix'], capture['max_events']) if capture['path'] else None
         self.check(self.global_checks)
-        self.http_session = self.http._session
+        for event in ('on_guild_role_create', 'on_guild_role_update', 'on_guild_role_delete', 'on_guild_channel_create',
+                      'on_guild_channel_update', 'on_guild_channel_delete', 'on_guild_remove'):
+            self.add_listener(self.invalidate_mentions, event)
+        self.http_session = self.http._session  # cogs' own requests aren't counted as Discord API requests below
+        metrics_config = config['metrics']
+        self.metrics = Metrics() if metrics_config['enabled'] else None
+        self.metrics_server = None
+        if self.metrics is not None:
+            self.metrics.instrument(self.http)
+            # Each shard serves its metrics on its own port, counting up from the configured one
+            self.metrics_server = MetricsServer(self, self.metrics, metrics_config['host'], metrics_config['port'] + (self.shard_id or 0))
+            self.loop.create_task(self.metrics_server.start())
+        self.configure_logging(config)
+
+    @staticmethod
+    def configure_event_filter(state, config):
+        """Installs the gateway event allow-list from the config into the connection state, if there is one"""
+        allowed = config['gateway_events']['allow']
+        if allowed is None:
+            return None
+        memory = config['memory']
+        if (memory['trim_members_minutes'] or not memory['fetch_offline_members']) and 'PRESENCE_UPDATE' not in allowed:
+            # Members missing from the member cache are only added back, and kept up to date, by their presence updates
+            dozer_logger.info('Parsing PRESENCE_UPDATE events, since the member cache is trimmed or not filled on startup')
+            allowed = list(allowed) + ['PRESENCE_UPDATE']
+        event_filter = EventFilter(allowed)
+        event_filter.install(state)
+        return event_filter
+
+    def configure_memory(self, config):
+        """Starts the member cache trimming and automatic allocation snapshots, if they are set up in the config"""
+        if config['memory']['trim_members_minutes']:
+            self.loop.create_task(self.trim_member_cache(config['memory']['trim_members_minutes'] * 60))
+        leak_config = config['tracemalloc']
+        snapshot_directory = leak_config['snapshot_directory']
+        if self.shard_id is not None:
+            snapshot_directory = os.path.join(snapshot_directory, f'shard{self.shard_id}')
+        self.snapshots = SnapshotStore(snapshot_directory, keep=leak_config['keep_in_memory'])
+        if leak_config['auto_snapshot_rss_mb']:
+            self.loop.create_task(self.snapshots.watch(leak_config['auto_snapshot_rss_mb'] * 2 ** 20, leak_config['auto_snapshot_step_mb'] * 2 ** 20,
+                                                       leak_config['check_interval_minutes'] * 60, frames=leak_config['frames']))
+
+    @staticmethod
+    def configure_logging(config):
+        """Applies the log levels and output format from the config"""
         if 'log_level' in config:
-            dozer_log_handler.setLevel(config['log_level'])
+            dozer_logger.setLevel(config['log_level'])
+        log_config = config['logging']
+        discord_logger.setLevel(log_config['discord_level'])
+        dozer_log_listener.dedup_interval = log_config['dedup_seconds']
+        if log_config['format'] == 'json':
+            dozer_log_handler.setFormatter(JSONFormatter())
 
     async def on_ready(self):
         """Things to run when the bot has initialized and signed in"""
         dozer_logger.info('Signed in as {}#{} ({})'.format(self.user.name, self.user.discriminator, self.user.id))
+        await self.warm_up()
+        if handoff.HANDOFF_FILE_ENV in os.environ:
+            await self.take_over()
+        await self.update_presence()
+        await self.ipc.publish('guilds_changed')  # the other shards' presence includes this one's guilds
+
+    async def guild_count(self):
+        """IPC query handler returning how many guilds this shard is in"""
+        return len(self.guilds)
+
+    async def trim_member_cache(self, interval):
+        """Drops offline members of large guilds from the member cache every interval seconds, to keep memory use down"""
+        await self.wait_until_ready()
+        while not self.is_closed():
+            await asyncio.sleep(interval)
+            start = time.perf_counter()
+            dropped = trim_members(self)
+            dozer_logger.info('Dropped %d offline members from the cache in %.0f ms', dropped, (time.perf_counter() - start) * 1000)
+
+    async def update_presence(self):
+        """Sets the bot's presence, which shows the number of guilds across all shards"""
+        if not self.is_ready():
+            return
         if self.config['is_backup']:
             status = discord.Status.dnd
         else:
             status = discord.Status.online
-        game = discord.Game(name='%shelp | %d guilds' % (self.config['prefix'], len(self.guilds)))
+        guilds = sum(count for count in await self.ipc.query('guild_count') if count is not None)
+        game = discord.Game(name=f"{self.config['prefix']}help | {guilds} guilds")
         try:
             await self.change_presence(activity=game, status=status)
         except TypeError:
             dozer_logger.warning("You are running an older version of the discord.py rewrite (with breaking changes)! "
                                  "To upgrade, run `pip install -r requirements.txt --upgrade`")
 
+    async def warm_up(self):
+        """
+        Loads the configuration caches of every cog for all guilds at once, by awaiting each cog's warm_up(guilds)
+        coroutine if it has one. Until the first warm-up finishes, event handlers other than on_ready wait for it,
+        instead of each one querying the database cold right after connecting.
+        """
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*(cog.warm_up(self.guilds) for cog in self.cogs.values() if hasattr(cog, 'warm_up')))
+        except Exception:
+            dozer_logger.exception('Cache warm-up failed, configuration will be loaded as it is used')
+        finally:
+            self._warmed_up.set()
+        dozer_logger.info('Warmed up caches for %d guilds in %.0f ms', len(self.guilds), (time.perf_counter() - start) * 1000)
+
+    async def wait_until_warmed_up(self):
+        """Waits until the first cache warm-up has finished, after the bot is ready"""
+        await self._warmed_up.wait()
+
+    @staticmethod
+    async def invalidate_mentions(changed, *_):
+        """Drops the cleaned mentions of a guild whose roles or channels changed, or that the bot left"""
+        utils.mention_index.invalidate(getattr(changed, 'guild', changed).id)
+
+    @staticmethod
+    async def on_guild_remove(guild):
+        """Drops the cached settings of a guild the bot left"""
+        db.settings_cache.invalidate_guild(guild.id)
+
+    def dispatch(self, event_name, *args, **kwargs):
+        """Dispatches an event; raw gateway payloads are also recorded and counted, and raw events about messages that
+        aren't cached are followed by their uncached_ counterpart"""
+        # Raw gateway payloads are dispatched as they arrive, before they are parsed, so they're recorded in order
+        if event_name == 'socket_response':
+            if self.event_recorder is not None:
+                self.event_recorder.record(args[0])
+            if self.metrics is not None:
+                self.metrics.event(args[0])
+        super().dispatch(event_name, *args, **kwargs)
+        # Raw events are dispatched before the message is looked up (and for deletions, removed from the cache)
+        if event_name in UNCACHED_EVENTS and self._connection._get_message(args[0].message_id) is None:  # pylint: disable=protected-access
+            super().dispatch(UNCACHED_EVENTS[event_name], *args, **kwargs)
+
+    async def on_message(self, message):
+        """Runs each message through the message pipeline, whose last stage processes commands"""
+        await self.message_pipeline.process(message)
+
+    async def command_stage(self, envelope):
+        """Message pipeline stage that invokes the command a message contains, if any"""
+        if envelope.prefix is None or envelope.author.bot:
+            return False
+        await self.invoke(await self.get_context(envelope.message))
+        return True
+
     async def get_context(self, message, *, cls=DozerContext):
         return await super().get_context(message, cls=cls)
 
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        # Each event handler runs in its own task, so this only labels queries made by this handler
+        db.query_source.set(getattr(coro, '__qualname__', event_name))
+        if self._standby and not (event_name == 'on_ready' and getattr(coro, '__self__', None) is self):
+            return  # another process is handling events
+        if event_name != 'on_ready' and not self._warmed_up.is_set():
+            await self._warmed_up.wait()
+        if perf_stats.enabled:
+            coro = perf_stats.timed(handler_owner(coro), event_name, coro)
+        await super()._run_event(coro, event_name, *args, **kwargs)
+
+    async def invoke(self, ctx):
+        """Invokes a command, labelling the queries it makes with the command's name and timing it"""
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        name = 'command ' + ctx.command.qualified_name
+        token = db.query_source.set(name)
+        start = time.perf_counter() if perf_stats.enabled else None
+        try:
+            return await super().invoke(ctx)
+        finally:
+            db.query_source.reset(token)
+            # Command errors are handled inside invoke, so failures are only visible on the context
+            failed = getattr(ctx, 'command_failed', False)
+            if start is not None:
+                perf_stats.record(type(ctx.cog).__name__ if ctx.cog else type(self).__name__, name, time.perf_counter() - start,
+                                  error=failed)
+            if self.metrics is not None:
+                self.metrics.command(ctx.command.qualified_name, failed)
+
     async def on_command_error(self, context, exception):
         if isinstance(exception, commands.NoPrivateMessage):
             await context.send('{}, This command cannot be used in DMs.'.format(context.author.mention))
@@ -103,13 +333,14 @@ class Dozer(commands.Bot):
 
         else:
             await context.send('```\n%s\n```' % ''.join(traceback.format_exception_only(type(exception), exception)).strip())
+            # The traceback is formatted by the log listener, off the event loop
             if isinstance(context.channel, discord.TextChannel):
-                dozer_logger.error('Error in command <{0}> ({1.name!r}:({1.id}) {2}:({2.id}) {3}:({3.id}) {4})'
-                                   ''.format(context.command, context.guild, context.channel, context.author, context.message.content))
+                dozer_logger.error('Error in command <%s> (%r:(%s) %s:(%s) %s:(%s) %s)', context.command, context.guild.name,
+                                   context.guild.id, context.channel, context.channel.id, context.author, context.author.id,
+                                   context.message.content, exc_info=exception)
             else:
-                dozer_logger.error('Error in command <{0}> (DM {1}:({1}.id) {2})'.format(context.command, context.channel.recipient,
-                                                                                         context.message.content))
-            dozer_logger.error(''.join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+                dozer_logger.error('Error in command <%s> (DM %s:(%s) %s)', context.command, context.channel.recipient,
+                                   context.channel.recipient.id, context.message.content, exc_info=exception)
 
     @staticmethod
     def format_error(ctx, err, *, word_re=re.compile('[A-Z][a-z]+')):
@@ -125,9 +356,9 @@ class Dozer(commands.Bot):
         """Checks that should be executed before passed to the command"""
         if ctx.author.bot:
             raise InvalidContext('Bots cannot run commands!')
-        retry_after = self._global_cooldown.update_rate_limit()
+        retry_after = self.rate_limiter.hit(ctx)
         if retry_after:
-            raise InvalidContext('Global rate-limit exceeded!')
+            raise InvalidContext(f'Rate limit exceeded, try again in {retry_after:.2f}s')
         return True
 
     def run(self, *args, **kwargs):
@@ -135,9 +366,86 @@ class Dozer(commands.Bot):
         del self.config['discord_token']  # Prevent token dumping
         super().run(token)
 
+    async def restart(self):
+        """
+        Restarts the bot. By default (exec mode) this process shuts down, then replaces itself with a new one which picks
+        up its state. In blue_green mode, a new process is started while this one keeps running; once the new one has
+        connected and warmed up, this one hands its state over and exits. The new process is a child of this one, so
+        blue_green needs a process supervisor that follows the new PID; systemd and Docker stop the new process along
+        with this one, and the shard launcher treats this one exiting as the shard stopping, so shards always use exec.
+        """
+        config = self.config['restart']
+        if config['mode'] == 'blue_green' and self.shard_id is not None:
+            dozer_logger.warning('Blue/green restarts are not supported under the shard launcher, restarting in place')
+        if config['mode'] != 'blue_green' or self.shard_id is not None:
+            await self.shutdown(restart=True)
+            return
+        if self._replacement is not None:
+            return  # already restarting
+        env = dict(os.environ)
+        env[handoff.HANDOFF_FILE_ENV] = os.path.abspath(self.handoff_file)
+        env[handoff.HANDOFF_PID_ENV] = str(os.getpid())
+        self.loop.add_signal_handler(signal.SIGUSR1, lambda: self.loop.create_task(self.hand_off()))
+        self._replacement = subprocess.Popen(handoff.restart_args(), env=env)
+        dozer_logger.info('Started replacement process %d, waiting for it to connect', self._replacement.pid)
+        self.loop.create_task(self._replacement_timeout(config['timeout_seconds']))
+
+    async def _replacement_timeout(self, timeout):
+        await asyncio.sleep(timeout)
+        if not self._standby:
+            dozer_logger.error('Replacement process %d did not connect within %d seconds, stopping it', self._replacement.pid, timeout)
+            self.loop.remove_signal_handler(signal.SIGUSR1)
+            self._replacement.kill()
+            self._replacement = None
+
+    async def hand_off(self):
+        """Called once the replacement process is ready: stops handling events, hands the state over and shuts down."""
+        self.loop.remove_signal_handler(signal.SIGUSR1)
+        self._standby = True
+        state = handoff.export_state(self)
+        await db.write_queue.flush()  # so the new process sees everything this one wrote
+        handoff.write_state(self.handoff_file, state)
+        dozer_logger.info('Handed over to replacement process %d', self._replacement.pid)
+        await self.shutdown()
+
+    async def take_over(self):
+        """
+        Takes over from the process this one is replacing: tells it this one is ready, waits for its state, then starts
+        handling events, including the cogs' on_ready listeners which were held back until now.
+        """
+        start = time.perf_counter()
+        handoff_file = os.environ.pop(handoff.HANDOFF_FILE_ENV)
+        old_pid = os.environ.pop(handoff.HANDOFF_PID_ENV, None)
+        if old_pid is not None:
+            try:
+                os.kill(int(old_pid), signal.SIGUSR1)
+            except ProcessLookupError:
+                dozer_logger.warning('The process being replaced (%s) has already exited', old_pid)
+        state = await handoff.read_state(handoff_file, self.config['restart']['timeout_seconds'])
+        self._standby = False
+        if state is None:
+            dozer_logger.warning('No state was handed over, starting from scratch')
+        else:
+            await handoff.import_state(self, state)
+        for listener in self.extra_events.get('on_ready', []):
+            self.loop.create_task(self._run_event(listener, 'on_ready'))
+        dozer_logger.info('Took over in %.0f ms', (time.perf_counter() - start) * 1000)
+
     async def shutdown(self, restart=False):
-        """Shuts down the bot"""
+        """Shuts down the bot. When restarting, the state is saved for the next process to pick up."""
         self._restarting = restart
+        if restart:
+            self._standby = True
+            state = handoff.export_state(self)
+            await db.write_queue.flush()
+            handoff.write_state(self.handoff_file, state)
+            os.environ[handoff.HANDOFF_FILE_ENV] = os.path.abspath(self.handoff_file)
+        self.loop_monitor.stop()
+        if self.event_recorder is not None:
+            self.event_recorder.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
         await self.logout()
         await self.close()
+        await db.write_queue.flush()
         self.loop.stop()
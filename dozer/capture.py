@@ -0,0 +1,186 @@
+"""Records the gateway events the bot receives, anonymised, so they can be replayed by dozer.replay"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+__all__ = ['Anonymizer', 'EventRecorder', 'read_events']
+
+logger = logging.getLogger('dozer')
+
+# Only the keys listed here are recorded; every other key is left out of the capture, so fields Discord adds later
+# aren't recorded until someone has checked them.
+# Keys whose string values are free text written by users, which is scrambled word by word
+TEXT_KEYS = {'content', 'username', 'discriminator', 'nick', 'name', 'filename', 'topic', 'title', 'description', 'value',
+             'text', 'reason'}
+# Keys discord.py expects to be present, recorded as null: images and links
+NULL_KEYS = {'avatar', 'icon', 'splash', 'banner', 'url', 'proxy_url'}
+# Keys holding lists of ids, besides those ending in _ids
+ID_LIST_KEYS = {'ids', 'roles', 'mention_roles', 'not_found'}
+# Keys whose values are recorded as they are: flags, counts, permissions, timestamps and the objects holding the rest
+PLAIN_KEYS = {
+    'type', 'bot', 'status', 'timestamp', 'edited_timestamp', 'joined_at', 'premium_since', 'tts', 'pinned',
+    'mention_everyone', 'flags', 'permissions', 'position', 'color', 'hoist', 'managed', 'mentionable', 'large',
+    'unavailable', 'member_count', 'features', 'region', 'deaf', 'mute', 'self_deaf', 'self_mute', 'self_video',
+    'self_stream', 'suppress', 'nsfw', 'rate_limit_per_user', 'bitrate', 'user_limit', 'animated', 'require_colons',
+    'available', 'verification_level', 'default_message_notifications', 'explicit_content_filter', 'mfa_level',
+    'premium_tier', 'premium_subscription_count', 'afk_timeout', 'system_channel_flags', 'allow', 'deny', 'count', 'me',
+    'inline', 'width', 'height', 'size', 'content_type', 'since', 'afk', 'desktop', 'mobile', 'web', 'v', 'shard',
+    # containers; what's inside them goes through the same lists
+    'user', 'author', 'member', 'members', 'mentions', 'recipients', 'embeds', 'attachments', 'fields', 'footer',
+    'image', 'thumbnail', 'video', 'provider', 'reactions', 'emoji', 'emojis', 'channels', 'guilds', 'presences',
+    'voice_states', 'permission_overwrites', 'private_channels', 'game', 'activities', 'client_status',
+    'message_reference', 'referenced_message',
+}
+_OMIT = object()
+
+TEXT_TOKEN = re.compile(r'<(@[!&]?|#|a?:\w+:)(\d+)>|https?://([^\s/]+)(\S*)|\w+')
+SNOWFLAKE_TIME_UNIT = 3600000  # anonymised ids keep the hour they were created in
+
+
+class Anonymizer:
+    """
+    Replaces the ids, names and text in gateway payloads, consistently within one capture so that the relations
+    between users, messages, channels and guilds are kept, and leaves out every key not in the lists above. Ids are
+    renumbered in the order they are first seen, keeping only the hour they were created in. Words are replaced by
+    pseudo-words of the same length and kind, derived from a random key so the original words can't be guessed back;
+    emoji and punctuation are kept, as are link hosts and command names (the first word of a message starting with the
+    command prefix).
+    """
+    def __init__(self, prefix, key=None):
+        self.prefix = prefix
+        self.key = key or os.urandom(16)
+        self._ids = {}
+        self._words = {}
+
+    def snowflake(self, value):
+        """Returns the anonymised version of an id."""
+        original = int(value)
+        mapped = self._ids.get(original)
+        if mapped is None:
+            hour = (original >> 22) // SNOWFLAKE_TIME_UNIT * SNOWFLAKE_TIME_UNIT
+            mapped = self._ids[original] = hour << 22 | len(self._ids) % (1 << 22)
+        return str(mapped) if isinstance(value, str) else mapped
+
+    def word(self, word):
+        """Returns the pseudo-word replacing a word: letters become letters of the same case, digits become digits."""
+        mapped = self._words.get(word)
+        if mapped is None:
+            digest = hashlib.blake2b(word.encode(), key=self.key).digest()
+            letters = []
+            for index, char in enumerate(word):
+                byte = digest[index % len(digest)]
+                if char.isdigit():
+                    letters.append(str(byte % 10))
+                elif char.isupper():
+                    letters.append(chr(ord('A') + byte % 26))
+                else:
+                    letters.append(chr(ord('a') + byte % 26))
+            mapped = self._words[word] = ''.join(letters)
+            if len(self._words) > 1000000:  # keep memory bounded; words seen again only lose consistency
+                self._words.clear()
+        return mapped
+
+    def text(self, text, command=False):
+        """Scrambles the words of some text, keeping mentions (with anonymised ids), link hosts and emoji."""
+        keep = None
+        if command and text.startswith(self.prefix):
+            keep = text[len(self.prefix):].split(' ', 1)[0]
+
+        def replace(match):
+            if match.group(2) is not None:
+                return f'<{match.group(1)}{self.snowflake(match.group(2))}>'
+            if match.group(3) is not None:
+                path = self.word(match.group(4))[:16] if match.group(4) else ''
+                return f'https://{match.group(3)}/{path}'
+            word = match.group(0)
+            if word == keep:
+                return word
+            return self.word(word)
+        return TEXT_TOKEN.sub(replace, text)
+
+    def scrub(self, data):
+        """Returns an anonymised copy of a payload, keeping only the keys the capture's lists allow."""
+        scrubbed = self._scrub(data, None)
+        return None if scrubbed is _OMIT else scrubbed
+
+    def _scrub(self, data, key):
+        id_list = key is not None and (key in ID_LIST_KEYS or key.endswith('_ids'))
+        if isinstance(data, (dict, list)) and key is not None and key not in PLAIN_KEYS and not id_list:
+            return _OMIT
+        if isinstance(data, dict):
+            scrubbed = {}
+            for k, v in data.items():
+                v = self._scrub(v, k)
+                if v is not _OMIT:
+                    scrubbed[k] = v
+            return scrubbed
+        if isinstance(data, list):
+            if id_list:
+                return [self.snowflake(item) if isinstance(item, (str, int)) else self._scrub(item, None) for item in data]
+            return [item for item in (self._scrub(item, key) for item in data) if item is not _OMIT]
+        return self._scrub_value(data, key)
+
+    def _scrub_value(self, value, key):
+        if value is None:
+            return None
+        if key is None:
+            return _OMIT
+        if (key == 'id' or key.endswith('_id')) and isinstance(value, (str, int)) and str(value).isdigit():
+            return self.snowflake(value)
+        if key in NULL_KEYS:
+            return None
+        if key in TEXT_KEYS and isinstance(value, str):
+            return self.text(value, command=key == 'content')
+        return value if key in PLAIN_KEYS else _OMIT
+
+
+class EventRecorder:
+    """
+    Writes each dispatched gateway event, anonymised, to a gzipped JSON lines file as
+    [seconds since the first event, event name, data], until max_events have been written.
+    """
+    def __init__(self, path, prefix, max_events=1000000):
+        self.path = path
+        self.max_events = max_events
+        self.recorded = 0
+        self.anonymizer = Anonymizer(prefix)
+        self._start = None
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        logger.info('Recording gateway events to %s', path)
+
+    def record(self, payload):
+        """Writes a gateway payload, if it is an event."""
+        if self._file is None or payload.get('op') != 0:
+            return
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        self._file.write(json.dumps([round(now - self._start, 4), payload['t'], self.anonymizer.scrub(payload['d'])],
+                                    separators=(',', ':')) + '\n')
+        self.recorded += 1
+        if self.recorded >= self.max_events:
+            self.close()
+        elif self.recorded % 10000 == 0:
+            self._file.flush()  # so that a capture cut short by a crash is still mostly readable
+
+    def close(self):
+        """Finishes the capture file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info('Recorded %d gateway events to %s', self.recorded, self.path)
+
+
+def read_events(path):
+    """Yields the [seconds, event name, data] entries of a capture, stopping at the end of one that was cut short."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                yield json.loads(line)
+        except (EOFError, ValueError):
+            return
@@ -2,11 +2,19 @@
 import copy
 import re
 import logging
+import os
+import resource
+import sys
+import tracemalloc
 import discord
 
-from discord.ext.commands import NotOwner
+from discord.ext.commands import BadArgument, NotOwner
 
 from ._utils import *
+from .. import db
+from ..extensions import import_profile
+from ..memory import cache_sizes, rss
+from ..perf import perf_stats
 
 logger = logging.getLogger("dozer")
 
@@ -31,8 +39,11 @@ class Development(Cog):
         """Reloads a cog."""
         extension = 'dozer.cogs.' + cog
         msg = await ctx.send('Reloading extension %s' % extension)
-        self.bot.unload_extension(extension)
-        self.bot.load_extension(extension)
+        if extension in self.bot.extension_loader.pending:  # never loaded, so only its stubs are registered
+            await self.bot.extension_loader.load(extension, 'reload')
+        else:
+            self.bot.unload_extension(extension)
+            self.bot.load_extension(extension)
         await msg.edit(content='Reloaded extension %s' % extension)
 
     reload.example_usage = """
@@ -90,6 +101,279 @@ class Development(Cog):
     `{prefix}su cooldude#1234 {prefix}ping` - simulate cooldude sending `{prefix}ping`
     """
 
+    @group(invoke_without_command=True)
+    async def dbstats(self, ctx, count: int = 5):
+        """Shows the SQL statements that have taken the most total time since startup, and what issued them."""
+        count = max(1, min(count, 10))
+        top = db.query_stats.top(count)
+        if not top:
+            await ctx.send('No queries have been recorded yet.')
+            return
+        e = discord.Embed(title=f'Top {len(top)} statements by total time', color=discord.Color.blue())
+        for rank, stats in enumerate(top, 1):
+            statement = ' '.join(stats.statement.split())
+            if len(statement) > 300:
+                statement = statement[:297] + '...'
+            sources = ', '.join(f"{source or 'unknown'} ({total * 1000:.0f} ms)"
+                                for source, total in stats.sources.most_common(3))
+            e.add_field(name=f'{rank}. {stats.total_time * 1000:.1f} ms total, {stats.calls} calls',
+                        value=f'p50 {stats.percentile(50) * 1000:.2f} ms | p99 {stats.percentile(99) * 1000:.2f} ms | '
+                              f'{stats.rows} rows | {stats.errors} errors\n```sql\n{statement}\n```From: {sources}',
+                        inline=False)
+        await ctx.send(embed=e)
+
+    dbstats.example_usage = """
+    `{prefix}dbstats` - shows the 5 statements that have taken the most total time
+    `{prefix}dbstats 10` - shows the top 10 statements
+    """
+
+    @dbstats.command(name='reset')
+    async def dbstats_reset(self, ctx):
+        """Clears the recorded query statistics."""
+        db.query_stats.reset()
+        await ctx.send('Query statistics cleared.')
+
+    dbstats_reset.example_usage = """
+    `{prefix}dbstats reset` - starts recording query statistics from scratch
+    """
+
+    @group(invoke_without_command=True)
+    async def perf(self, ctx, minutes: int = 0, count: int = 10):
+        """
+        Shows the event listeners, message pipeline stages and commands that have taken the most total time.
+        By default this covers everything since startup or the last reset; pass a number of minutes to only include recent calls.
+        """
+        if not perf_stats.enabled:
+            await ctx.send(f'Handler timing is disabled. Enable it with `{ctx.prefix}perf enable`.')
+            return
+        minutes = max(1, min(minutes, perf_stats.window_minutes)) if minutes > 0 else None
+        count = max(1, min(count, 15))  # keeps the table under Discord's message length limit
+        top = perf_stats.top(count, window=minutes)
+        if not top:
+            await ctx.send('No handler calls have been recorded yet.')
+            return
+        title = f'Top {len(top)} handlers by total time'
+        if minutes is not None:
+            title += f' in the last {minutes} minutes'
+        lines = []
+        for stats, histogram in top:
+            name = f'{stats.cog}.{stats.name}'[:40]
+            lines.append(f'{name:<40} {histogram.calls:>6} {histogram.errors:>4} {histogram.percentile(50) * 1000:>8.1f} '
+                         f'{histogram.percentile(95) * 1000:>8.1f} {histogram.percentile(99) * 1000:>8.1f} '
+                         f'{histogram.max_time * 1000:>8.1f}')
+        header = f"{'handler':<40} {'calls':>6} {'errs':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        table = '\n'.join(lines)
+        await ctx.send(f'**{title}**\n```\n{header}\n{table}\n```')
+
+    perf.example_usage = """
+    `{prefix}perf` - shows the 10 handlers that have taken the most total time since startup
+    `{prefix}perf 15` - only counts calls from the last 15 minutes
+    `{prefix}perf 60 15` - shows the top 15 handlers over the last hour
+    """
+
+    @perf.command(name='reset')
+    async def perf_reset(self, ctx):
+        """Clears the recorded handler timings."""
+        perf_stats.reset()
+        await ctx.send('Handler timings cleared.')
+
+    perf_reset.example_usage = """
+    `{prefix}perf reset` - starts recording handler timings from scratch
+    """
+
+    @perf.command(name='enable')
+    async def perf_enable(self, ctx):
+        """Starts timing handlers, until the bot restarts."""
+        perf_stats.enabled = True
+        await ctx.send('Handler timing enabled.')
+
+    perf_enable.example_usage = """
+    `{prefix}perf enable` - starts timing handlers
+    """
+
+    @perf.command(name='disable')
+    async def perf_disable(self, ctx):
+        """Stops timing handlers, until the bot restarts. Timings recorded so far are kept."""
+        perf_stats.enabled = False
+        await ctx.send('Handler timing disabled.')
+
+    perf_disable.example_usage = """
+    `{prefix}perf disable` - stops timing handlers
+    """
+
+    @command()
+    async def importtime(self, ctx, cog=None):
+        """
+        Profiles how long each extension takes to import, by importing it in a fresh interpreter with `-X importtime`,
+        along with its slowest direct imports and how long loading it took in this process.
+        """
+        loader = self.bot.extension_loader
+        if cog is not None:
+            extensions = ['dozer.cogs.' + cog]
+        else:
+            extensions = sorted(set(loader.load_times) | set(loader.pending))
+        lines = []
+        async with ctx.typing():
+            for extension in extensions:
+                try:
+                    total, imports = await import_profile(extension)
+                except RuntimeError as err:
+                    lines.append(f'{extension}: {err}')
+                    continue
+                if extension in loader.load_times:
+                    seconds, reason = loader.load_times[extension]
+                    loaded = f'loaded in {seconds * 1000:.0f} ms ({reason})'
+                else:
+                    loaded = 'not loaded yet'
+                lines.append(f"{extension[len('dozer.cogs.'):]:<24} {total / 1000:>7.0f} ms import, {loaded}")
+                slowest = imports[:3] if cog is None else imports[:15]
+                lines.extend(f'    {name:<20} {cumulative / 1000:>7.0f} ms' for name, cumulative in slowest)
+        if not lines:
+            await ctx.send('No extensions found.')
+            return
+        message = ''
+        for line in lines:
+            if len(message) + len(line) > 1900:
+                await ctx.send(f'```\n{message}```')
+                message = ''
+            message += line + '\n'
+        await ctx.send(f'```\n{message}```')
+
+    importtime.example_usage = """
+    `{prefix}importtime` - shows the import time of every extension and its three slowest imports
+    `{prefix}importtime tba` - shows the import time of the tba cog and all of its direct imports
+    """
+
+    @command()
+    async def memory(self, ctx):
+        """
+        Estimates how much memory each of discord.py's caches and the bot's own caches use, from the size of a sample of
+        their entries. Objects shared between caches, like the guild a member belongs to, are only counted in their own.
+        """
+        sizes = cache_sizes(self.bot)
+        lines = [f"{'cache':<16} {'entries':>9} {'est. size':>11}"]
+        for name, count, size in sizes:
+            lines.append(f"{name:<16} {('' if count is None else count):>9} {size / 2 ** 20:>7.1f} MiB")
+        lines.append(f"{'total':<16} {'':>9} {sum(size for _, _, size in sizes) / 2 ** 20:>7.1f} MiB")
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        config = self.bot.config['memory']
+        await ctx.send('```\n{}\n```Peak process memory: {:.1f} MiB | max_messages: {} | fetch_offline_members: {}'.format(
+            '\n'.join(lines), peak, config['max_messages'], config['fetch_offline_members']))
+
+    memory.example_usage = """
+    `{prefix}memory` - shows how much memory the caches are estimated to use
+    """
+
+    @group(name='tracemalloc', invoke_without_command=True)
+    async def trace(self, ctx):
+        """
+        Shows whether allocations are being traced with tracemalloc, how much traced memory is allocated, and the snapshots
+        that can be compared. Automatic snapshots, taken as the process grows, are kept on disk.
+        """
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            status = (f'Tracing {tracemalloc.get_traceback_limit()} frame(s) per allocation: {format_size(current)} allocated, '
+                      f'{format_size(peak)} at peak, {format_size(tracemalloc.get_tracemalloc_memory())} used by tracemalloc itself.')
+        else:
+            status = f'Not tracing allocations. Start with `{ctx.prefix}tracemalloc start`.'
+        names = self.bot.snapshots.names()
+        snapshots = '\n'.join(name if size is None else f'{name} (in memory, RSS {format_size(size)})'
+                              for name, size in names.items()) or 'none'
+        await ctx.send(f'{status}\nProcess RSS: {format_size(rss())}\nSnapshots:\n```\n{snapshots}\n```')
+
+    trace.example_usage = """
+    `{prefix}tracemalloc` - shows the tracing status and the snapshots taken
+    """
+
+    @trace.command(name='start')
+    async def trace_start(self, ctx, frames: int = 1):
+        """Starts tracing allocations, recording the given number of stack frames for each. This slows the bot down."""
+        if tracemalloc.is_tracing():
+            await ctx.send('Allocations are already being traced.')
+            return
+        tracemalloc.start(max(1, min(frames, 25)))
+        await ctx.send(f'Started tracing allocations. Take a snapshot with `{ctx.prefix}tracemalloc snapshot <name>`.')
+
+    trace_start.example_usage = """
+    `{prefix}tracemalloc start` - starts tracing allocations by file and line
+    `{prefix}tracemalloc start 10` - also records the 10 innermost frames of each allocation's stack
+    """
+
+    @trace.command(name='stop')
+    async def trace_stop(self, ctx):
+        """Stops tracing allocations. The snapshots taken so far can still be compared."""
+        tracemalloc.stop()
+        await ctx.send('Stopped tracing allocations.')
+
+    trace_stop.example_usage = """
+    `{prefix}tracemalloc stop` - stops tracing allocations
+    """
+
+    @trace.command(name='snapshot')
+    async def trace_snapshot(self, ctx, name, save: bool = False):
+        """Takes a named snapshot of the traced allocations, optionally also writing it to disk."""
+        if not tracemalloc.is_tracing():
+            await ctx.send(f'Allocations aren\'t being traced. Start with `{ctx.prefix}tracemalloc start`.')
+            return
+        if not re.fullmatch(r'[\w.-]+', name):
+            raise BadArgument('snapshot names can only contain letters, numbers, dots, dashes and underscores')
+        async with ctx.typing():
+            await self.bot.snapshots.take(name, save=save)
+        await ctx.send(f'Took snapshot `{name}` ({format_size(tracemalloc.get_traced_memory()[0])} traced).')
+
+    trace_snapshot.example_usage = """
+    `{prefix}tracemalloc snapshot before` - takes a snapshot named "before"
+    `{prefix}tracemalloc snapshot before yes` - also writes it to disk, to compare against after a restart
+    """
+
+    @trace.command(name='diff')
+    async def trace_diff(self, ctx, old, new, count: int = 30):
+        """Shows the lines whose allocations grew the most between two snapshots."""
+        count = max(1, min(count, 100))
+        async with ctx.typing():
+            try:
+                diffs = await self.bot.snapshots.diff(old, new)
+            except KeyError as err:
+                raise BadArgument(f'there is no snapshot named {err.args[0]}') from err
+        total = sum(diff.size_diff for diff in diffs)
+        grown = sorted((diff for diff in diffs if diff.size_diff > 0), key=lambda diff: diff.size_diff, reverse=True)[:count]
+        if not grown:
+            await ctx.send(f'No allocations grew between `{old}` and `{new}` ({format_size(total, sign=True)} overall).')
+            return
+        pages = []
+        for page in chunk(grown, 10):
+            e = discord.Embed(title=f'Allocation growth from {old} to {new}', color=discord.Color.blue())
+            e.description = f'{format_size(total, sign=True)} overall'
+            for diff in page:
+                frame = diff.traceback[0]
+                e.add_field(name=f'{short_path(frame.filename)}:{frame.lineno}'[-256:],
+                            value=f'{format_size(diff.size_diff, sign=True)} (now {format_size(diff.size)}), '
+                                  f'{diff.count_diff:+d} blocks', inline=False)
+            pages.append(e)
+        for number, page in enumerate(pages, 1):
+            page.set_footer(text=f'Page {number} of {len(pages)}')
+        await paginate(ctx, pages)
+
+    trace_diff.example_usage = """
+    `{prefix}tracemalloc diff before after` - shows the 30 lines whose allocations grew the most from "before" to "after"
+    `{prefix}tracemalloc diff auto-20190101-120000 auto-20190102-120000 10` - compares two automatic snapshots
+    """
+
+
+def format_size(size, sign=False):
+    """Formats a number of bytes in KiB or MiB."""
+    if abs(size) >= 2 ** 20:
+        return f"{size / 2 ** 20:{'+' if sign else ''}.1f} MiB"
+    return f"{size / 2 ** 10:{'+' if sign else ''}.1f} KiB"
+
+
+def short_path(filename):
+    """Shortens a source file's path to be relative to the import path entry it is under."""
+    for entry in sorted((entry for entry in sys.path if entry), key=len, reverse=True):
+        if filename.startswith(entry + os.sep):
+            return filename[len(entry) + 1:]
+    return filename
+
 
 def load_function(code, globals_, locals_):
     """Loads the user-evaluted code as a function so it can be executed."""
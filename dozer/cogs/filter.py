@@ -18,66 +18,92 @@ class Filter(Cog):
     """
     filter_dict = {}
 
+    def __init__(self, bot):
+        super().__init__(bot)
+        bot.message_pipeline.add_stage('filter', 10, self.filter_stage, settings=[(WordFilterRoleWhitelist, 'guild_id', True)])
+
+    def __unload(self):
+        self.bot.message_pipeline.remove_stage('filter')
+
     """Helper Functions"""
 
     async def check_dm_filter(self, ctx, embed):
         """Send an embed, if the setting in the DB allows for it"""
-        with db.Session() as session:
-            results = session.query(WordFilterSetting).filter_by(guild_id=ctx.guild.id, setting_type="dm") \
-                .one_or_none()
+        results = await db.settings_cache.get(WordFilterSetting, guild_id=ctx.guild.id, setting_type="dm")
 
-            if results is None:
-                results = True
-            else:
-                results = results.value
+        if results is None:
+            results = True
+        else:
+            results = results.value
 
-            if results == "1":
-                await ctx.author.send(embed=embed)
-                await ctx.message.add_reaction("📬")
-            else:
-                await ctx.send(embed=embed)
+        if results == "1":
+            await ctx.author.send(embed=embed)
+            await ctx.message.add_reaction("📬")
+        else:
+            await ctx.send(embed=embed)
 
-    def load_filters(self, guild_id):
+    async def load_filters(self, guild_id):
         """Load all filters for a selected guild """
-        with db.Session() as session:
-            results = session.query(WordFilter).filter_by(guild_id=guild_id, enabled=True).all()
+        async with db.AsyncSession() as session:
+            results = await session.query(WordFilter).filter_by(guild_id=guild_id, enabled=True).all()
             self.filter_dict[guild_id] = {}
             for wordfilter in results:
                 self.filter_dict[guild_id][wordfilter.id] = re.compile(wordfilter.pattern, re.IGNORECASE)
 
+    async def warm_up(self, guilds):
+        """Compiles the filters of every guild and loads their settings into the settings cache, one query per table."""
+        guild_ids = [guild.id for guild in guilds]
+        async with db.AsyncSession() as session:
+            results = await session.query(WordFilter).filter_by(enabled=True).all()
+        loaded = {guild_id: {} for guild_id in guild_ids}
+        for wordfilter in results:
+            if wordfilter.guild_id in loaded:
+                loaded[wordfilter.guild_id][wordfilter.id] = re.compile(wordfilter.pattern, re.IGNORECASE)
+        for guild_id, filters in loaded.items():
+            self.filter_dict.setdefault(guild_id, filters)  # guilds already loaded are kept up to date by load_filters
+        await db.settings_cache.warm(WordFilterSetting, 'guild_id', guild_ids, setting_type="dm")
+        await db.settings_cache.warm(WordFilterRoleWhitelist, 'guild_id', guild_ids, many=True)
+
     async def check_filters(self, message):
         """Check all the filters for a certain message (with it's guild)"""
+        if message.guild is None:
+            return False
+        whitelist = await db.settings_cache.get_all(WordFilterRoleWhitelist, guild_id=message.guild.id)
+        return await self.apply_filters(message, {role.id for role in message.author.roles}, whitelist)
+
+    async def apply_filters(self, message, role_ids, whitelist):
+        """Runs the guild's filters over a message, unless its author has one of the whitelisted roles.
+        Returns whether the message was deleted."""
         if message.author.id == self.bot.user.id:
-            return
-        with db.Session() as session:
-            roles = session.query(WordFilterRoleWhitelist).filter_by(guild_id=message.guild.id).all()
-        whitelisted_ids = set(role.role_id for role in roles)
-        if any(x.id in whitelisted_ids for x in message.author.roles):
-            return
+            return False
+        if any(role.role_id in role_ids for role in whitelist):
+            return False
         try:
             filters = self.filter_dict[message.guild.id]
         except KeyError:
-            self.load_filters(message.guild.id)
+            await self.load_filters(message.guild.id)
             filters = self.filter_dict[message.guild.id]
         deleted = False
         for wordid, wordfilter in filters.items():
             if wordfilter.search(message.content) is not None:
                 await message.channel.send("{}, Banned word detected!".format(message.author.mention), delete_after=5.0)
                 time = datetime.datetime.utcnow()
-                with db.Session() as session:
-                    infraction = WordFilterInfraction(member_id=message.author.id, filter_id=wordid,
-                                                      timestamp=time,
-                                                      message=message.content)
-                    session.add(infraction)
+                infraction = WordFilterInfraction(member_id=message.author.id, filter_id=wordid,
+                                                  timestamp=time,
+                                                  message=message.content)
+                db.write_queue.add(infraction)
                 if not deleted:
                     await message.delete()
                     deleted = True
+        return deleted
 
     """Event Handlers"""
 
-    async def on_message(self, message):
-        """Send the message handler out"""
-        await self.check_filters(message)
+    async def filter_stage(self, envelope):
+        """Message pipeline stage; deleted messages aren't processed any further"""
+        if envelope.guild is None:
+            return False
+        return await self.apply_filters(envelope.message, envelope.role_ids, envelope.settings[WordFilterRoleWhitelist])
 
     async def on_message_edit(self, _, after):
         """Send the message handler out, but for edits"""
@@ -89,8 +115,8 @@ class Filter(Cog):
     @guild_only()
     async def filter(self, ctx, advanced: bool = False):
         """List and manage filtered words"""
-        with db.Session() as session:
-            results = session.query(WordFilter).filter_by(guild_id=ctx.guild.id, enabled=True).all()
+        async with db.AsyncSession() as session:
+            results = await session.query(WordFilter).filter_by(guild_id=ctx.guild.id, enabled=True).all()
         if not results:
             embed = discord.Embed(title="Filters for {}".format(ctx.guild.name))
             embed.description = "No filters found for this guild! Add one using `{}whitelist add filter <>`".format(
@@ -129,14 +155,14 @@ class Filter(Cog):
             await ctx.send("Invalid RegEx! ```{}```".format(err.msg))
             return
         new_filter = WordFilter(guild_id=ctx.guild.id, pattern=pattern, friendly_name=friendly_name or pattern)
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             session.add(new_filter)
         embed = discord.Embed()
         embed.title = "Filter {} added".format(new_filter.id)
         embed.description = "A new filter with the name `{}` was added.".format(friendly_name or pattern)
         embed.add_field(name="Pattern", value="`{}`".format(pattern))
         await ctx.send(embed=embed)
-        self.load_filters(ctx.guild.id)
+        await self.load_filters(ctx.guild.id)
 
     add.example_usage = "`{prefix}filter add Swear` - Makes it so that \"Swear\" will be filtered"
 
@@ -150,8 +176,8 @@ class Filter(Cog):
         except re.error as err:
             await ctx.send("Invalid RegEx! ```{}```".format(err.msg))
             return
-        with db.Session() as session:
-            result = session.query(WordFilter).filter_by(id=filter_id, guild_id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            result = await session.query(WordFilter).filter_by(id=filter_id, guild_id=ctx.guild.id).one_or_none()
             old_pattern = result.pattern
             if result is None:
                 await ctx.send("That filter ID does not exist or does not belong to this guild.")
@@ -160,7 +186,7 @@ class Filter(Cog):
                 result.enabled = True
                 enabled_change = True
             result.pattern = pattern
-        self.load_filters(ctx.guild.id)
+        await self.load_filters(ctx.guild.id)
         embed = discord.Embed(title="Updated filter {}".format(result.friendly_name or result.pattern))
         embed.description = "Filter ID {} has been updated.".format(result.id)
         embed.add_field(name="Old Pattern", value=old_pattern)
@@ -178,8 +204,8 @@ class Filter(Cog):
     @filter.command()
     async def remove(self, ctx, filter_id):
         """Remove a pattern from the filter list."""
-        with db.Session() as session:
-            result = session.query(WordFilter).filter_by(id=filter_id).one_or_none()
+        async with db.AsyncSession() as session:
+            result = await session.query(WordFilter).filter_by(id=filter_id).one_or_none()
             if result is None:
                 await ctx.send("Filter ID {} not found!".format(filter_id))
                 return
@@ -188,7 +214,7 @@ class Filter(Cog):
                 return
             result.enabled = False
         await ctx.send("Filter `{}` with name `{}` deleted.".format(result.id, result.friendly_name))
-        self.load_filters(ctx.guild.id)
+        await self.load_filters(ctx.guild.id)
 
     remove.example_usage = "`{prefix}filter remove 7` - Disables filter with ID 7"
 
@@ -197,8 +223,8 @@ class Filter(Cog):
     @filter.command(name="dm")
     async def dm_config(self, ctx, config: bool):
         """Set whether filter words should be DMed when used in bot messages"""
-        with db.Session() as session:
-            result = session.query(WordFilterSetting).filter_by(guild_id=ctx.guild.id, setting_type="dm") \
+        async with db.AsyncSession() as session:
+            result = await session.query(WordFilterSetting).filter_by(guild_id=ctx.guild.id, setting_type="dm") \
                 .one_or_none()
             try:
                 before_setting = result.value
@@ -207,9 +233,10 @@ class Filter(Cog):
                 before_setting = None
                 result = WordFilterSetting(guild_id=ctx.guild.id, setting_type="dm", value=config)
                 session.add(result)
-            await ctx.send(
-                "The DM setting for this guild has been changed from {} to {}.".format(before_setting == "1",
-                                                                                       result.value))
+        db.settings_cache.invalidate(WordFilterSetting, guild_id=ctx.guild.id, setting_type="dm")
+        await ctx.send(
+            "The DM setting for this guild has been changed from {} to {}.".format(before_setting == "1",
+                                                                                   result.value))
 
     dm_config.example_usage = "`{prefix}filter dm_config True` - Makes all messages containining filter lists to be sent through DMs"
 
@@ -217,8 +244,8 @@ class Filter(Cog):
     @filter.group(invoke_without_command=True)
     async def whitelist(self, ctx):
         """List all whitelisted roles for this server"""
-        with db.Session() as session:
-            results = session.query(WordFilterRoleWhitelist).filter_by(guild_id=ctx.guild.id).all()
+        async with db.AsyncSession() as session:
+            results = await session.query(WordFilterRoleWhitelist).filter_by(guild_id=ctx.guild.id).all()
             role_objects = (ctx.guild.get_role(db_role.role_id) for db_role in results)
             role_names = (role.name for role in role_objects if role is not None)
             roles_text = "\n".join(role_names)
@@ -235,13 +262,14 @@ class Filter(Cog):
     @whitelist.command(name="add")
     async def whitelist_add(self, ctx, *, role: discord.Role):
         """Add a role to the whitelist"""
-        with db.Session() as session:
-            result = session.query(WordFilterRoleWhitelist).filter_by(role_id=role.id).one_or_none()
+        async with db.AsyncSession() as session:
+            result = await session.query(WordFilterRoleWhitelist).filter_by(role_id=role.id).one_or_none()
             if result is not None:
                 await ctx.send("That role is already whitelisted.")
                 return
             whitelist_entry = WordFilterRoleWhitelist(guild_id=ctx.guild.id, role_id=role.id)
             session.add(whitelist_entry)
+        db.settings_cache.invalidate(WordFilterRoleWhitelist, guild_id=ctx.guild.id)
         await ctx.send("Whitelisted `{}` for this guild.".format(role.name))
 
     whitelist_add.example_usage = "`{prefix}filter whitelist add Moderators` - Makes it so that Moderators will not be caught by the filter."
@@ -251,12 +279,13 @@ class Filter(Cog):
     @whitelist.command(name="remove")
     async def whitelist_remove(self, ctx, *, role: discord.Role):
         """Remove a role from the whitelist"""
-        with db.Session() as session:
-            result = session.query(WordFilterRoleWhitelist).filter_by(role_id=role.id).one_or_none()
+        async with db.AsyncSession() as session:
+            result = await session.query(WordFilterRoleWhitelist).filter_by(role_id=role.id).one_or_none()
             if result is None:
                 await ctx.send("That role is not whitelisted.")
                 return
-            session.delete(result)
+            await session.delete(result)
+        db.settings_cache.invalidate(WordFilterRoleWhitelist, guild_id=ctx.guild.id)
         await ctx.send("The role `{}` is no longer whitelisted.".format(role.name))
 
     whitelist_remove.example_usage = "`{prefix}filter whitelist remove Admins` - Makes it so that Admins are caught by the filter again."
@@ -275,7 +304,7 @@ class WordFilter(db.DatabaseObject):
     __tablename__ = "word_filters"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     enabled = db.Column(db.Boolean, default=True)
-    guild_id = db.Column(db.BigInteger)
+    guild_id = db.Column(db.BigInteger, index=True)
     friendly_name = db.Column(db.String, nullable=True)
     pattern = db.Column(db.String)
     infractions = db.relationship("WordFilterInfraction", back_populates="filter")
@@ -293,7 +322,7 @@ class WordFilterSetting(db.DatabaseObject):
 class WordFilterRoleWhitelist(db.DatabaseObject):
     """Object for each whitelisted role (guild-specific)"""
     __tablename__ = "word_filter_role_whitelist"
-    guild_id = db.Column(db.Integer)
+    guild_id = db.Column(db.BigInteger)
     role_id = db.Column(db.BigInteger, primary_key=True)
 
 
@@ -301,8 +330,14 @@ class WordFilterInfraction(db.DatabaseObject):
     """Object for each word filter infraction"""
     __tablename__ = "word_filter_infraction"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    member_id = db.Column(db.BigInteger)
+    member_id = db.Column(db.BigInteger, index=True)
     filter_id = db.Column(db.Integer, db.ForeignKey('word_filters.id'))
     filter = db.relationship("WordFilter", back_populates="infractions")
     timestamp = db.Column(db.DateTime)
     message = db.Column(db.String)
+
+
+@db.retention_policy(WordFilterInfraction)
+def expired_infractions(cutoff):
+    """Infractions older than the cutoff"""
+    return WordFilterInfraction.timestamp < cutoff
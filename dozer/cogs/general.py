@@ -18,6 +18,10 @@ class General(Cog):
         """Queries the name of the bot on connection to Discord"""
         self.name = (await self.bot.application_info()).name
 
+    async def warm_up(self, guilds):
+        """Loads the welcome channel of every guild into the settings cache."""
+        await db.settings_cache.warm(WelcomeChannel, 'id', [guild.id for guild in guilds])
+
     @command()
     async def ping(self, ctx):
         """Check the bot is online, and calculate its response time."""
@@ -183,26 +187,25 @@ class General(Cog):
         """
         Generates a set number of single use invites.
         """
-        with db.Session() as session:
-            settings = session.query(WelcomeChannel).filter_by(id=ctx.guild.id).one_or_none()
-            if settings is None:
+        settings = await db.settings_cache.get(WelcomeChannel, id=ctx.guild.id)
+        if settings is None:
+            await ctx.send(
+                "There is no welcome channel set. Please set one using `{0}welcomeconifg channel` and try again.".format(
+                    ctx.prefix))
+            return
+        else:
+            invitechannel = ctx.bot.get_channel(settings.channel_id)
+            if invitechannel is None:
                 await ctx.send(
-                    "There is no welcome channel set. Please set one using `{0}welcomeconifg channel` and try again.".format(
+                    "There was an issue getting your welcome channel. Please set it again using `{0} welcomeconfig channel`.".format(
                         ctx.prefix))
                 return
-            else:
-                invitechannel = ctx.bot.get_channel(settings.channel_id)
-                if invitechannel is None:
-                    await ctx.send(
-                        "There was an issue getting your welcome channel. Please set it again using `{0} welcomeconfig channel`.".format(
-                            ctx.prefix))
-                    return
-                text = ""
-                for i in range(int(num)):
-                    invite = await invitechannel.create_invite(max_age=hours * 3600, max_uses=1, unique=True,
-                                                               reason="Autogenerated by {}".format(ctx.author))
-                    text += "Invite {0}: <{1}>\n".format(i + 1, invite.url)
-                await ctx.send(text)
+            text = ""
+            for i in range(int(num)):
+                invite = await invitechannel.create_invite(max_age=hours * 3600, max_uses=1, unique=True,
+                                                           reason="Autogenerated by {}".format(ctx.author))
+                text += "Invite {0}: <{1}>\n".format(i + 1, invite.url)
+            await ctx.send(text)
 
     invites.example_usage = """
     `{prefix}invtes 5` - Generates 5 single use invites.
@@ -218,13 +221,14 @@ class General(Cog):
         if welcome_channel.guild != ctx.guild:
             await ctx.send("That channel is not in this guild.")
             return
-        with db.Session() as Session:
-            settings = Session.query(WelcomeChannel).filter_by(id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            settings = await session.query(WelcomeChannel).filter_by(id=ctx.guild.id).one_or_none()
             if settings is None:
                 settings = WelcomeChannel(id=ctx.guild.id, channel_id=welcome_channel.id)
-                Session.add(settings)
+                session.add(settings)
             else:
                 settings.member_role = welcome_channel.id
+        db.settings_cache.invalidate(WelcomeChannel, id=ctx.guild.id)
         await ctx.send("Welcome channel set to {}".format(welcome_channel.mention))
 
     welcomeconfig.example_usage = """
@@ -14,6 +14,12 @@ FTC_DISCORD_ID = 225450307654647808
 VERIFY_CHANNEL_ID = 333612583409942530
 JOINED_LOGS_ID = 350482751335432202
 class Hacks(Cog):
+    def __init__(self, bot):
+        super().__init__(bot)
+        bot.message_pipeline.add_stage('hacks', 50, self.hacks_stage)
+
+    def __unload(self):
+        self.bot.message_pipeline.remove_stage('hacks')
 
     async def on_member_join(self, member):
         if member.guild.id == FTC_DISCORD_ID:
@@ -26,7 +32,8 @@ class Hacks(Cog):
         await logs.send(res)
 
                 
-    async def on_message(self, message):
+    async def hacks_stage(self, envelope):
+        message = envelope.message
         member = message.author
         if message.channel.id == VERIFY_CHANNEL_ID and message.content.lower().startswith("i have read the rules and regulations"):
             await member.add_roles(discord.utils.get(message.guild.roles, name="Member"))
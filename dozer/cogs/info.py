@@ -13,6 +13,7 @@ from .. import db
 blurple = discord.Color.blurple()
 datetime_format = '%Y-%m-%d %I:%M %p'
 startup_time = time.time()
+SPARK_BARS = "\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
 
 try:
     with open("/etc/os-release") as f:
@@ -27,6 +28,23 @@ class Info(Cog):
     def __init__(self, bot):
         super().__init__(bot)
         self.afk_map = {}
+        bot.message_pipeline.add_stage('afk', 40, self.afk_stage)
+        bot.ipc.handler('stats', self.shard_stats)
+        bot.ipc.subscribe('afk', self.sync_afk)
+
+    def __unload(self):
+        self.bot.message_pipeline.remove_stage('afk')
+        self.bot.ipc.remove_handler('stats')
+        self.bot.ipc.unsubscribe('afk', self.sync_afk)
+
+    def export_state(self):
+        """Returns everyone's AFK reason, to hand over to the new process when restarting."""
+        return {user_id: status.reason for user_id, status in self.afk_map.items()}
+
+    async def import_state(self, state):
+        """Restores the AFK reasons handed over by the previous process."""
+        for user_id, reason in state.items():
+            self.afk_map.setdefault(user_id, AFKStatus(user_id=user_id, reason=reason))
 
     @guild_only()
     @cooldown(1, 10, BucketType.channel)
@@ -98,19 +116,42 @@ class Info(Cog):
     async def stats(self, ctx):
         """Get current running internal/hosts stats for the bot"""
         info = await ctx.bot.application_info()
+        shards = [shard for shard in await ctx.bot.ipc.query('stats') if shard is not None]
+        monitor = ctx.bot.loop_monitor
+        history = monitor.history()
+        average_lag, max_lag = monitor.summary()
+        skipped = ctx.bot.event_filter.skipped if ctx.bot.event_filter is not None else None
 
         #e = discord.Embed(title=info.name + " Stats", color=discord.Color.blue())
         frame = "\n".join(map(lambda x: f"{str(x[0]):<24}{str(x[1])}", { #e.add_field(name=x[0], value=x[1], inline=False), {
             "{:=^48}".format(f" Stats for {info.name} "): "",
             "Bot owner:": info.owner,
-            "Users:": len(ctx.bot.users),
-            "Channels:": len(list(ctx.bot.get_all_channels())),
-            "Servers:": len(ctx.bot.guilds),
+            "Users:": sum(shard['users'] for shard in shards),
+            "Channels:": sum(shard['channels'] for shard in shards),
+            "Servers:": sum(shard['guilds'] for shard in shards),
+            "Shards responding:": f"{len(shards)}/{ctx.bot.shard_count or 1}",
             "":"",
             f"{' Host stats ':=^48}": "",
+            "Shard:": "not sharded" if ctx.bot.shard_id is None else ctx.bot.shard_id,
             "Operating system:": os_name,
             "Process memory usage:": f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}K",
-            "Process uptime": str(datetime.timedelta(seconds=round(time.time() - startup_time)))
+            "Process uptime": str(datetime.timedelta(seconds=round(time.time() - startup_time))),
+            " ": "",
+            f"{' Event loop ':=^48}": "",
+            "Current lag:": f"{monitor.last_lag * 1000:.1f} ms",
+            f"Average lag ({len(history)}m):": f"{average_lag * 1000:.1f} ms",
+            f"Max lag ({len(history)}m):": f"{max_lag * 1000:.1f} ms",
+            "Stalls:": monitor.stalls,
+            "Max lag per minute:": lag_sparkline(history[-24:]),
+            "  ": "",
+            f"{' Rate limiting ':=^48}": "",
+            "Commands checked:": ctx.bot.rate_limiter.checked,
+            "Commands throttled:": ctx.bot.rate_limiter.throttled,
+            "Tracked buckets:": len(ctx.bot.rate_limiter),
+            "   ": "",
+            f"{' Gateway events ':=^48}": "",
+            "Skipped (this shard):": "not filtered" if skipped is None else sum(skipped.values()),
+            "Most skipped:": ", ".join(f"{event} ({count})" for event, count in skipped.most_common(2)) if skipped else "none"
         }.items()))
         await ctx.send(f"```\n{frame}\n```")#embed=e)
 
@@ -131,32 +172,59 @@ class Info(Cog):
         else:
             afk_status = AFKStatus(user_id=ctx.author.id, reason=reason)
             self.afk_map[ctx.author.id] = afk_status
+        await self.bot.ipc.publish('afk', user_id=ctx.author.id, reason=reason)
 
         await ctx.send(embed=discord.Embed(description=f"**{ctx.author.name}** is AFK: **{reason}**"))
     afk.example_usage = """
     `{prefix}afk robot building` - set yourself to AFK for reason "reason"
     """
 
-    async def on_message(self, message):
-        """Primarily handles AFK"""
-        ctx = await self.bot.get_context(message)
-        if message.content.strip().startswith(f"{ctx.prefix}afk"):
-            return
+    async def afk_stage(self, envelope):
+        """Message pipeline stage that handles AFK"""
+        if envelope.prefix is not None and envelope.content.strip().startswith(f"{envelope.prefix}afk"):
+            return False
 
-        for member in message.mentions:
-            if member.id in self.afk_map:
-                await ctx.send(embed=discord.Embed(description=f"**{member.name}** is AFK: **{self.afk_map[member.id].reason}**"))
+        afk_mentions = [member for member in envelope.message.mentions if member.id in self.afk_map]
+        afk_status = self.afk_map.get(envelope.author.id)
+        if not afk_mentions and afk_status is None:
+            return False
+
+        ctx = await self.bot.get_context(envelope.message)
+        for member in afk_mentions:
+            await ctx.send(embed=discord.Embed(description=f"**{member.name}** is AFK: **{self.afk_map[member.id].reason}**"))
 
-        afk_status = self.afk_map.get(ctx.author.id)
         if afk_status is not None:
             await ctx.send(f"**{ctx.author.name}** is no longer AFK!")
             del self.afk_map[ctx.author.id]
+            await self.bot.ipc.publish('afk', user_id=ctx.author.id, reason=None)
+        return False
+
+    async def shard_stats(self):
+        """IPC query handler returning this shard's counts for the stats command"""
+        return {'users': len(self.bot.users), 'channels': sum(1 for _ in self.bot.get_all_channels()), 'guilds': len(self.bot.guilds)}
+
+    async def sync_afk(self, user_id, reason):
+        """IPC event handler applying an AFK change made on another shard, since a user's AFK status is shared by every guild"""
+        if reason is None:
+            self.afk_map.pop(user_id, None)
+        elif user_id in self.afk_map:
+            self.afk_map[user_id].reason = reason
+        else:
+            self.afk_map[user_id] = AFKStatus(user_id=user_id, reason=reason)
+
+
+def lag_sparkline(history):
+    """Draws the max lag of each minute in a loop monitor history as a bar chart, scaled to the highest minute"""
+    if not history:
+        return "no data yet"
+    highest = max(maximum for _, _, maximum in history) or 1
+    return "".join(SPARK_BARS[min(len(SPARK_BARS) - 1, int(maximum / highest * len(SPARK_BARS)))] for _, _, maximum in history)
 
 
 class AFKStatus(db.DatabaseObject):
     """Holds AFK data."""
     __tablename__ = "afk_status"
-    user_id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.BigInteger, primary_key=True)
     reason = db.Column(db.String)
 
 
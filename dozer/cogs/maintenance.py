@@ -1,19 +1,40 @@
 """Maintenance commands for bot developers"""
 
+import asyncio
+import datetime
 import os
 import sys
+import time
 
+import discord
 from discord.ext.commands import NotOwner
 
 from dozer.bot import dozer_logger
 from ._utils import *
+from .. import db
 
 
 class Maintenance(Cog):
     """
     Commands for performing maintenance on the bot.
     These commands are restricted to bot developers.
+    Also runs the database retention and backup jobs in the background.
     """
+    def __init__(self, bot):
+        super().__init__(bot)
+        self.retention_task = None
+        self.backup_task = None
+        if bot.shard_id:
+            return  # the shards share the database, so only the first one runs the jobs
+        self.retention_task = bot.loop.create_task(self.run_periodically(self.run_retention, 'db_retention'))
+        if db.engine.dialect.name == 'sqlite':  # other databases have their own backup tooling
+            self.backup_task = bot.loop.create_task(self.run_periodically(self.run_backup, 'db_backup'))
+
+    def __unload(self):
+        if self.retention_task is not None:
+            self.retention_task.cancel()
+        if self.backup_task is not None:
+            self.backup_task.cancel()
 
     def __local_check(self, ctx):  # All of this cog is only available to devs
         if ctx.author.id not in ctx.bot.config['developers']:
@@ -38,7 +59,7 @@ class Maintenance(Cog):
     async def restart(self, ctx):
         """Restarts the bot."""
         await ctx.send('Restarting')
-        await self.bot.shutdown(restart=True)
+        await self.bot.restart()
 
     restart.example_usage = """
     `{prefix}restart` - restart the bot
@@ -62,6 +83,94 @@ class Maintenance(Cog):
     `{prefix}update` - update to the latest commit and restart
     """
 
+    @command()
+    async def prunedb(self, ctx):
+        """
+        Runs the database retention job now.
+        Deletes rows older than the retention policies in the config, then compacts the database if enabled.
+        """
+        msg = await ctx.send('Pruning the database...')
+        reclaimed, freed, elapsed = await self.run_retention()
+        e = discord.Embed(title='Database retention', color=discord.Color.blue())
+        for table, count in reclaimed.items():
+            e.add_field(name=table, value=f'{count} rows deleted')
+        footer = f'Took {elapsed:.1f}s'
+        if freed is not None:
+            footer += f', {freed / 1024:.1f} KiB freed by compaction'
+        e.set_footer(text=footer)
+        await msg.edit(content=None, embed=e)
+
+    prunedb.example_usage = """
+    `{prefix}prunedb` - delete expired rows and compact the database
+    """
+
+    async def run_retention(self):
+        """
+        Deletes the rows of each table in the db_retention config older than its max_age_days, in batches of batch_size,
+        then compacts the database if vacuum is enabled. Retention policies are registered when a cog is imported, so
+        the tables of cogs that haven't been loaded yet (in lazy mode) are left until a run after they are.
+        Returns the rows deleted per table, the bytes freed by compaction (or None), and how long it took.
+        """
+        config = self.bot.config['db_retention']
+        start = time.perf_counter()
+        deferred = self.bot.extension_loader.pending_tables
+        reclaimed = {}
+        for table_name, policy in config['tables'].items():
+            if policy.get('max_age_days') is None:
+                continue
+            if table_name not in db.retention_policies:
+                if table_name in deferred:
+                    dozer_logger.debug('Not pruning table %s until its extension is loaded', table_name)
+                else:
+                    dozer_logger.warning('No retention policy is registered for table %s, skipping it', table_name)
+                continue
+            table, criterion = db.retention_policies[table_name]
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=policy['max_age_days'])
+            reclaimed[table_name] = await db.prune(table, criterion(cutoff), config['batch_size'])
+        freed = await db.compact() if config['vacuum'] else None
+        elapsed = time.perf_counter() - start
+        dozer_logger.info('Database retention deleted %d rows (%s) in %.1fs', sum(reclaimed.values()),
+                          ', '.join(f'{table}: {count}' for table, count in reclaimed.items()), elapsed)
+        return reclaimed, freed, elapsed
+
+    @command()
+    async def backupdb(self, ctx):
+        """
+        Takes a compressed snapshot of the database without stopping the bot.
+        Snapshots go to the backup directory in the config, and only the newest few are kept.
+        """
+        msg = await ctx.send('Backing up the database...')
+        try:
+            path, size, elapsed = await self.run_backup()
+        except (RuntimeError, ValueError) as err:
+            await msg.edit(content=f'Backup failed: {err}')
+            return
+        await msg.edit(content=f'Database backed up to `{path}` ({size / 1024:.1f} KiB) in {elapsed:.1f}s')
+
+    backupdb.example_usage = """
+    `{prefix}backupdb` - write a snapshot of the database now
+    """
+
+    async def run_backup(self):
+        """Writes a database snapshot as set up in the db_backup config. Returns its path, size in bytes and how long it took."""
+        config = self.bot.config['db_backup']
+        start = time.perf_counter()
+        path, size = await db.backup(config['directory'], keep=config['keep'], pages=config['pages_per_step'])
+        elapsed = time.perf_counter() - start
+        dozer_logger.info('Database backed up to %s (%d bytes) in %.1fs', path, size, elapsed)
+        return path, size, elapsed
+
+    async def run_periodically(self, job, config_key):
+        """Runs a job every interval_hours from its section of the config while the bot is up."""
+        await self.bot.wait_until_ready()
+        await asyncio.sleep(600)  # stay out of the way of startup
+        while not self.bot.is_closed():
+            try:
+                await job()
+            except Exception:
+                dozer_logger.exception('Scheduled %s job failed', config_key)
+            await asyncio.sleep(self.bot.config[config_key]['interval_hours'] * 3600)
+
 
 def setup(bot):
     """Adds the maintenance cog to the bot process."""
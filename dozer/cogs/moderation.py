@@ -30,6 +30,23 @@ class SafeRoleConverter(RoleConverter):
 class Moderation(Cog):
     """A cog to handle moderation tasks."""
 
+    def __init__(self, bot):
+        super().__init__(bot)
+        bot.message_pipeline.add_stage('moderation', 20, self.moderation_stage,
+                                       settings=[(GuildMessageLinks, 'guild_id', False), (GuildNewMember, 'guild_id', False)])
+        self.punishment_tasks = set()
+
+    def __unload(self):
+        self.bot.message_pipeline.remove_stage('moderation')
+
+    def export_state(self):
+        """Stops the running punishment timers for a restart. Their records stay saved, so the new process restarts them."""
+        for task in self.punishment_tasks:
+            task.cancel()
+
+    async def import_state(self, _state):
+        """Punishment timers are restored from the database by on_ready, so there is nothing to import."""
+
     """=== Helper functions ==="""
 
     async def mod_log(self, actor: discord.Member, action: str, target: Union[discord.User, discord.Member], reason, orig_channel=None,
@@ -48,18 +65,17 @@ class Moderation(Cog):
             await target.send(embed=modlog_embed)
         except discord.Forbidden:
             await orig_channel.send("Failed to DM modlog to user")
-        with db.Session() as session:
-            modlog_channel = session.query(GuildModLog).filter_by(id=actor.guild.id).one_or_none()
+        modlog_channel = await db.settings_cache.get(GuildModLog, id=actor.guild.id)
+        if orig_channel is not None:
+            await orig_channel.send(embed=modlog_embed)
+        if modlog_channel is not None:
+            if global_modlog:
+                channel = actor.guild.get_channel(modlog_channel.modlog_channel)
+                if channel is not None and channel != orig_channel: # prevent duplicate embeds
+                    await channel.send(embed=modlog_embed)
+        else:
             if orig_channel is not None:
-                await orig_channel.send(embed=modlog_embed)
-            if modlog_channel is not None:
-                if global_modlog:
-                    channel = actor.guild.get_channel(modlog_channel.modlog_channel)
-                    if channel is not None and channel != orig_channel: # prevent duplicate embeds
-                        await channel.send(embed=modlog_embed)
-            else:
-                if orig_channel is not None:
-                    await orig_channel.send("Please configure modlog channel to enable modlog functionality")
+                await orig_channel.send("Please configure modlog channel to enable modlog functionality")
 
     async def perm_override(self, member, **overwrites):
         """Applies the given overrides to the given member in their guild."""
@@ -83,6 +99,12 @@ class Moderation(Cog):
         seconds = int(matches.get('seconds') or 0)
         return (hours * 3600) + (minutes * 60) + seconds
 
+    def start_punishment_timer(self, *args, **kwargs):
+        """Runs punishment_timer in the background, keeping track of it until it finishes."""
+        task = self.bot.loop.create_task(self.punishment_timer(*args, **kwargs))
+        self.punishment_tasks.add(task)
+        task.add_done_callback(self.punishment_tasks.discard)
+
     async def punishment_timer(self, seconds, target: discord.Member, punishment, reason, actor: discord.Member, orig_channel=None,
                                global_modlog=True):
         """Asynchronous task that sleeps for a set time to unmute/undeafen a member for a set period of time."""
@@ -90,7 +112,7 @@ class Moderation(Cog):
             return
 
         # register the timer
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             ent = PunishmentTimerRecord(
                 guild_id=target.guild.id,
                 actor_id=actor.id,
@@ -101,13 +123,13 @@ class Moderation(Cog):
                 target_ts=int(seconds + time.time())
             )
             session.add(ent)
-            session.commit() # necessary to generate an autoincrement id
+            await session.commit() # necessary to generate an autoincrement id
             ent_id = ent.id
 
         await asyncio.sleep(seconds)
 
-        with db.Session() as session:
-            user = session.query(punishment).filter_by(id=target.id).one_or_none()
+        async with db.AsyncSession() as session:
+            user = await session.query(punishment).filter_by(id=target.id).one_or_none()
             if user is not None:
                 await self.mod_log(actor,
                                    "un" + punishment.past_participle,
@@ -118,9 +140,10 @@ class Moderation(Cog):
                                    global_modlog=global_modlog)
                 self.bot.loop.create_task(coro=punishment.finished_callback(self, target))
 
-            ent = session.query(PunishmentTimerRecord).filter_by(id=ent_id).one_or_none() # necessary to refresh the entry for the current session
+            # necessary to refresh the entry for the current session
+            ent = await session.query(PunishmentTimerRecord).filter_by(id=ent_id).one_or_none()
             if ent:
-                session.delete(ent)
+                await session.delete(ent)
 
     async def _check_links_warn(self, msg, role):
         """Warns a user that they can't send links."""
@@ -131,20 +154,59 @@ class Moderation(Cog):
     async def check_links(self, msg):
         """Checks messages for the links role if necessary, then checks if the author is allowed to send links in the server"""
         if msg.guild is None or not isinstance(msg.author, discord.Member) or not msg.guild.me.guild_permissions.manage_messages:
-            return
-        with db.Session() as session:
-            config = session.query(GuildMessageLinks).filter_by(guild_id=msg.guild.id).one_or_none()
-            if config is None:
-                return
-            role = msg.guild.get_role(config.role_id)
-            if role is None:
-                return
-            if role not in msg.author.roles and re.search("https?://", msg.content):
-                await msg.delete()
-                self.bot.loop.create_task(coro=self._check_links_warn(msg, role))
-                return True
+            return False
+        config = await db.settings_cache.get(GuildMessageLinks, guild_id=msg.guild.id)
+        return await self.scrub_links(msg, config, {role.id for role in msg.author.roles})
+
+    async def scrub_links(self, msg, config, role_ids):
+        """Deletes a message with links in it if its author doesn't have the guild's links role, given the guild's config"""
+        if config is None:
+            return False
+        role = msg.guild.get_role(config.role_id)
+        if role is None:
+            return False
+        if role.id not in role_ids and re.search("https?://", msg.content):
+            await msg.delete()
+            self.bot.loop.create_task(coro=self._check_links_warn(msg, role))
+            return True
         return False
 
+    @staticmethod
+    def add_message_fields(e, name, message, embeds=True):
+        """Adds a message's content to a message log embed, split over two fields if it doesn't fit in one, or its embeds
+        if it has no content, and then its attachments."""
+        if 0 < len(message.content) <= 1024:
+            e.add_field(name=name, value=message.content)
+        elif message.content:
+            e.add_field(name=name, value=message.content[:1024])
+            e.add_field(name=name + " continued", value=message.content[1024:2048])
+        elif embeds:
+            for i in message.embeds:
+                e.add_field(name="Title", value=i.title)
+                e.add_field(name="Description", value=i.description)
+                e.add_field(name="Timestamp", value=i.timestamp)
+                for x in i.fields:
+                    e.add_field(name=x.name, value=x.value)
+                e.add_field(name="Footer", value=i.footer)
+        if message.attachments:
+            e.add_field(name="Attachments", value=", ".join([i.url for i in message.attachments]))
+
+    def edit_log_embed(self, after, before=None):
+        """Builds the message log entry for an edit; before is the message before the edit, or None if it wasn't cached."""
+        e = discord.Embed(type='rich')
+        e.title = 'Message Edited'
+        e.color = 0xFFC400
+        e.timestamp = after.edited_at
+        e.add_field(name='Author', value=after.author)
+        e.add_field(name='Author pingable', value=after.author.mention)
+        e.add_field(name='Channel', value=after.channel)
+        if before is None:
+            e.add_field(name="Old message", value='Unknown, the message was no longer cached')
+        else:
+            self.add_message_fields(e, "Old message", before, embeds=before.edited_at is not None)
+        self.add_message_fields(e, "New message", after, embeds=after.edited_at is not None)
+        return e
+
     """=== context-free backend functions ==="""
 
     async def _mute(self, member: discord.Member, reason: str = "No reason provided", seconds=0, actor=None, orig_channel=None):
@@ -155,24 +217,23 @@ class Moderation(Cog):
         actor: the acting user who requested the mute
         orig_channel: the channel of the request origin
         """
-        with db.Session() as session:
-            if session.query(Mute).filter_by(id=member.id, guild=member.guild.id).one_or_none() is not None:
+        async with db.AsyncSession() as session:
+            if await session.query(Mute).filter_by(id=member.id, guild=member.guild.id).one_or_none() is not None:
                 return False # member already muted
             else:
                 user = Mute(id=member.id, guild=member.guild.id)
                 session.add(user)
                 await self.perm_override(member, send_messages=False, add_reactions=False)
 
-                self.bot.loop.create_task(
-                    self.punishment_timer(seconds, member, Mute, reason, actor or member.guild.me, orig_channel=orig_channel))
+                self.start_punishment_timer(seconds, member, Mute, reason, actor or member.guild.me, orig_channel=orig_channel)
                 return True
 
     async def _unmute(self, member: discord.Member):
         """Unmutes a user."""
-        with db.Session() as session:
-            user = session.query(Mute).filter_by(id=member.id, guild=member.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            user = await session.query(Mute).filter_by(id=member.id, guild=member.guild.id).one_or_none()
             if user is not None:
-                session.delete(user)
+                await session.delete(user)
                 await self.perm_override(member, send_messages=None, add_reactions=None)
                 return True
             else:
@@ -188,8 +249,8 @@ class Moderation(Cog):
         actor: the acting user who requested the mute
         orig_channel: the channel of the request origin
         """
-        with db.Session() as session:
-            if session.query(Deafen).filter_by(id=member.id, guild=member.guild.id).one_or_none() is not None:
+        async with db.AsyncSession() as session:
+            if await session.query(Deafen).filter_by(id=member.id, guild=member.guild.id).one_or_none() is not None:
                 return False
             else:
                 user = Deafen(id=member.id, guild=member.guild.id, self_inflicted=self_inflicted)
@@ -198,44 +259,63 @@ class Moderation(Cog):
 
                 if self_inflicted and seconds == 0:
                     seconds = 30 # prevent lockout in case of bad argument
-                self.bot.loop.create_task(
-                    self.punishment_timer(seconds, member,
-                                          punishment=Deafen,
-                                          reason=reason,
-                                          actor=actor or member.guild.me,
-                                          orig_channel=orig_channel,
-                                          global_modlog=not self_inflicted))
+                self.start_punishment_timer(seconds, member,
+                                            punishment=Deafen,
+                                            reason=reason,
+                                            actor=actor or member.guild.me,
+                                            orig_channel=orig_channel,
+                                            global_modlog=not self_inflicted)
                 return True
 
     async def _undeafen(self, member: discord.Member):
         """Undeafens a user."""
-        with db.Session() as session:
-            user = session.query(Deafen).filter_by(id=member.id, guild=member.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            user = await session.query(Deafen).filter_by(id=member.id, guild=member.guild.id).one_or_none()
             if user is not None:
                 await self.perm_override(member=member, read_messages=None)
-                session.delete(user)
+                await session.delete(user)
                 return True
             else:
                 return False
 
+    async def warm_up(self, guilds):
+        """Loads the logging and new member configuration of every guild into the settings cache."""
+        guild_ids = [guild.id for guild in guilds]
+        for table in (GuildModLog, GuildMemberLog, GuildMessageLog, MemberRole):
+            await db.settings_cache.warm(table, 'id', guild_ids)
+        for table in (GuildMessageLinks, GuildNewMember):
+            await db.settings_cache.warm(table, 'guild_id', guild_ids)
+
     """=== Event handlers ==="""
 
     async def on_ready(self):
         """Restore punishment timers on bot startup"""
-        with db.Session() as session:
-            q = session.query(PunishmentTimerRecord).all()
-            for r in q:
-                guild = self.bot.get_guild(r.guild_id)
-                actor = guild.get_member(r.actor_id)
-                target = guild.get_member(r.target_id)
-                orig_channel = self.bot.get_channel(r.orig_channel_id)
-                punishment_type = r.type
-                reason = r.reason or ""
-                seconds = max(int(r.target_ts - time.time()), 0.01)
-                session.delete(r)
-                self.bot.loop.create_task(self.punishment_timer(seconds, target, PunishmentTimerRecord.type_map[punishment_type], reason, actor,
-                                                                orig_channel))
-                getLogger('dozer').info(f"Restarted {PunishmentTimerRecord.type_map[punishment_type].__name__} of {target} in {guild}")
+        for r in await self.pop_punishment_timers([guild.id for guild in self.bot.guilds]):
+            guild = self.bot.get_guild(r.guild_id)
+            actor = guild.get_member(r.actor_id)
+            target = guild.get_member(r.target_id)
+            orig_channel = self.bot.get_channel(r.orig_channel_id)
+            punishment_type = r.type
+            reason = r.reason or ""
+            seconds = max(int(r.target_ts - time.time()), 0.01)
+            self.start_punishment_timer(seconds, target, PunishmentTimerRecord.type_map[punishment_type], reason, actor, orig_channel)
+            getLogger('dozer').info(f"Restarted {PunishmentTimerRecord.type_map[punishment_type].__name__} of {target} in {guild}")
+
+    @staticmethod
+    async def pop_punishment_timers(guild_ids):
+        """
+        Returns the saved punishment timers of the given guilds and deletes them; restarted timers save themselves again.
+        Other shards' guilds are left for them to restore. A shard can hold more guilds than a query can take parameters
+        (999 on older SQLite), so the guilds are picked out here and the timers are deleted a chunk of ids at a time.
+        """
+        guild_ids = set(guild_ids)
+        async with db.AsyncSession() as session:
+            records = [record for record in await session.query(PunishmentTimerRecord).all() if record.guild_id in guild_ids]
+            for i in range(0, len(records), 500):
+                chunk = [record.id for record in records[i:i + 500]]
+                await session.query(PunishmentTimerRecord).filter(PunishmentTimerRecord.id.in_(chunk)) \
+                    .delete(synchronize_session=False)
+        return records
 
     async def on_member_join(self, member):
         """Logs that a member joined."""
@@ -243,15 +323,15 @@ class Moderation(Cog):
         join.set_author(name='Member Joined', icon_url=member.avatar_url_as(format='png', size=32))
         join.description = "{0.mention}\n{0} ({0.id})".format(member)
         join.set_footer(text="{} | {} members".format(member.guild.name, member.guild.member_count))
-        with db.Session() as session:
-            memberlogchannel = session.query(GuildMemberLog).filter_by(id=member.guild.id).one_or_none()
-            if memberlogchannel is not None:
-                channel = member.guild.get_channel(memberlogchannel.memberlog_channel)
-                await channel.send(embed=join)
-            user = session.query(Mute).filter_by(id=member.id, guild=member.guild.id).one_or_none()
+        memberlogchannel = await db.settings_cache.get(GuildMemberLog, id=member.guild.id)
+        if memberlogchannel is not None:
+            channel = member.guild.get_channel(memberlogchannel.memberlog_channel)
+            await channel.send(embed=join)
+        async with db.AsyncSession() as session:
+            user = await session.query(Mute).filter_by(id=member.id, guild=member.guild.id).one_or_none()
             if user is not None:
                 await self.perm_override(member, add_reactions=False, send_messages=False)
-            user = session.query(Deafen).filter_by(id=member.id, guild=member.guild.id).one_or_none()
+            user = await session.query(Deafen).filter_by(id=member.id, guild=member.guild.id).one_or_none()
             if user is not None:
                 await self.perm_override(member, read_messages=False)
 
@@ -261,31 +341,30 @@ class Moderation(Cog):
         leave.set_author(name='Member Left', icon_url=member.avatar_url_as(format='png', size=32))
         leave.description = "{0.mention}\n{0} ({0.id})".format(member)
         leave.set_footer(text="{} | {} members".format(member.guild.name, member.guild.member_count))
-        with db.Session() as session:
-            memberlogchannel = session.query(GuildMemberLog).filter_by(id=member.guild.id).one_or_none()
-            if memberlogchannel is not None:
-                channel = member.guild.get_channel(memberlogchannel.memberlog_channel)
-                await channel.send(embed=leave)
-
-    async def on_message(self, message):
-        """Check things when messages come in."""
-        if message.author.bot or message.guild is None or not message.guild.me.guild_permissions.manage_roles:
-            return
-
-        if await self.check_links(message):
-            return
-        with db.Session() as session:
-            config = session.query(GuildNewMember).filter_by(guild_id=message.guild.id).one_or_none()
-            if config is not None:
-                string = config.message
-                content = message.content.casefold()
-                if string not in content:
-                    return
-                channel = config.channel_id
-                role_id = config.role_id
-                if message.channel.id != channel:
-                    return
-                await message.author.add_roles(message.guild.get_role(role_id))
+        memberlogchannel = await db.settings_cache.get(GuildMemberLog, id=member.guild.id)
+        if memberlogchannel is not None:
+            channel = member.guild.get_channel(memberlogchannel.memberlog_channel)
+            await channel.send(embed=leave)
+
+    async def moderation_stage(self, envelope):
+        """Message pipeline stage that checks things when messages come in."""
+        message = envelope.message
+        if envelope.author.bot or envelope.guild is None or not isinstance(envelope.author, discord.Member):
+            return False
+        permissions = envelope.guild.me.guild_permissions
+        if not permissions.manage_roles:
+            return False
+
+        if permissions.manage_messages and await self.scrub_links(message, envelope.settings[GuildMessageLinks], envelope.role_ids):
+            return True
+        config = envelope.settings[GuildNewMember]
+        if config is not None:
+            if config.message not in envelope.folded:
+                return False
+            if message.channel.id != config.channel_id:
+                return False
+            await envelope.author.add_roles(envelope.guild.get_role(config.role_id))
+        return False
 
     async def on_message_delete(self, message):
         """When a message is deleted, log it."""
@@ -296,27 +375,12 @@ class Moderation(Cog):
         e.add_field(name='Author', value=message.author)
         e.add_field(name='Author pingable', value=message.author.mention)
         e.add_field(name='Channel', value=message.channel)
-        if 1024 > len(message.content) > 0:
-            e.add_field(name="Deleted message", value=message.content)
-        elif len(message.content) != 0:
-            e.add_field(name="Deleted message", value=message.content[0:1023])
-            e.add_field(name="Deleted message continued", value=message.content[1024:2000])
-        elif len(message.content) == 0:
-            for i in message.embeds:
-                e.add_field(name="Title", value=i.title)
-                e.add_field(name="Description", value=i.description)
-                e.add_field(name="Timestamp", value=i.timestamp)
-                for x in i.fields:
-                    e.add_field(name=x.name, value=x.value)
-                e.add_field(name="Footer", value=i.footer)
-        if message.attachments:
-            e.add_field(name="Attachments", value=", ".join([i.url for i in message.attachments]))
-        with db.Session() as session:
-            messagelogchannel = session.query(GuildMessageLog).filter_by(id=message.guild.id).one_or_none()
-            if messagelogchannel is not None:
-                channel = message.guild.get_channel(messagelogchannel.messagelog_channel)
-                if channel is not None:
-                    await channel.send(embed=e)
+        self.add_message_fields(e, "Deleted message", message)
+        messagelogchannel = await db.settings_cache.get(GuildMessageLog, id=message.guild.id)
+        if messagelogchannel is not None:
+            channel = message.guild.get_channel(messagelogchannel.messagelog_channel)
+            if channel is not None:
+                await channel.send(embed=e)
 
     async def on_message_edit(self, before, after):
         """Logs message edits."""
@@ -325,48 +389,54 @@ class Moderation(Cog):
             return
         if after.edited_at is not None or before.edited_at is not None:
             # There is a reason for this. That reason is that otherwise, an infinite spam loop occurs
-            e = discord.Embed(type='rich')
-            e.title = 'Message Edited'
-            e.color = 0xFFC400
-            e.timestamp = after.edited_at
-            e.add_field(name='Author', value=before.author)
-            e.add_field(name='Author pingable', value=before.author.mention)
-            e.add_field(name='Channel', value=before.channel)
-            if 1024 > len(before.content) > 0:
-                e.add_field(name="Old message", value=before.content)
-            elif len(before.content) != 0:
-                e.add_field(name="Old message", value=before.content[0:1023])
-                e.add_field(name="Old message continued", value=before.content[1024:2000])
-            elif len(before.content) == 0 and before.edited_at is not None:
-                for i in before.embeds:
-                    e.add_field(name="Title", value=i.title)
-                    e.add_field(name="Description", value=i.description)
-                    e.add_field(name="Timestamp", value=i.timestamp)
-                    for x in i.fields:
-                        e.add_field(name=x.name, value=x.value)
-                    e.add_field(name="Footer", value=i.footer)
-            if before.attachments:
-                e.add_field(name="Attachments", value=", ".join([i.url for i in before.attachments]))
-            if 0 < len(after.content) < 1024:
-                e.add_field(name="New message", value=after.content)
-            elif len(after.content) != 0:
-                e.add_field(name="New message", value=after.content[0:1023])
-                e.add_field(name="New message continued", value=after.content[1024:2000])
-            elif len(after.content) == 0 and after.edited_at is not None:
-                for i in after.embeds:
-                    e.add_field(name="Title", value=i.title)
-                    e.add_field(name="Description", value=i.description)
-                    e.add_field(name="Timestamp", value=i.timestamp)
-                    for x in i.fields:
-                        e.add_field(name=x.name, value=x.value)
-            if after.attachments:
-                e.add_field(name="Attachments", value=", ".join([i.url for i in before.attachments]))
-            with db.Session() as session:
-                messagelogchannel = session.query(GuildMessageLog).filter_by(id=before.guild.id).one_or_none()
-                if messagelogchannel is not None:
-                    channel = before.guild.get_channel(messagelogchannel.messagelog_channel)
-                    if channel is not None:
-                        await channel.send(embed=e)
+            e = self.edit_log_embed(after, before)
+            messagelogchannel = await db.settings_cache.get(GuildMessageLog, id=before.guild.id)
+            if messagelogchannel is not None:
+                channel = before.guild.get_channel(messagelogchannel.messagelog_channel)
+                if channel is not None:
+                    await channel.send(embed=e)
+
+    async def on_uncached_message_delete(self, payload):
+        """When a message that isn't in the message cache is deleted, log what is known about it."""
+        if payload.guild_id is None:
+            return
+        messagelogchannel = await db.settings_cache.get(GuildMessageLog, id=payload.guild_id)
+        if messagelogchannel is None:
+            return
+        channel = self.bot.get_channel(messagelogchannel.messagelog_channel)
+        if channel is None:
+            return
+        e = discord.Embed(type='rich')
+        e.title = 'Message Deletion'
+        e.color = 0xFF0000
+        e.timestamp = datetime.datetime.utcnow()
+        e.add_field(name='Channel', value=self.bot.get_channel(payload.channel_id))
+        e.add_field(name='Message ID', value=payload.message_id)
+        e.add_field(name='Deleted message', value='Unknown, the message was no longer cached')
+        await channel.send(embed=e)
+
+    async def on_uncached_message_edit(self, payload):
+        """When a message that isn't in the message cache is edited, fetch it to check its links and log the edit."""
+        data = payload.data
+        if 'content' not in data or data.get('edited_timestamp') is None or data.get('author', {}).get('bot'):
+            return  # not an edit by a user (such as embeds being added to the message)
+        message_channel = self.bot.get_channel(int(data['channel_id']))
+        if not isinstance(message_channel, discord.TextChannel):
+            return
+        messagelogchannel = await db.settings_cache.get(GuildMessageLog, id=message_channel.guild.id)
+        links_config = await db.settings_cache.get(GuildMessageLinks, guild_id=message_channel.guild.id)
+        if messagelogchannel is None and links_config is None:
+            return  # nothing to do, so don't fetch the message
+        try:
+            after = await message_channel.get_message(payload.message_id)
+        except discord.HTTPException:
+            return
+        if await self.check_links(after) or messagelogchannel is None:
+            return
+        e = self.edit_log_embed(after)
+        channel = message_channel.guild.get_channel(messagelogchannel.messagelog_channel)
+        if channel is not None:
+            await channel.send(embed=e)
 
     """=== Direct moderation commands ==="""
 
@@ -385,14 +455,10 @@ class Moderation(Cog):
     @bot_has_permissions(manage_roles=True)
     async def timeout(self, ctx, duration: float):
         """Set a timeout (no sending messages or adding reactions) on the current channel."""
-        with db.Session() as session:
-            settings = session.query(MemberRole).filter_by(id=ctx.guild.id).one_or_none()
-            if settings is None:
-                settings = MemberRole(id=ctx.guild.id)
-                session.add(settings)
+        settings = await db.settings_cache.get(MemberRole, id=ctx.guild.id)
 
         # None-safe - nonexistent or non-configured role return None
-        member_role = ctx.guild.get_role(settings.member_role)
+        member_role = ctx.guild.get_role(settings.member_role) if settings is not None else None
         if member_role is not None:
             targets = {member_role}
         else:
@@ -606,15 +672,9 @@ class Moderation(Cog):
     @has_permissions(administrator=True)
     async def modlogconfig(self, ctx, channel_mentions: discord.TextChannel):
         """Set the modlog channel for a server by passing the channel id"""
-        with db.Session() as session:
-            config = session.query(GuildModLog).filter_by(id=str(ctx.guild.id)).one_or_none()
-            if config is not None:
-                config.name = ctx.guild.name
-                config.modlog_channel = str(channel_mentions.id)
-            else:
-                config = GuildModLog(id=ctx.guild.id, modlog_channel=channel_mentions.id, name=ctx.guild.name)
-                session.add(config)
-            await ctx.send(ctx.message.author.mention + ', modlog settings configured!')
+        await db.upsert(GuildModLog, {'id': ctx.guild.id, 'modlog_channel': channel_mentions.id, 'name': ctx.guild.name})
+        db.settings_cache.invalidate(GuildModLog, id=ctx.guild.id)
+        await ctx.send(ctx.message.author.mention + ', modlog settings configured!')
     modlogconfig.example_usage = """
     `{prefix}modlogconfig #join-leave-logs` - set a channel named #join-leave-logs to log joins/leaves 
     """
@@ -623,8 +683,8 @@ class Moderation(Cog):
     @has_permissions(administrator=True)
     async def nmconfig(self, ctx, channel_mention: discord.TextChannel, role: discord.Role, *, message):
         """Sets the config for the new members channel"""
-        with db.Session() as session:
-            config = session.query(GuildNewMember).filter_by(guild_id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            config = await session.query(GuildNewMember).filter_by(guild_id=ctx.guild.id).one_or_none()
             if config is not None:
                 config.channel_id = channel_mention.id
                 config.role_id = role.id
@@ -633,6 +693,7 @@ class Moderation(Cog):
                 config = GuildNewMember(guild_id=ctx.guild.id, channel_id=channel_mention.id, role_id=role.id,
                                         message=message.casefold())
                 session.add(config)
+        db.settings_cache.invalidate(GuildNewMember, guild_id=ctx.guild.id)
 
         role_name = role.name
         await ctx.send(
@@ -652,13 +713,8 @@ class Moderation(Cog):
         if member_role >= ctx.author.top_role:
             raise BadArgument('member role cannot be higher than your top role!')
 
-        with db.Session() as session:
-            settings = session.query(MemberRole).filter_by(id=ctx.guild.id).one_or_none()
-            if settings is None:
-                settings = MemberRole(id=ctx.guild.id, member_role=member_role.id)
-                session.add(settings)
-            else:
-                settings.member_role = member_role.id
+        await db.upsert(MemberRole, {'id': ctx.guild.id, 'member_role': member_role.id})
+        db.settings_cache.invalidate(MemberRole, id=ctx.guild.id)
         await ctx.send('Member role set as `{}`.'.format(member_role.name))
     memberconfig.example_usage = """
     `{prefix}memberconfig Members` - set a role called "Members" as the member role
@@ -680,13 +736,8 @@ class Moderation(Cog):
         if link_role >= ctx.author.top_role:
             raise BadArgument('Link role cannot be higher than your top role!')
 
-        with db.Session() as session:
-            settings = session.query(GuildMessageLinks).filter_by(guild_id=ctx.guild.id).one_or_none()
-            if settings is None:
-                settings = GuildMessageLinks(guild_id=ctx.guild.id, role_id=link_role.id)
-                session.add(settings)
-            else:
-                settings.role_id = link_role.id
+        await db.upsert(GuildMessageLinks, {'guild_id': ctx.guild.id, 'role_id': link_role.id})
+        db.settings_cache.invalidate(GuildMessageLinks, guild_id=ctx.guild.id)
         await ctx.send(f'Link role set as `{link_role.name}`.')
     linkscrubconfig.example_usage = """
     `{prefix}linkscrubconfig Links` - set a role called "Links" as the link role
@@ -701,15 +752,16 @@ class Moderation(Cog):
     @has_permissions(administrator=True)
     async def memberlogconfig(self, ctx, channel_mentions: discord.TextChannel):
         """Set the join/leave channel for a server by passing a channel mention"""
-        with db.Session() as session:
-            config = session.query(GuildMemberLog).filter_by(id=str(ctx.guild.id)).one_or_none()
+        async with db.AsyncSession() as session:
+            config = await session.query(GuildMemberLog).filter_by(id=str(ctx.guild.id)).one_or_none()
             if config is not None:
                 config.name = ctx.guild.name
                 config.memberlog_channel = str(channel_mentions.id)
             else:
                 config = GuildMemberLog(id=ctx.guild.id, memberlog_channel=channel_mentions.id, name=ctx.guild.name)
                 session.add(config)
-            await ctx.send(ctx.message.author.mention + ', memberlog settings configured!')
+        db.settings_cache.invalidate(GuildMemberLog, id=ctx.guild.id)
+        await ctx.send(ctx.message.author.mention + ', memberlog settings configured!')
     memberlogconfig.example_usage = """
     `{prefix}memberlogconfig #join-leave-logs` - set a channel named #join-leave-logs to log joins/leaves 
     """
@@ -718,15 +770,16 @@ class Moderation(Cog):
     @has_permissions(administrator=True)
     async def messagelogconfig(self, ctx, channel_mentions: discord.TextChannel):
         """Set the modlog channel for a server by passing the channel id"""
-        with db.Session() as session:
-            config = session.query(GuildMessageLog).filter_by(id=str(ctx.guild.id)).one_or_none()
+        async with db.AsyncSession() as session:
+            config = await session.query(GuildMessageLog).filter_by(id=str(ctx.guild.id)).one_or_none()
             if config is not None:
                 config.name = ctx.guild.name
                 config.messagelog_channel = str(channel_mentions.id)
             else:
                 config = GuildMessageLog(id=ctx.guild.id, messagelog_channel=channel_mentions.id, name=ctx.guild.name)
                 session.add(config)
-            await ctx.send(ctx.message.author.mention + ', messagelog settings configured!')
+        db.settings_cache.invalidate(GuildMessageLog, id=ctx.guild.id)
+        await ctx.send(ctx.message.author.mention + ', messagelog settings configured!')
     messagelogconfig.example_usage = """
     `{prefix}messagelogconfig #orwellian-dystopia` - set a channel named #orwellian-dystopia to log message edits/deletions
     """
@@ -813,7 +866,7 @@ class PunishmentTimerRecord(db.DatabaseObject):
     orig_channel_id = db.Column(db.BigInteger, nullable=True)
     type = db.Column(db.BigInteger)
     reason = db.Column(db.String, nullable=True)
-    target_ts = db.Column(db.BigInteger)
+    target_ts = db.Column(db.BigInteger, index=True)
 
     type_map = {p.type: p for p in (Mute, Deafen)}
 
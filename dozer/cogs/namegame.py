@@ -2,7 +2,6 @@
 import asyncio
 import gzip
 import pickle
-import traceback
 from collections import OrderedDict
 from functools import wraps
 
@@ -31,7 +30,7 @@ def keep_alive(func):
                 if isinstance(e, asyncio.CancelledError):
                     return
                 # panic to the console, and to chat
-                dozer_logger.error(traceback.format_exc())
+                dozer_logger.exception('Error in game loop')
                 await ctx.send(f"```Error in game loop:\n{e.__class__.__name__}: {e}```")
 
     return wrapper
@@ -53,6 +52,10 @@ def game_is_running(func):
 
 class NameGameSession():
     """NameGame session object"""
+    # Attributes that can be handed over to a new process as they are
+    plain_state = ('running', 'pings_enabled', 'picked', 'mode', 'time', 'vote_time', 'number', 'last_name', 'last_team',
+                   'turn_count', 'pass_tally', 'fail_tally', 'vote_correct')
+
     def __init__(self, mode):
         self.running = True
         self.pings_enabled = False
@@ -150,8 +153,18 @@ class NameGameSession():
         """Gets the picked teams"""
         return ", ".join(map(str, sorted(self.picked))) or "No Picked Teams"
 
+    def export_state(self):
+        """Returns the game's state, with members and messages replaced by their ids."""
+        state = {attr: getattr(self, attr) for attr in self.plain_state}
+        state['players'] = [(player.id, strikes) for player, strikes in self.players.items()]
+        state['removed_players'] = [player.id for player in self.removed_players]
+        for attr in ('current_player', 'vote_player', 'turn_msg', 'vote_msg'):
+            value = getattr(self, attr)
+            state[attr] = value.id if value is not None else None
+        return state
+
 
-class NameGame(Cog):
+class NameGame(Cog):  # pylint: disable=too-many-public-methods
     """Namegame commands"""
     def __init__(self, bot):
         super().__init__(bot)
@@ -161,6 +174,56 @@ class NameGame(Cog):
         self.tba_parser = aiotba.TBASession(tba_config['key'], self.bot.http_session)
         # tbapi.TBAParser(tba_config['key'], cache=False)
 
+    async def warm_up(self, guilds):
+        """Loads the namegame configuration of every guild into the settings cache."""
+        await db.settings_cache.warm(NameGameConfig, 'guild_id', [guild.id for guild in guilds])
+
+    def export_state(self):
+        """Stops the running games and returns their state, to be continued by the new process when restarting."""
+        state = {}
+        for channel_id, game in self.games.items():
+            for task in (game.turn_task, game.vote_task):
+                if task is not None:
+                    task.cancel()
+            state[channel_id] = game.export_state()
+        return state
+
+    async def import_state(self, state):
+        """Continues the games handed over by the previous process where they left off."""
+        for channel_id, saved in state.items():
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or saved['turn_msg'] is None:
+                continue
+            game = NameGameSession(saved['mode'])
+            game.state_lock = asyncio.Lock()
+            for attr in NameGameSession.plain_state:
+                setattr(game, attr, saved[attr])
+            game.players = OrderedDict((channel.guild.get_member(player_id), strikes) for player_id, strikes in saved['players']
+                                       if channel.guild.get_member(player_id) is not None)
+            game.removed_players = [member for member in map(channel.guild.get_member, saved['removed_players']) if member is not None]
+            game.current_player = channel.guild.get_member(saved['current_player'])
+            if saved['vote_player'] is not None:
+                game.vote_player = channel.guild.get_member(saved['vote_player'])
+            if not game.players or game.current_player not in game.players:
+                continue
+            try:
+                game.turn_msg = await channel.get_message(saved['turn_msg'])
+                if saved['vote_msg'] is not None and saved['vote_msg'] != saved['turn_msg']:
+                    game.vote_msg = await channel.get_message(saved['vote_msg'])
+            except discord.HTTPException:
+                continue
+            game.turn_embed = game.turn_msg.embeds[0] if game.turn_msg.embeds else game.create_embed()
+            if saved['vote_msg'] == saved['turn_msg']:
+                game.vote_msg, game.vote_embed = game.turn_msg, game.turn_embed
+            elif game.vote_msg is not None:
+                game.vote_embed = game.vote_msg.embeds[0] if game.vote_msg.embeds else None
+            # Countdowns only use the context to send messages to the game's channel
+            ctx = await self.bot.get_context(game.turn_msg)
+            self.games[channel_id] = game
+            game.turn_task = self.bot.loop.create_task(self.game_turn_countdown(ctx, game))
+            if game.vote_embed is not None and not game.vote_correct and game.vote_time > 0:
+                game.vote_task = self.bot.loop.create_task(self.game_vote_countdown(ctx, game))
+
     @group(invoke_without_command=True)
     async def ng(self, ctx):
         """Show info about and participate in a robotics team namegame.
@@ -234,29 +297,31 @@ class NameGame(Cog):
     @has_permissions(manage_guild=True)
     async def defaultmode(self, ctx, mode: str = None):
         """Configuration of the default game mode (FRC, FTC, etc.)"""
-        with db.Session() as session:
-            config = session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
-            if mode is None:
-                mode = SUPPORTED_MODES[0] if config is None else config.mode
-                await ctx.send(f"The current default game mode for this server is `{mode}`")
+        if mode is None:
+            config = await db.settings_cache.get(NameGameConfig, guild_id=ctx.guild.id)
+            mode = SUPPORTED_MODES[0] if config is None else config.mode
+            await ctx.send(f"The current default game mode for this server is `{mode}`")
+            return
+        if mode not in SUPPORTED_MODES:
+            await ctx.send(
+                f"Game mode `{mode}` not supported! Please pick a mode that is one of: `{', '.join(SUPPORTED_MODES)}`")
+            return
+        async with db.AsyncSession() as session:
+            config = await session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
+            if config is None:
+                config = NameGameConfig(guild_id=ctx.guild.id, channel_id=None, mode=mode, pings_enabled=False)
+                session.add(config)
             else:
-                if mode not in SUPPORTED_MODES:
-                    await ctx.send(
-                        f"Game mode `{mode}` not supported! Please pick a mode that is one of: `{', '.join(SUPPORTED_MODES)}`")
-                    return
-                if config is None:
-                    config = NameGameConfig(guild_id=ctx.guild.id, channel_id=None, mode=mode, pings_enabled=False)
-                    session.add(config)
-                else:
-                    config.mode = mode
-                await ctx.send(f"Default game mode updated to `{mode}`")
+                config.mode = mode
+        db.settings_cache.invalidate(NameGameConfig, guild_id=ctx.guild.id)
+        await ctx.send(f"Default game mode updated to `{mode}`")
 
     @config.command()
     @has_permissions(manage_guild=True)
     async def setchannel(self, ctx, channel: discord.TextChannel = None):
         """Sets the namegame channel"""
-        with db.Session() as session:
-            config = session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            config = await session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
             if channel is None:
                 if config is None or config.channel_id is None:
                     await ctx.send(
@@ -273,31 +338,35 @@ class NameGame(Cog):
                     session.add(config)
                 else:
                     config.channel_id = channel.id
-                await ctx.send(f"Namegame channel set to {channel.mention}!")
+        if channel is not None:
+            db.settings_cache.invalidate(NameGameConfig, guild_id=ctx.guild.id)
+            await ctx.send(f"Namegame channel set to {channel.mention}!")
 
     @config.command()
     @has_permissions(manage_guild=True)
     async def clearsetchannel(self, ctx):
         """Clears the set namegame channel"""
-        with db.Session() as session:
-            config = session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            config = await session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
             if config is not None:
                 config.channel_id = None
-            await ctx.send("Namegame channel cleared!")
+        db.settings_cache.invalidate(NameGameConfig, guild_id=ctx.guild.id)
+        await ctx.send("Namegame channel cleared!")
 
     @config.command()
     @has_permissions(manage_guild=True)
     async def setpings(self, ctx, enabled: bool):
         """Sets whether or not pings are enabled"""
-        with db.Session() as session:
-            config = session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            config = await session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
             if config is None:
                 config = NameGameConfig(guild_id=ctx.guild.id, channel_id=None, mode=SUPPORTED_MODES[0],
                                         pings_enabled=int(enabled))
                 session.add(config)
             else:
                 config.pings_enabled = int(enabled)
-            await ctx.send(f"Pings enabled set to `{enabled}`!")
+        db.settings_cache.invalidate(NameGameConfig, guild_id=ctx.guild.id)
+        await ctx.send(f"Pings enabled set to `{enabled}`!")
 
     @config.command()
     @has_permissions(manage_guild=True)
@@ -307,13 +376,13 @@ class NameGame(Cog):
             await ctx.send(
                 f"Game mode `{mode}` not supported! Please pick a mode that is one of: `{', '.join(SUPPORTED_MODES)}`")
             return
-        with db.Session() as session:
-            record = session.query(NameGameLeaderboard).filter_by(game_mode=mode, user_id=user.id).one_or_none()
-            if record is None:
-                await ctx.send("User not on leaderboard!")
-                return
-            record.wins = wins
-            await ctx.send(f"{user.display_name}'s wins now set to: **{wins}**")
+        async with db.AsyncSession() as session:
+            updated = await session.query(NameGameLeaderboard).filter_by(game_mode=mode, user_id=user.id).update(
+                {'wins': wins}, synchronize_session=False)
+        if not updated:
+            await ctx.send("User not on leaderboard!")
+            return
+        await ctx.send(f"{user.display_name}'s wins now set to: **{wins}**")
 
     @config.command()
     @has_permissions(manage_guild=True)
@@ -323,8 +392,8 @@ class NameGame(Cog):
             await ctx.send(
                 f"Game mode `{mode}` not supported! Please pick a mode that is one of: `{', '.join(SUPPORTED_MODES)}`")
             return
-        with db.Session() as session:
-            session.query(NameGameLeaderboard).filter_by(game_mode=mode).delete()
+        async with db.AsyncSession() as session:
+            await session.query(NameGameLeaderboard).filter_by(game_mode=mode).delete()
         await ctx.send(f"Cleared leaderboard for mode {mode}")
 
     # TODO: configurable time limits, ping on event, etc
@@ -356,7 +425,7 @@ class NameGame(Cog):
         except Exception:
             pass
 
-        self.games.pop(game)
+        self.games.pop(ctx.channel.id)
 
     @ng.command()
     async def modes(self, ctx):
@@ -370,20 +439,17 @@ class NameGame(Cog):
         One can select the robotics program by specifying one of "FRC" or "FTC".
         """
         if mode is None or mode.lower() not in SUPPORTED_MODES:
-            with db.Session() as session:
-                config = session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
+            config = await db.settings_cache.get(NameGameConfig, guild_id=ctx.guild.id)
             mode = SUPPORTED_MODES[0] if config is None else config.mode
             await ctx.send(
                 f"Unspecified or invalid game mode,  assuming game mode `{mode}`. For a full list of game modes, run "
                 f"`{ctx.prefix}ng modes`")
 
-        pings_enabled = False
-        with db.Session() as session:
-            config = session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
-            if config is not None and config.channel_id is not None and config.channel_id != ctx.channel.id:
-                await ctx.send("Games cannot be started in this channel!")
-                return
-            pings_enabled = (config is not None and config.pings_enabled)
+        config = await db.settings_cache.get(NameGameConfig, guild_id=ctx.guild.id)
+        if config is not None and config.channel_id is not None and config.channel_id != ctx.channel.id:
+            await ctx.send("Games cannot be started in this channel!")
+            return
+        pings_enabled = (config is not None and config.pings_enabled)
 
         if ctx.channel.id in self.games:
             await ctx.send("A game is currently going on! Wait till the players finish up to start again.")
@@ -587,25 +653,29 @@ class NameGame(Cog):
     async def leaderboard(self, ctx, mode: str = None):
         """Display top numbers of wins for the specified game mode"""
         if mode is None:
-            with db.Session() as session:
-                config = session.query(NameGameConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
+            config = await db.settings_cache.get(NameGameConfig, guild_id=ctx.guild.id)
             mode = SUPPORTED_MODES[0] if config is None else config.mode
         if mode not in SUPPORTED_MODES:
             await ctx.send(
                 f"Game mode `{mode}` not supported! Please pick a mode that is one of: `{', '.join(SUPPORTED_MODES)}`")
             return
-        with db.Session() as session:
-            leaderboard = sorted(session.query(NameGameLeaderboard).filter_by(game_mode=mode).all(),
-                                 key=lambda i: i.wins, reverse=True)[:10]
-            embed = discord.Embed(color=discord.Color.gold(), title=f"{mode.upper()} Name Game Leaderboard")
-            for idx, entry in enumerate(leaderboard, 1):
-                embed.add_field(name=f"#{idx}: {ctx.bot.get_user(entry.user_id).display_name}", value=entry.wins)
-            await ctx.send(embed=embed)
+        leaderboard = await self.leaderboard_entries(mode)
+        embed = discord.Embed(color=discord.Color.gold(), title=f"{mode.upper()} Name Game Leaderboard")
+        for idx, entry in enumerate(leaderboard, 1):
+            embed.add_field(name=f"#{idx}: {ctx.bot.get_user(entry.user_id).display_name}", value=entry.wins)
+        await ctx.send(embed=embed)
 
     leaderboard.example_usage = """
     `{prefix}ng leaderboard ftc` - display the namegame winning leaderboards for FTC.
     """
 
+    @staticmethod
+    async def leaderboard_entries(mode, count=10):
+        """Returns the leaderboard records of the count players with the most wins in a game mode, most wins first."""
+        async with db.AsyncSession() as session:
+            return sorted(await session.query(NameGameLeaderboard).filter_by(game_mode=mode).all(),
+                          key=lambda i: i.wins, reverse=True)[:count]
+
     async def strike(self, ctx, game, player):
         """Gives a player a strike."""
         if game.strike(player):
@@ -616,19 +686,14 @@ class NameGame(Cog):
         if game.check_win():
             # winning condition
             winner = list(game.players.keys())[0]
-            with db.Session() as session:
-                record = session.query(NameGameLeaderboard).filter_by(user_id=winner.id,
-                                                                      game_mode=game.mode).one_or_none()
-                if record is None:
-                    record = NameGameLeaderboard(user_id=winner.id, wins=1, game_mode=game.mode)
-                    session.add(record)
-                else:
-                    record.wins += 1
+            wins, = await db.upsert(NameGameLeaderboard, {'user_id': winner.id, 'game_mode': game.mode, 'wins': 1},
+                                    update={'wins': NameGameLeaderboard.wins + 1},
+                                    returning=[NameGameLeaderboard.wins])
             win_embed = discord.Embed()
             win_embed.color = discord.Color.gold()
             win_embed.title = "We have a winner!"
             win_embed.add_field(name="Winning Player", value=winner)
-            win_embed.add_field(name="Wins Total", value=record.wins)
+            win_embed.add_field(name="Wins Total", value=wins)
             win_embed.add_field(name="Teams Picked", value=game.get_picked())
             await ctx.send(embed=win_embed)
 
@@ -787,7 +852,7 @@ class NameGameLeaderboard(db.DatabaseObject):
     __tablename__ = "namegame_leaderboard"
     user_id = db.Column(db.BigInteger, primary_key=True)
     wins = db.Column(db.BigInteger)
-    game_mode = db.Column(db.String)
+    game_mode = db.Column(db.String, primary_key=True)
 
 
 def setup(bot):
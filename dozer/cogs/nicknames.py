@@ -1,4 +1,6 @@
 """A cog that handles keeping nicknames persistent between member join/leave, as a substitute for setting nicknames by teams."""
+import datetime
+
 import discord
 from discord.ext.commands import BadArgument, guild_only
 
@@ -13,8 +15,8 @@ class Nicknames(Cog):
     @guild_only()
     async def savenick(self, ctx, save: bool = None):
         """Sets whether or not a user wants their nickname upon server leave to be saved upon server rejoin."""
-        with db.Session() as session:
-            nick = session.query(NicknameTable).filter_by(user_id=ctx.author.id, guild_id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            nick = await session.query(NicknameTable).filter_by(user_id=ctx.author.id, guild_id=ctx.guild.id).one_or_none()
             if nick is None:
                 nick = NicknameTable(user_id=ctx.author.id, guild_id=ctx.guild.id, nickname=ctx.author.nick, enabled=save is None or save)
                 session.add(nick)
@@ -28,23 +30,20 @@ class Nicknames(Cog):
 
     async def on_member_join(self, member):
         """Handles adding the nickname back on server join."""
-        with db.Session() as session:
-            nick = session.query(NicknameTable).filter_by(user_id=member.id, guild_id=member.guild.id).one_or_none()
+        await db.write_queue.flush()  # the member may have left moments ago
+        async with db.AsyncSession() as session:
+            nick = await session.query(NicknameTable).filter_by(user_id=member.id, guild_id=member.guild.id).one_or_none()
             if nick is None or not nick.enabled:
                 return
             await member.edit(nick=nick.nickname)
 
     async def on_member_remove(self, member):
         """Handles saving the nickname on server leave."""
-        with db.Session() as session:
-            nick = session.query(NicknameTable).filter_by(user_id=member.id, guild_id=member.guild.id).one_or_none()
-            if nick is None:
-                nick = NicknameTable(user_id=member.id, guild_id=member.guild.id, nickname=member.nick, enabled=True)
-                session.add(nick)
-            else:
-                if not nick.enabled:
-                    return
-                nick.nickname = member.nick
+        # Members who turned saving off keep their row untouched
+        db.write_queue.upsert(NicknameTable, {'user_id': member.id, 'guild_id': member.guild.id,
+                                               'nickname': member.nick, 'enabled': True,
+                                               'saved_at': datetime.datetime.utcnow()},
+                              update=['nickname', 'saved_at'], where=NicknameTable.enabled)
 
 
 class NicknameTable(db.DatabaseObject):
@@ -54,6 +53,13 @@ class NicknameTable(db.DatabaseObject):
     guild_id = db.Column(db.BigInteger, primary_key=True)
     nickname = db.Column(db.String, nullable=True)
     enabled = db.Column(db.Boolean)
+    saved_at = db.Column(db.DateTime, nullable=True)
+
+
+@db.retention_policy(NicknameTable)
+def expired_nicknames(cutoff):
+    """Nicknames saved before the cutoff. Opt-outs from savenick are preferences rather than saved data, so they are kept."""
+    return (NicknameTable.saved_at < cutoff) & NicknameTable.enabled
 
 
 def setup(bot):
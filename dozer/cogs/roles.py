@@ -1,5 +1,7 @@
 """Role management commands."""
 
+import datetime
+
 import discord
 import discord.utils
 from discord.ext.commands import cooldown, BucketType, has_permissions, BadArgument, MissingPermissions
@@ -25,23 +27,20 @@ class Roles(Cog):
         """Restores a member's roles when they join if they have joined before."""
         me = member.guild.me
         top_restorable = me.top_role.position if me.guild_permissions.manage_roles else 0
-        with db.Session() as session:
-            restore = session.query(MissingMember).filter_by(guild_id=member.guild.id,
-                                                             member_id=member.id).one_or_none()
-            if restore is None:
-                return  # New member - nothing to restore
-
-            valid, cant_give, missing = set(), set(), set()
-            for missing_role in restore.missing_roles:
-                role = member.guild.get_role(missing_role.role_id)
-                if role is None:  # Role with that ID does not exist
-                    missing.add(missing_role.role_name)
-                elif role.position > top_restorable:
-                    cant_give.add(role.name)
-                else:
-                    valid.add(role)
-
-            session.delete(restore)  # Not missing anymore - remove the record to free up the primary key
+        await db.write_queue.flush()  # the member may have left moments ago
+        saved_roles = await self.pop_saved_roles(member.guild.id, member.id)
+        if saved_roles is None:
+            return  # New member - nothing to restore
+
+        valid, cant_give, missing = set(), set(), set()
+        for missing_role in saved_roles:
+            role = member.guild.get_role(missing_role.role_id)
+            if role is None:  # Role with that ID does not exist
+                missing.add(missing_role.role_name)
+            elif role.position > top_restorable:
+                cant_give.add(role.name)
+            else:
+                valid.add(role)
 
         await member.add_roles(*valid)
         if not missing and not cant_give:
@@ -68,25 +67,36 @@ class Roles(Cog):
         """Saves a member's roles when they leave in case they rejoin."""
         guild_id = member.guild.id
         member_id = member.id
-        with db.Session() as session:
-            db_member = MissingMember(guild_id=guild_id, member_id=member_id)
-            session.add(db_member)
-            for role in member.roles[1:]:  # Exclude the @everyone role
-                db_member.missing_roles.append(MissingRole(role_id=role.id, role_name=role.name))
+        db_member = MissingMember(guild_id=guild_id, member_id=member_id, left_at=datetime.datetime.utcnow())
+        for role in member.roles[1:]:  # Exclude the @everyone role
+            db_member.missing_roles.append(MissingRole(role_id=role.id, role_name=role.name, guild_id=guild_id, member_id=member_id))
+        # Merging rather than inserting replaces any roles still saved from an earlier leave, instead of conflicting with them
+        db.write_queue.merge(db_member)
+
+    @staticmethod
+    async def pop_saved_roles(guild_id, member_id):
+        """Returns the MissingRole records saved when a member last left a guild, or None if there are none, and deletes them."""
+        async with db.AsyncSession() as session:
+            restore = await session.query(MissingMember).filter_by(guild_id=guild_id, member_id=member_id).one_or_none()
+            if restore is None:
+                return None
+            saved_roles = await session.run(lambda: list(restore.missing_roles))
+            await session.delete(restore)  # Not missing anymore - remove the record to free up the primary key
+        return saved_roles
 
     async def giveme_purge(self, rolelist):
         """Purges roles in the giveme database that no longer exist"""
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             for role in rolelist:
-                dbrole = session.query(GiveableRole).filter_by(id=role.id).one_or_none()
+                dbrole = await session.query(GiveableRole).filter_by(id=role.id).one_or_none()
                 if dbrole is not None:
-                    session.delete(dbrole)
+                    await session.delete(dbrole)
 
     async def ctx_purge(self, ctx):
         """Purges all giveme roles that no longer exist in a guild"""
         counter = 0
-        with db.Session() as session:
-            roles = session.query(GiveableRole).filter_by(guild_id=ctx.guild.id)
+        async with db.AsyncSession() as session:
+            roles = await session.query(GiveableRole).filter_by(guild_id=ctx.guild.id).all()
             guildroles = []
             rolelist = []
             for i in ctx.guild.roles:
@@ -108,10 +118,10 @@ class Roles(Cog):
     async def giveme(self, ctx, *, roles):
         """Give you one or more giveable roles, separated by commas."""
         norm_names = [self.normalize(name) for name in roles.split(',')]
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             giveable_ids = [tup[0] for tup in
-                            session.query(GiveableRole.id).filter(GiveableRole.guild_id == ctx.guild.id,
-                                                                  GiveableRole.norm_name.in_(norm_names)).all()]
+                            await session.query(GiveableRole.id).filter(GiveableRole.guild_id == ctx.guild.id,
+                                                                        GiveableRole.norm_name.in_(norm_names)).all()]
             valid = set(role for role in ctx.guild.roles if role.id in giveable_ids)
 
         already_have = valid & set(ctx.author.roles)
@@ -155,12 +165,13 @@ class Roles(Cog):
         if ',' in name:
             raise BadArgument('giveable role names must not contain commas!')
         norm_name = self.normalize(name)
-        with db.Session() as session:
-            settings = session.query(GuildSettings).filter_by(id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            settings = await session.query(GuildSettings).filter_by(id=ctx.guild.id).one_or_none()
             if settings is None:
                 settings = GuildSettings(id=ctx.guild.id)
                 session.add(settings)
-            if norm_name in (giveable.norm_name for giveable in settings.giveable_roles):
+            giveable_roles = await session.run(lambda: settings.giveable_roles)
+            if norm_name in (giveable.norm_name for giveable in giveable_roles):
                 raise BadArgument('that role already exists and is giveable!')
             candidates = [role for role in ctx.guild.roles if self.normalize(role.name) == norm_name]
 
@@ -170,7 +181,7 @@ class Roles(Cog):
                 role = candidates[0]
             else:
                 raise BadArgument('{} roles with that name exist!'.format(len(candidates)))
-            settings.giveable_roles.append(GiveableRole.from_role(role))
+            giveable_roles.append(GiveableRole.from_role(role))
         await ctx.send(
             'Role "{0}" added! Use `{1}{2} {0}` to get it!'.format(role.name, ctx.prefix, ctx.command.parent))
 
@@ -188,16 +199,17 @@ class Roles(Cog):
         if ',' in name:
             raise BadArgument('giveable role names must not contain commas!')
         norm_name = self.normalize(name)
-        with db.Session() as session:
-            settings = session.query(GuildSettings).filter_by(id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            settings = await session.query(GuildSettings).filter_by(id=ctx.guild.id).one_or_none()
             if settings is None:
                 settings = GuildSettings(id=ctx.guild.id)
                 session.add(settings)
-            if norm_name in (giveable.norm_name for giveable in settings.giveable_roles):
+            giveable_roles = await session.run(lambda: settings.giveable_roles)
+            if norm_name in (giveable.norm_name for giveable in giveable_roles):
                 raise BadArgument('that role already exists and is giveable!')
 
             role = await ctx.guild.create_role(name=name, reason='Giveable role created by {}'.format(ctx.author))
-            settings.giveable_roles.append(GiveableRole.from_role(role))
+            giveable_roles.append(GiveableRole.from_role(role))
         await ctx.send(
             'Role "{0}" created! Use `{1}{2} {0}` to get it!'.format(role.name, ctx.prefix, ctx.command.parent))
 
@@ -211,10 +223,10 @@ class Roles(Cog):
     async def remove(self, ctx, *, roles):
         """Removes multiple giveable roles from you. Names must be separated by commas."""
         norm_names = [self.normalize(name) for name in roles.split(',')]
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             query = session.query(GiveableRole.id).filter(GiveableRole.guild_id == ctx.guild.id,
                                                           GiveableRole.norm_name.in_(norm_names))
-            removable_ids = [tup[0] for tup in query.all()]
+            removable_ids = [tup[0] for tup in await query.all()]
             valid = set(role for role in ctx.guild.roles if role.id in removable_ids)
 
         removed = valid & set(ctx.author.roles)
@@ -250,17 +262,17 @@ class Roles(Cog):
             raise BadArgument('this command only works with single roles!')
         norm_name = self.normalize(name)
         valid_ids = set(role.id for role in ctx.guild.roles)
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             try:
-                role = session.query(GiveableRole).filter(GiveableRole.guild_id == ctx.guild.id,
-                                                          GiveableRole.norm_name == norm_name,
-                                                          GiveableRole.id.in_(valid_ids)).one()
+                role = await session.query(GiveableRole).filter(GiveableRole.guild_id == ctx.guild.id,
+                                                                GiveableRole.norm_name == norm_name,
+                                                                GiveableRole.id.in_(valid_ids)).one()
             except MultipleResultsFound:
                 raise BadArgument('multiple giveable roles with that name exist!')
             except NoResultFound:
                 raise BadArgument('that role does not exist or is not giveable!')
             else:
-                session.delete(role)
+                await session.delete(role)
         role = ctx.guild.get_role(role.id)  # Not null because we already checked for id in valid_ids
         await role.delete(reason='Giveable role deleted by {}'.format(ctx.author))
         await ctx.send('Role "{0}" deleted!'.format(role))
@@ -274,8 +286,8 @@ class Roles(Cog):
     @bot_has_permissions(manage_roles=True)
     async def list_roles(self, ctx):
         """Lists all giveable roles for this server."""
-        with db.Session() as session:
-            names = [tup[0] for tup in session.query(GiveableRole.name).filter_by(guild_id=ctx.guild.id)]
+        async with db.AsyncSession() as session:
+            names = [tup[0] for tup in await session.query(GiveableRole.name).filter_by(guild_id=ctx.guild.id).all()]
         e = discord.Embed(title='Roles available to self-assign', color=discord.Color.blue())
         e.description = '\n'.join(sorted(names, key=str.casefold))
         await ctx.send(embed=e)
@@ -299,17 +311,17 @@ class Roles(Cog):
             raise BadArgument('this command only works with single roles!')
         norm_name = self.normalize(name)
         valid_ids = set(role.id for role in ctx.guild.roles)
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             try:
-                role = session.query(GiveableRole).filter(GiveableRole.guild_id == ctx.guild.id,
-                                                          GiveableRole.norm_name == norm_name,
-                                                          GiveableRole.id.in_(valid_ids)).one()
+                role = await session.query(GiveableRole).filter(GiveableRole.guild_id == ctx.guild.id,
+                                                                GiveableRole.norm_name == norm_name,
+                                                                GiveableRole.id.in_(valid_ids)).one()
             except MultipleResultsFound:
                 raise BadArgument('multiple giveable roles with that name exist!')
             except NoResultFound:
                 raise BadArgument('that role does not exist or is not giveable!')
             else:
-                session.delete(role)
+                await session.delete(role)
         await ctx.send('Role "{0}" deleted from list!'.format(name))
 
     delete.example_usage = """
@@ -392,13 +404,15 @@ class MissingMember(db.DatabaseObject):
     guild_id = db.Column(db.BigInteger, primary_key=True)
     member_id = db.Column(db.BigInteger, primary_key=True)
     missing_roles = db.relationship('MissingRole', back_populates='member', cascade='all, delete, delete-orphan')
+    left_at = db.Column(db.DateTime)
 
 
 class MissingRole(db.DatabaseObject):
     """Holds what roles a given member had when they last left the guild."""
     __tablename__ = 'missing_roles'
     __table_args__ = (
-        db.ForeignKeyConstraint(['guild_id', 'member_id'], ['missing_members.guild_id', 'missing_members.member_id']),)
+        db.ForeignKeyConstraint(['guild_id', 'member_id'], ['missing_members.guild_id', 'missing_members.member_id']),
+        db.Index('ix_missing_roles_guild_id_member_id', 'guild_id', 'member_id'))
     role_id = db.Column(db.BigInteger, primary_key=True)
     guild_id = db.Column(db.BigInteger)  # Guild ID doesn't have to be primary because role IDs are unique across guilds
     member_id = db.Column(db.BigInteger, primary_key=True)
@@ -406,6 +420,12 @@ class MissingRole(db.DatabaseObject):
     member = db.relationship('MissingMember', back_populates='missing_roles')
 
 
+@db.retention_policy(MissingMember)
+def expired_missing_members(cutoff):
+    """Members (and their saved roles) who left before the cutoff"""
+    return MissingMember.left_at < cutoff
+
+
 def setup(bot):
     """Adds the roles cog to the main bot project."""
     bot.add_cog(Roles(bot))
@@ -10,9 +10,9 @@ from .. import db
 
 class Starboard(Cog):
     """Various starboard functions."""
-    def __init__(self, bot):
-        super().__init__(bot)
-        self.config_cache = {}
+    async def warm_up(self, guilds):
+        """Loads the starboard configuration of every guild into the settings cache."""
+        await db.settings_cache.warm(StarboardConfig, 'guild_id', [guild.id for guild in guilds])
 
     def starboard_embed_footer(self, emoji=None, reaction_count=None):
         """create the footer for a starboard embed"""
@@ -52,11 +52,11 @@ class Starboard(Cog):
 
     async def send_to_starboard(self, config, msg: discord.Message):
         """Sends a message to the starboard; if the message already exists in the starboard, update the reactions count"""
-        with db.Session() as session:
+        async with db.AsyncSession() as session:
             starboard_channel = msg.guild.get_channel(config.channel_id)
             if starboard_channel is None:
                 return
-            msg_ent = session.query(StarboardMessage).filter_by(message_id=msg.id).one_or_none()
+            msg_ent = await session.query(StarboardMessage).filter_by(message_id=msg.id).one_or_none()
             reaction_count = ([r.count for r in msg.reactions if str(r.emoji) == config.emoji] or [0])[0]
             if msg_ent:
                 msg_ent.reaction_count = reaction_count
@@ -75,22 +75,34 @@ class Starboard(Cog):
     async def on_reaction_add(self, reaction, member):
         """Handles core reaction logic."""
         msg = reaction.message
-        if msg.guild.id in self.config_cache:
-            config = self.config_cache[msg.guild.id]
-        else:
-            with db.Session() as session:
-                config = session.query(StarboardConfig).filter_by(guild_id=msg.guild.id).one_or_none()
-                if config:
-                    self.config_cache[msg.guild.id] = config
-                else:
-                    self.config_cache[msg.guild.id] = None
-                    return
-
-        # we cache null results for servers
+        config = await db.settings_cache.get(StarboardConfig, guild_id=msg.guild.id)
         if config is None:
             return
 
-        if reaction.count >= config.threshold and str(reaction.emoji) == config.emoji and member != msg.guild.me:
+        if member != msg.guild.me:
+            await self.count_reaction(config, msg, reaction)
+
+    async def on_uncached_reaction_add(self, payload):
+        """Handles reactions to messages that aren't in the message cache, fetching the message if the reaction could star it."""
+        if payload.guild_id is None or payload.user_id == self.bot.user.id:
+            return
+        config = await db.settings_cache.get(StarboardConfig, guild_id=payload.guild_id)
+        if config is None or str(payload.emoji) != config.emoji:
+            return
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        try:
+            msg = await channel.get_message(payload.message_id)
+        except discord.HTTPException:
+            return
+        reaction = discord.utils.find(lambda r: str(r.emoji) == config.emoji, msg.reactions)
+        if reaction is not None:
+            await self.count_reaction(config, msg, reaction)
+
+    async def count_reaction(self, config, msg, reaction):
+        """Sends a message to the starboard once a reaction with the starboard emoji reaches the threshold."""
+        if reaction.count >= config.threshold and str(reaction.emoji) == config.emoji:
             try:
                 await self.send_to_starboard(config, msg)
                 await msg.add_reaction(reaction.emoji)
@@ -105,12 +117,11 @@ class Starboard(Cog):
 
            To configure a starboard, use the `starboard config` subcommand.
            """
-        with db.Session() as session:
-            config = session.query(StarboardConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
-            if config:
-                await ctx.send(embed=self.make_config_embed(ctx, f"Starboard configuration for {ctx.guild}", config))
-            else:
-                await ctx.send(f"This server does not have a starboard configured! See `{ctx.prefix}help starboard` for more information.")
+        config = await db.settings_cache.get(StarboardConfig, guild_id=ctx.guild.id)
+        if config:
+            await ctx.send(embed=self.make_config_embed(ctx, f"Starboard configuration for {ctx.guild}", config))
+        else:
+            await ctx.send(f"This server does not have a starboard configured! See `{ctx.prefix}help starboard` for more information.")
     starboard.example_usage = """
     `{prefix}starboard` - Show starboard configuration details.
     `{prefix}starboard config #hall-of-fame 🌟 5` - Set the bot to repost messages that have 5 star reactions to `#hall-of-fame`
@@ -129,15 +140,14 @@ class Starboard(Cog):
             await ctx.send(f"{ctx.author.mention}, bad argument: '{emoji}' is not an emoji!")
             return
 
-        with db.Session() as session:
-            config = session.query(StarboardConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
+        async with db.AsyncSession() as session:
+            config = await session.query(StarboardConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
             if config:
-                session.delete(config)
+                await session.delete(config)
             config = StarboardConfig(guild_id=ctx.guild.id, channel_id=channel.id, emoji=str(emoji), threshold=threshold)
             session.add(config)
-            if ctx.guild.id in self.config_cache:
-                del self.config_cache[ctx.guild.id]
-            await ctx.send(embed=self.make_config_embed(ctx, f"Updated configuration for {ctx.guild}!", config))
+        db.settings_cache.invalidate(StarboardConfig, guild_id=ctx.guild.id)
+        await ctx.send(embed=self.make_config_embed(ctx, f"Updated configuration for {ctx.guild}!", config))
     config.example_usage = """
     `{prefix}starboard config #hall-of-fame 🌟 5` - Set the bot to repost messages that have 5 star reactions to `#hall-of-fame`
     """
@@ -146,19 +156,18 @@ class Starboard(Cog):
     @bot_has_permissions(embed_links=True)
     async def add(self, ctx, channel: discord.TextChannel, message_id: int):
         """Manually adds a message to the starboard. Note that the caller must have permissions to send messages to the starboard channel."""
-        with db.Session() as session:
-            config = session.query(StarboardConfig).filter_by(guild_id=ctx.guild.id).one_or_none()
-            if config:
-                starboard_channel = ctx.guild.get_channel(config.channel_id)
-                if not starboard_channel.permissions_for(ctx.author).send_messages:
-                    await ctx.send("You don't have permissions to add messages to the starboard channel!")
-                    return
-                elif not starboard_channel.permissions_for(ctx.guild.me).send_messages:
-                    await ctx.send("I don't have permissions to add messages to the starboard channel!")
-                    return
-            else:
-                await ctx.send("This server does not have a starboard configured!")
+        config = await db.settings_cache.get(StarboardConfig, guild_id=ctx.guild.id)
+        if config:
+            starboard_channel = ctx.guild.get_channel(config.channel_id)
+            if not starboard_channel.permissions_for(ctx.author).send_messages:
+                await ctx.send("You don't have permissions to add messages to the starboard channel!")
                 return
+            elif not starboard_channel.permissions_for(ctx.guild.me).send_messages:
+                await ctx.send("I don't have permissions to add messages to the starboard channel!")
+                return
+        else:
+            await ctx.send("This server does not have a starboard configured!")
+            return
         try:
             msg = await channel.get_message(message_id)
             await self.send_to_starboard(config, msg)
@@ -189,6 +198,12 @@ class StarboardMessage(db.DatabaseObject):
     reaction_count = db.Column(db.BigInteger)
 
 
+@db.retention_policy(StarboardMessage)
+def expired_starboard_messages(cutoff):
+    """Starboard entries for messages sent before the cutoff, going by the timestamp in their snowflake"""
+    return StarboardMessage.message_id < discord.utils.time_snowflake(cutoff)
+
+
 def setup(bot):
     """Add this cog to the main bot."""
     bot.add_cog(Starboard(bot))
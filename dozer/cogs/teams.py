@@ -6,6 +6,7 @@ from discord.ext.commands import BadArgument, guild_only
 
 from ._utils import *
 from .. import db
+from ..memory import offline_members
 
 
 class Teams(Cog):
@@ -14,15 +15,10 @@ class Teams(Cog):
     async def setteam(self, ctx, team_type, team_number: int):
         """Sets an association with your team in the database."""
         team_type = team_type.casefold()
-        with db.Session() as session:
-            dbcheck = session.query(TeamNumbers).filter_by(user_id=ctx.author.id, team_number=team_number,
-                                                           team_type=team_type).one_or_none()
-            if dbcheck is None:
-                dbtransaction = TeamNumbers(user_id=ctx.author.id, team_number=team_number, team_type=team_type)
-                session.add(dbtransaction)
-                await ctx.send("Team number set! Note that unlike FRC Dozer, this will not affect your nickname when joining other servers.")
-            else:
-                raise BadArgument("You are already associated with that team!")
+        inserted = await db.upsert(TeamNumbers, {'user_id': ctx.author.id, 'team_number': team_number, 'team_type': team_type})
+        if not inserted:
+            raise BadArgument("You are already associated with that team!")
+        await ctx.send("Team number set! Note that unlike FRC Dozer, this will not affect your nickname when joining other servers.")
 
     setteam.example_usage = """
     `{prefix}setteam type team_number` - Creates an association in the database with a specified team
@@ -32,11 +28,11 @@ class Teams(Cog):
     async def removeteam(self, ctx, team_type, team_number):
         """Removes an association with a team in the database."""
         team_type = team_type.casefold()
-        with db.Session() as session:
-            results = session.query(TeamNumbers).filter_by(user_id=ctx.author.id, team_type=team_type,
-                                                           team_number=team_number).one_or_none()
+        async with db.AsyncSession() as session:
+            results = await session.query(TeamNumbers).filter_by(user_id=ctx.author.id, team_type=team_type,
+                                                                 team_number=team_number).one_or_none()
             if results is not None:
-                session.delete(results)
+                await session.delete(results)
                 await ctx.send("Removed association with {} team {}".format(team_type, team_number))
             if results is None:
                 await ctx.send("Couldn't find any associations with that team!")
@@ -51,9 +47,9 @@ class Teams(Cog):
         """Allows you to see the teams for the mentioned user. If no user is mentioned, your teams are displayed."""
         if user is None:
             user = ctx.author
-        with db.Session() as session:
-            teams = session.query(TeamNumbers).filter_by(user_id=user.id).order_by("team_type desc",
-                                                                                   "team_number asc").all()
+        async with db.AsyncSession() as session:
+            teams = await session.query(TeamNumbers).filter_by(user_id=user.id).order_by("team_type desc",
+                                                                                         "team_number asc").all()
             if not teams:
                 raise BadArgument("Couldn't find any team associations for that user!")
             else:
@@ -73,18 +69,19 @@ class Teams(Cog):
     async def onteam(self, ctx, team_type, team_number):
         """Allows you to see who has associated themselves with a particular team."""
         team_type = team_type.casefold()
-        with db.Session() as session:
-            users = session.query(TeamNumbers).filter_by(team_number=team_number, team_type=team_type).all()
+        async with db.AsyncSession() as session:
+            users = await session.query(TeamNumbers).filter_by(team_number=team_number, team_type=team_type).all()
             if not users:
                 await ctx.send("Nobody on that team found!")
             else:
                 e = discord.Embed(type='rich')
                 e.title = 'Users on team {}'.format(team_number)
                 e.description = "Users: \n"
-                for i in users:
-                    user = ctx.guild.get_member(i.user_id)
-                    if user is not None:
-                        e.description = "{}{} {} \n".format(e.description, user.display_name, user.mention)
+                async with offline_members(self.bot, ctx.guild):
+                    for i in users:
+                        user = ctx.guild.get_member(i.user_id)
+                        if user is not None:
+                            e.description = f"{e.description}{user.display_name} {user.mention} \n"
                 await ctx.send(embed=e)
 
     onteam.example_usage = """
@@ -95,11 +92,9 @@ class Teams(Cog):
     @guild_only()
     async def top(self, ctx):
         """Show the top 10 teams by number of members in this guild."""
-        with db.Session() as session:
-            team_keys = session.query(TeamNumbers.team_type, TeamNumbers.team_number) \
-                .filter(TeamNumbers.user_id.in_({member.id for member in ctx.guild.members})).all()
-
-        counts = sorted(collections.Counter(team_keys).most_common(10), key=lambda tup: tup[0])
+        async with offline_members(self.bot, ctx.guild):
+            member_ids = {member.id for member in ctx.guild.members}
+        counts = await self.team_counts(member_ids)
         embed = discord.Embed(title=f'Top teams in {ctx.guild.name}', color=discord.Color.blue())
         embed.description = '\n'.join(
             f'{type_.upper()} team {num} ({count} member{"s" if count > 1 else ""})' for (type_, num), count in counts)
@@ -109,13 +104,21 @@ class Teams(Cog):
     `{prefix}onteam top` - List the 10 teams with the most members in this guild
     """
 
+    @staticmethod
+    async def team_counts(member_ids, count=10):
+        """Returns the count teams with the most members among member_ids as ((type, number), members) pairs, sorted by team."""
+        async with db.AsyncSession() as session:
+            team_keys = await session.query(TeamNumbers.team_type, TeamNumbers.team_number) \
+                .filter(TeamNumbers.user_id.in_(member_ids)).all()
+        return sorted(collections.Counter(team_keys).most_common(count), key=lambda tup: tup[0])
+
     async def on_member_join(self, member):
         """Adds a user's team association to their name when they join (if exactly 1 association)"""
         if member:  # pylint friendly NOP
             return
         if member.guild.me.guild_permissions.manage_nicknames:
-            with db.Session() as session:
-                query = session.query(TeamNumbers).filter_by(user_id=member.id).first()
+            async with db.AsyncSession() as session:
+                query = await session.query(TeamNumbers).filter_by(user_id=member.id).first()
                 if query is not None:
                     nick = "{} {}{}".format(member.display_name, query.team_type, query.team_number)
                     if len(nick) <= 32:
@@ -125,6 +128,7 @@ class Teams(Cog):
 class TeamNumbers(db.DatabaseObject):
     """DB object for tracking team associations."""
     __tablename__ = 'team_numbers'
+    __table_args__ = (db.Index('ix_team_numbers_team_type_team_number', 'team_type', 'team_number'), {'extend_existing': True})
     user_id = db.Column(db.BigInteger, primary_key=True)
     team_number = db.Column(db.BigInteger, primary_key=True)
     team_type = db.Column(db.String, primary_key=True)
@@ -8,6 +8,10 @@ from .. import db
 
 class Voice(Cog):
     """Commands interacting with voice."""
+    async def warm_up(self, guilds):
+        """Loads the voicebind of every voice channel into the settings cache."""
+        await db.settings_cache.warm(Voicebinds, 'channel_id', [channel.id for guild in guilds for channel in guild.voice_channels])
+
     async def on_voice_state_update(self, member, before, after):
         """Handles voicebinds when members join/leave voice channels"""
         # skip this if we have no perms, or if it's something like a mute/deafen
@@ -16,33 +20,24 @@ class Voice(Cog):
             # before and after are voice states
             if after.channel is not None:
                 # join event, give role
-                with db.Session() as session:
-                    config = session.query(Voicebinds).filter_by(channel_id=after.channel.id).one_or_none()
-                    if config is not None:
-                        await member.add_roles(member.guild.get_role(config.role_id))
+                config = await db.settings_cache.get(Voicebinds, channel_id=after.channel.id)
+                if config is not None:
+                    await member.add_roles(member.guild.get_role(config.role_id))
 
             if before.channel is not None:
                 # leave event, take role
-                with db.Session() as session:
-                    config = session.query(Voicebinds).filter_by(channel_id=before.channel.id).one_or_none()
-                    if config is not None:
-                        await member.remove_roles(member.guild.get_role(config.role_id))
+                config = await db.settings_cache.get(Voicebinds, channel_id=before.channel.id)
+                if config is not None:
+                    await member.remove_roles(member.guild.get_role(config.role_id))
 
     @command()
     @bot_has_permissions(manage_roles=True)
     @has_permissions(manage_roles=True)
     async def voicebind(self, ctx, voice_channel: discord.VoiceChannel, *, role: discord.Role):
         """Associates a voice channel with a role, so users joining a voice channel will automatically be given a specified role or roles."""
-
-        with db.Session() as session:
-            config = session.query(Voicebinds).filter_by(channel_id=voice_channel.id).one_or_none()
-            if config is not None:
-                config.guild_id = ctx.guild.id
-                config.channel_id = voice_channel.id
-                config.role_id = role.id
-            else:
-                config = Voicebinds(channel_id=voice_channel.id, role_id=role.id, guild_id=ctx.guild.id)
-                session.add(config)
+        await db.upsert(Voicebinds, {'channel_id': voice_channel.id, 'role_id': role.id, 'guild_id': ctx.guild.id},
+                        conflict=['channel_id'])
+        db.settings_cache.invalidate(Voicebinds, channel_id=voice_channel.id)
 
         await ctx.send("Role `{role}` will now be given to users in voice channel `{voice_channel}`!".format(role=role,
                                                                                                              voice_channel=voice_channel))
@@ -56,17 +51,18 @@ class Voice(Cog):
     @has_permissions(manage_roles=True)
     async def voiceunbind(self, ctx, voice_channel: discord.VoiceChannel):
         """Dissasociates a voice channel with a role previously binded with the voicebind command."""
-        with db.Session() as session:
-            config = session.query(Voicebinds).filter_by(channel_id=voice_channel.id).one_or_none()
-            if config is not None:
-                role = ctx.guild.get_role(config.role_id)
-                session.delete(config)
-                await ctx.send(
-                    "Role `{role}` will no longer be given to users in voice channel `{voice_channel}`!".format(
-                        role=role, voice_channel=voice_channel))
-            else:
+        async with db.AsyncSession() as session:
+            config = await session.query(Voicebinds).filter_by(channel_id=voice_channel.id).one_or_none()
+            if config is None:
                 await ctx.send("It appears that `{voice_channel}` is not associated with a role!".format(
                     voice_channel=voice_channel))
+                return
+            role = ctx.guild.get_role(config.role_id)
+            await session.delete(config)
+        db.settings_cache.invalidate(Voicebinds, channel_id=voice_channel.id)
+        await ctx.send(
+            "Role `{role}` will no longer be given to users in voice channel `{voice_channel}`!".format(
+                role=role, voice_channel=voice_channel))
 
     voiceunbind.example_usage = """
     `{prefix}voiceunbind "General #1"` - Removes automatic role-giving for users in "General #1".
@@ -77,8 +73,8 @@ class Voice(Cog):
     async def voicebindlist(self, ctx):
         """Lists all the voice channel to role bindings for the current server"""
         embed = discord.Embed(title="List of voice bindings for \"{}\"".format(ctx.guild), color=discord.Color.blue())
-        with db.Session() as session:
-            for config in session.query(Voicebinds).filter_by(guild_id=ctx.guild.id).all():
+        async with db.AsyncSession() as session:
+            for config in await session.query(Voicebinds).filter_by(guild_id=ctx.guild.id).all():
                 channel = discord.utils.get(ctx.guild.voice_channels, id=config.channel_id)
                 role = ctx.guild.get_role(config.role_id)
                 embed.add_field(name=channel, value="`{}`".format(role))
@@ -93,9 +89,9 @@ class Voicebinds(db.DatabaseObject):
     """DB object to keep track of voice to text channel access bindings."""
     __tablename__ = 'voicebinds'
     id = db.Column(db.Integer, primary_key=True)
-    guild_id = db.Column(db.Integer)
-    channel_id = db.Column(db.Integer)
-    role_id = db.Column(db.Integer)
+    guild_id = db.Column(db.BigInteger)
+    channel_id = db.Column(db.BigInteger, index=True, unique=True)
+    role_id = db.Column(db.BigInteger)
 
 
 def setup(bot):
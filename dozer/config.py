@@ -0,0 +1,103 @@
+"""The default configuration, which __main__ updates from config.json and writes back with any new settings"""
+
+
+def default_config():
+    """Returns a fresh copy of the default configuration."""
+    return {
+        'prefix': '&', 'developers': [],
+        'tba': {
+            'key': ''
+        },
+        'toa': {
+            'key': 'Put TOA API key here',
+            'app_name': 'Dozer',
+            'teamdata_url': ''
+        },
+        'log_level': 'INFO',
+        'gateway_events': {
+            'allow': None
+        },
+        'memory': {
+            'max_messages': 5000,
+            'fetch_offline_members': True,
+            'trim_members_minutes': 0
+        },
+        'tracemalloc': {
+            'frames': 1,
+            'snapshot_directory': 'snapshots',
+            'keep_in_memory': 5,
+            'auto_snapshot_rss_mb': 0,
+            'auto_snapshot_step_mb': 100,
+            'check_interval_minutes': 5
+        },
+        'metrics': {
+            'enabled': False,
+            'host': '127.0.0.1',
+            'port': 9590
+        },
+        'logging': {
+            'format': 'text',
+            'discord_level': 'INFO',
+            'dedup_seconds': 60
+        },
+        'db_url': 'sqlite:///dozer.db',
+        'gmaps_key': "PUT GOOGLE MAPS API KEY HERE",
+        'tz_url': '',
+        'discord_token': "Put Discord API Token here.",
+        'is_backup': False,
+        'db_write_batch': {
+            'max_rows': 100,
+            'max_delay_ms': 500
+        },
+        'db_slow_query_ms': 250,
+        'db_settings_cache_entries': 50000,
+        'db_retention': {
+            'interval_hours': 24,
+            'batch_size': 500,
+            'vacuum': True,
+            'tables': {
+                'word_filter_infraction': {'max_age_days': 365},
+                'starboard_messages': {'max_age_days': 365},
+                'missing_members': {'max_age_days': 365},
+                'nicknames': {'max_age_days': 365}
+            }
+        },
+        'db_backup': {
+            'directory': 'backups',
+            'interval_hours': 24,
+            'keep': 7,
+            'pages_per_step': 256
+        },
+        'perf_stats': {
+            'enabled': True,
+            'window_minutes': 60
+        },
+        'lazy_cogs': False,
+        'restart': {
+            'mode': 'exec',
+            'handoff_file': 'handoff.pickle',
+            'timeout_seconds': 120
+        },
+        'rate_limit': {
+            'rate': 1,
+            'per_seconds': 1,
+            'burst': 3,
+            'scope': 'user',
+            'max_keys': 100000
+        },
+        'loop_monitor': {
+            'interval_ms': 250,
+            'stall_threshold_ms': 1000,
+            'history_minutes': 60
+        },
+        'event_capture': {
+            'path': '',
+            'max_events': 1000000
+        },
+        'shards': {
+            'count': 1,
+            'ipc_port': 4590,
+            'ipc_timeout_seconds': 5,
+            'identify_interval_seconds': 5
+        }
+    }
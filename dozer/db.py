@@ -1,12 +1,39 @@
 """Provides database storage for the Dozer Discord bot"""
 
+import asyncio
+import collections
+import contextvars
+import datetime
+import functools
+import glob
+import gzip
+import itertools
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import sqlalchemy
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, ForeignKeyConstraint, DateTime, BigInteger
+import sqlalchemy.exc
+from sqlalchemy import event, Column, Integer, String, Boolean, ForeignKey, ForeignKeyConstraint, DateTime, BigInteger, Index
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, Session, sessionmaker
+from sqlalchemy.orm import relationship, Session, sessionmaker, Query
+
+from .perf import Histogram
+
+__all__ = ['DatabaseObject', 'Session', 'AsyncSession', 'settings_cache', 'write_queue', 'query_stats', 'query_source',
+           'upsert', 'retention_policy', 'retention_policies', 'prune', 'compact', 'backup', 'Column', 'Integer', 'String', 'ForeignKey',
+           'relationship', 'Boolean', 'DateTime', 'BigInteger', 'Index']
+
+logger = logging.getLogger('dozer')
 
-__all__ = ['DatabaseObject', 'Session', 'Column', 'Integer', 'String', 'ForeignKey', 'relationship',
-           'Boolean', 'DateTime', 'BigInteger']
+# The listener or command currently running, set by the bot's dispatch so queries can be attributed to it
+query_source = contextvars.ContextVar('query_source', default=None)
 
 
 class CtxSession(Session):
@@ -29,13 +56,661 @@ class CtxSession(Session):
 
 
 DatabaseObject = None
+engine = None
+_async_session_factory = None
+_executor = None
+
+
+async def run_sync(func, *args, **kwargs):
+    """Runs a blocking database function on the database thread and waits for its result without blocking the event loop."""
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()  # carry query_source over to the database thread
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+class AsyncQuery:
+    """
+    Wraps a Query so that the methods which actually hit the database return awaitables run on the database thread.
+    Every other method (filter_by, order_by, ...) builds the query as normal and returns another AsyncQuery.
+    """
+    _executing = frozenset({'all', 'one', 'one_or_none', 'first', 'get', 'count', 'scalar', 'delete', 'update'})
+
+    def __init__(self, query):
+        self._query = query
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if name in self._executing:
+            return functools.partial(run_sync, attr)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def wrapper(*args, **kwargs):
+            """Keeps the query wrapped while it is being built."""
+            result = attr(*args, **kwargs)
+            return AsyncQuery(result) if isinstance(result, Query) else result
+        return wrapper
+
+
+class AsyncSession:
+    """
+    A session whose database I/O runs on a dedicated database thread instead of the event loop.
+    Usage:
+        async with db.AsyncSession() as session:
+            config = await session.query(Table).filter_by(guild_id=guild.id).one_or_none()
+            session.add(Table(...))
+    Like CtxSession, the session is committed when the block exits normally and rolled back if it raises.
+    add() only stages objects and stays synchronous; anything that may touch the database must be awaited.
+    Objects are not expired on commit, so their loaded attributes stay usable after the block ends.
+    """
+    def __init__(self):
+        self._session = _async_session_factory()
+
+    def query(self, *entities, **kwargs):
+        """Starts an awaitable query."""
+        return AsyncQuery(self._session.query(*entities, **kwargs))
+
+    def add(self, instance):
+        """Stages an object to be inserted on the next flush."""
+        self._session.add(instance)
+
+    def add_all(self, instances):
+        """Stages several objects to be inserted on the next flush."""
+        self._session.add_all(instances)
+
+    async def delete(self, instance):
+        """Marks an object for deletion. Awaitable, since cascades may need to load relationships."""
+        await run_sync(self._session.delete, instance)
+
+    async def merge(self, instance):
+        """Merges an object's state into the session, loading the existing row if there is one."""
+        return await run_sync(self._session.merge, instance)
+
+    async def flush(self):
+        """Flushes pending changes to the database."""
+        await run_sync(self._session.flush)
+
+    async def commit(self):
+        """Commits the current transaction."""
+        await run_sync(self._session.commit)
+
+    async def rollback(self):
+        """Rolls back the current transaction."""
+        await run_sync(self._session.rollback)
+
+    async def run(self, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) on the database thread, e.g. to access lazily-loaded relationships."""
+        return await run_sync(func, *args, **kwargs)
+
+    def _finish(self, commit):
+        try:
+            if commit:
+                self._session.commit()
+            else:
+                self._session.rollback()
+        finally:
+            self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, err_type, err, tb):
+        await run_sync(self._finish, err_type is None)
+        return False
+
+
+class SettingsCache:
+    """
+    Read-through cache for the small per-guild and per-channel configuration rows read by event handlers.
+    Entries are keyed by table and the column values they were looked up by. Missing rows are cached as None, so
+    unconfigured guilds don't hit the database either. Anything that writes to a cached table must call invalidate()
+    with the same lookup columns once its session has committed. Beyond max_entries entries, the least recently used
+    are dropped.
+    Cached rows are detached from their session and must be treated as read-only.
+    """
+    _missing = object()
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        # key -> [lookups running, invalidations since they started], kept only while a lookup of the key is running,
+        # so that lookups that raced a write don't cache the stale row
+        self._in_flight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(table, many, filters):
+        return table.__tablename__, many, tuple(sorted(filters.items()))
+
+    def _start(self, key):
+        in_flight = self._in_flight.setdefault(key, [0, 0])
+        in_flight[0] += 1
+        return in_flight[1]
+
+    def _finish(self, key, version, value):
+        """Caches a looked up value, unless the lookup failed or the key was invalidated while it was running."""
+        in_flight = self._in_flight[key]
+        in_flight[0] -= 1
+        if not in_flight[0]:
+            del self._in_flight[key]
+        if value is not self._missing and in_flight[1] == version:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def _lookup(self, table, many, filters):
+        key = self._key(table, many, filters)
+        value = self._entries.get(key, self._missing)
+        if value is not self._missing:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+        self.misses += 1
+        version = self._start(key)
+        try:
+            async with AsyncSession() as session:
+                query = session.query(table).filter_by(**filters)
+                value = tuple(await query.all()) if many else await query.one_or_none()
+        finally:
+            self._finish(key, version, value)
+        return value
+
+    async def get(self, table, **filters):
+        """Returns the single row of table matching filters, or None if there isn't one."""
+        return await self._lookup(table, False, filters)
+
+    async def get_all(self, table, **filters):
+        """Returns a tuple of all the rows of table matching filters."""
+        return await self._lookup(table, True, filters)
+
+    async def warm(self, table, column, keys, many=False, **filters):
+        """
+        Fills the cache for lookups of table by column for each of keys (and any other fixed filters), using a single
+        query for the whole table rather than one per key. Keys without a matching row are cached as missing.
+        Entries invalidated while the query was running are left alone. Returns the number of rows loaded.
+        """
+        lookups = {key: self._key(table, many, dict(filters, **{column: key})) for key in keys}
+        versions = {key: self._start(cache_key) for key, cache_key in lookups.items()}
+        found = None
+        try:
+            async with AsyncSession() as session:
+                rows = await session.query(table).filter_by(**filters).all()
+            found = collections.defaultdict(list)
+            for row in rows:
+                found[getattr(row, column)].append(row)
+        finally:
+            for key, cache_key in lookups.items():
+                if found is None:
+                    value = self._missing
+                else:
+                    matches = found.get(key, [])
+                    value = tuple(matches) if many else next(iter(matches), None)
+                self._finish(cache_key, versions[key], value)
+        return len(rows)
+
+    def _invalidate_key(self, key):
+        self._entries.pop(key, None)
+        if key in self._in_flight:
+            self._in_flight[key][1] += 1
+
+    def invalidate(self, table, **filters):
+        """Drops the cached results for a lookup, so the next one reads from the database."""
+        for many in (False, True):
+            self._invalidate_key(self._key(table, many, filters))
+
+    def invalidate_guild(self, guild_id):
+        """
+        Drops the cached results of every lookup by a guild's id, such as when the bot leaves the guild. This includes
+        lookups by its default channel or @everyone role, which share the id, but not by its other channels.
+        """
+        keys = {key for key in itertools.chain(self._entries, self._in_flight) if guild_id in (value for _, value in key[2])}
+        for key in keys:
+            self._invalidate_key(key)
+
+    def clear(self):
+        """Drops every cached entry."""
+        self._entries.clear()
+        for in_flight in self._in_flight.values():
+            in_flight[1] += 1
+
+
+settings_cache = SettingsCache()
+
+
+class WriteBehindQueue:
+    """
+    Batches writes that nothing reads back straight away (infraction logs, departing member records, ...) into group
+    commits, flushed once max_rows writes are pending or max_delay seconds after the first one, whichever comes first.
+    Queued objects must not be used afterwards; they belong to the queue until it flushes.
+    If a batch fails, its rows are retried one transaction at a time so a single bad row doesn't lose the rest.
+    """
+    def __init__(self, max_rows=100, max_delay=0.5):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._pending = []
+        self._timer = None
+        self._flushing = None
+
+    def add(self, *instances):
+        """Queues objects to be inserted."""
+        self._queue(('add', instance) for instance in instances)
+
+    def merge(self, *instances):
+        """Queues objects to be merged into their existing rows, e.g. a detached row with modified attributes."""
+        self._queue(('merge', instance) for instance in instances)
+
+    def upsert(self, table, values, **kwargs):
+        """Queues an upsert; takes the same arguments as db.upsert."""
+        self._queue([('upsert', (table, values, kwargs))])
+
+    def _queue(self, writes):
+        self._pending.extend(writes)
+        if len(self._pending) >= self.max_rows:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.max_delay, self._start_flush)
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Writes everything queued so far, waiting for any flush already in progress."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._flushing is not None:
+            await self._flushing
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._flushing = asyncio.ensure_future(run_sync(self._write, batch))
+        try:
+            await self._flushing
+        finally:
+            self._flushing = None
+
+    def flush_blocking(self):
+        """Writes everything queued on the calling thread. For use after the event loop has stopped."""
+        batch, self._pending = self._pending, []
+        if batch:
+            self._write(batch)
+
+    @staticmethod
+    def _write(batch):
+        query_source.set('write queue')
+        try:
+            _commit_writes(batch)
+        except sqlalchemy.exc.SQLAlchemyError:
+            logger.exception('Batched write of %d rows failed, retrying rows individually', len(batch))
+            for write in batch:
+                try:
+                    _commit_writes([write])
+                except sqlalchemy.exc.SQLAlchemyError:
+                    logger.exception('Dropped queued write %r', write)
+
+
+def _commit_writes(writes):
+    session = _async_session_factory()
+    try:
+        for kind, arg in writes:
+            if kind == 'add':
+                session.add(arg)
+            elif kind == 'merge':
+                session.merge(arg)
+            else:
+                table, values, kwargs = arg
+                _upsert(session, table, values, **kwargs)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+write_queue = WriteBehindQueue()
+
+
+_upsert_dialects = {'sqlite': sqlite, 'postgresql': postgresql}
+# Dialects whose ON CONFLICT statements can also return the written row
+_returning_dialects = {'postgresql'}
+
+
+def _upsert(session, table, values, *, update=None, where=None, conflict=None, returning=None):
+    conflict = conflict or [column.name for column in table.__table__.primary_key]
+    if update is None:
+        update = [name for name in values if name not in conflict]
+    result = _write_upsert(session, table, values, update=update, where=where, conflict=conflict, returning=returning)
+    if not returning or not isinstance(result, int):
+        return result
+    # Read the row back in the same transaction, so nothing else can change it in between
+    return session.query(*returning).filter_by(**{name: values[name] for name in conflict}).one()
+
+
+def _write_upsert(session, table, values, *, update, where, conflict, returning):
+
+    dialect = _upsert_dialects.get(session.bind.dialect.name)
+    if dialect is not None:
+        statement = dialect.insert(table.__table__).values(**values)
+        if isinstance(update, dict):
+            set_ = update
+        else:
+            set_ = {name: statement.excluded[name] for name in update}
+        if set_:
+            statement = statement.on_conflict_do_update(index_elements=conflict, set_=set_, where=where)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=conflict)
+        if returning and session.bind.dialect.name in _returning_dialects:
+            row = session.execute(statement.returning(*returning)).first()
+            if row is not None:
+                return row
+            return 0  # the conflicting row was left alone, so read it back instead
+        return session.execute(statement).rowcount
+
+    # No single-statement upsert here, so lock the existing row (where supported) and fall back to a read then a write
+    query = session.query(table).filter_by(**{name: values[name] for name in conflict})
+    if query.with_for_update().first() is None:
+        session.add(table(**values))
+        session.flush()
+        return 1
+    if not update:
+        return 0
+    if where is not None:
+        query = query.filter(where)
+    if not isinstance(update, dict):
+        update = {name: values[name] for name in update}
+    return query.update(update, synchronize_session=False)
+
+
+def _run_upsert(table, values, **kwargs):
+    session = _async_session_factory()
+    try:
+        count = _upsert(session, table, values, **kwargs)
+        session.commit()
+        return count
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+async def upsert(table, values, *, update=None, where=None, conflict=None, returning=None):
+    """
+    Inserts a row, or updates the row it conflicts with, in one statement and transaction.
+    values maps column names to the row's values. conflict lists the columns of the unique constraint to check, and
+    defaults to the primary key. update is either a list of columns to overwrite with the new values (all the other
+    columns in values by default), or a dict mapping columns to expressions over the existing row, e.g.
+    {'wins': Table.wins + 1}; if it's empty, conflicting rows are left alone. where restricts which existing rows are
+    updated. Returns the number of rows written, which is 0 if a conflicting row was left alone.
+    If returning lists columns, the row's values for them after the write are returned instead, e.g.
+    wins, = await db.upsert(..., returning=[Table.wins]); PostgreSQL gets them from the statement's RETURNING clause,
+    other databases read them back in the same transaction.
+    SQLite (3.24+) and PostgreSQL use INSERT ... ON CONFLICT; other databases fall back to a locked read and a write.
+    """
+    return await run_sync(_run_upsert, table, values, update=update, where=where, conflict=conflict,
+                          returning=returning)
+
+
+# table name -> (table, function returning the criterion for rows older than a given datetime)
+retention_policies = {}
+
+
+def retention_policy(table):
+    """Registers a function that takes a cutoff datetime and returns a filter criterion selecting the rows of table
+    older than it, so the retention job can prune the table."""
+    def decorator(func):
+        """Adds the policy to the registry"""
+        retention_policies[table.__tablename__] = (table, func)
+        return func
+    return decorator
+
+
+async def prune(table, criterion, batch_size=500):
+    """
+    Deletes the rows of table matching criterion, batch_size rows per transaction so that other queries can run in
+    between batches. Rows are deleted through the ORM so relationship cascades apply. Returns the number of rows deleted.
+    """
+    deleted = 0
+    while True:
+        async with AsyncSession() as session:
+            rows = await session.query(table).filter(criterion).limit(batch_size).all()
+            for row in rows:
+                await session.delete(row)
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+
+
+def _compact():
+    path = engine.url.database
+    size_before = os.path.getsize(path) if path and os.path.isfile(path) else None
+    with engine.connect() as conn:
+        conn.execute('VACUUM')
+        conn.execute('ANALYZE')
+    if size_before is None:
+        return None
+    return max(0, size_before - os.path.getsize(path))  # ANALYZE's statistics can outweigh what VACUUM frees
+
+
+async def compact():
+    """
+    Runs VACUUM and ANALYZE on SQLite databases to give space freed by deletes back to the filesystem and refresh the
+    query planner's statistics. Other queries wait while this runs. Returns the number of bytes reclaimed, if known.
+    Other databases are left to their own autovacuum.
+    """
+    if engine.dialect.name != 'sqlite':
+        return None
+    return await run_sync(_compact)
+
+
+def _backup(source_path, directory, name, keep, pages):
+    snapshot_path = os.path.join(directory, f"{name}-{datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.db.gz")
+    temp_path = snapshot_path + '.tmp'
+
+    def pause(status, remaining, total):  # pylint: disable=unused-argument
+        """Called after each step; sleeping here lets writers in before the next step takes the read lock again."""
+        if remaining:
+            time.sleep(0.05)
+
+    try:
+        # A connection of our own, so the database thread keeps serving queries while pages are copied
+        source = sqlite3.connect(source_path)
+        try:
+            target = sqlite3.connect(temp_path)
+            try:
+                # Copy a few pages at a time, so writers only ever wait for one small step
+                source.backup(target, pages=pages, progress=pause)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+        with open(temp_path, 'rb') as raw, gzip.open(snapshot_path, 'wb') as compressed:
+            shutil.copyfileobj(raw, compressed)
+    except BaseException:
+        # Don't leave a partial snapshot behind for the rotation below to count as a good one
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+        raise
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # Timestamped names sort chronologically
+    pattern = os.path.join(glob.escape(directory), glob.escape(name) + '-' + '[0-9]' * 8 + '-' + '[0-9]' * 6 + '.db.gz')
+    snapshots = sorted(glob.glob(pattern))
+    for old in snapshots[:len(snapshots) - keep]:
+        os.remove(old)
+    return snapshot_path, os.path.getsize(snapshot_path)
+
+
+async def backup(directory, keep=7, pages=256):
+    """
+    Writes a gzip-compressed snapshot of a SQLite database to directory as <name>-<YYYYmmdd>-<HHMMSS>.db.gz using
+    SQLite's online backup API, then deletes all but the newest keep snapshots (at least 1). The copy runs on a worker
+    thread pages at a time with a short pause between steps, so neither the event loop nor the database thread is held
+    while it runs, and writers get in between steps.
+    Returns the snapshot's path and size in bytes.
+    """
+    if keep < 1:
+        raise ValueError('keep must be at least 1, or the new snapshot would be deleted')
+    source_path = engine.url.database
+    if engine.dialect.name != 'sqlite' or not source_path or source_path == ':memory:':
+        raise RuntimeError('online backups are only supported for SQLite database files')
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    return await asyncio.get_event_loop().run_in_executor(None, _backup, source_path, directory, name, keep, pages)
+
+
+class StatementStats:
+    """Timings for one SQL statement. Percentiles are computed over the most recent samples only."""
+    def __init__(self, statement, samples):
+        self.statement = statement
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.rows = 0
+        self.sources = collections.Counter()  # source -> total time
+        self._samples = collections.deque(maxlen=samples)
+
+    def record(self, source, duration, rows, error=False):
+        """Adds one execution of the statement."""
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        if rows > 0:
+            self.rows += rows
+        self.sources[source] += duration
+        self._samples.append(duration)
+
+    def percentile(self, pct):
+        """Returns the given percentile (0-100) of the recent execution times, in seconds."""
+        samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        return samples[round((len(samples) - 1) * pct / 100)]
+
+
+# Bound parameter lists, which SQLAlchemy expands to one placeholder per value: IN (?, ?, ?) or IN (%(id_1_1)s, ...)
+IN_LIST = re.compile(r'\bIN \((?:\s*(?:\?|%\(\w+\)s|:\w+|\$\d+)\s*,)*\s*(?:\?|%\(\w+\)s|:\w+|\$\d+)\s*\)', re.IGNORECASE)
+OTHER_STATEMENTS = '(other statements)'
+
+
+def normalize_statement(statement):
+    """Collapses the parts of a statement that vary with its parameters, so that each query is recorded once."""
+    return IN_LIST.sub('IN (...)', statement)
+
+
+class QueryStats:
+    """
+    Per-statement latency, row and error counts for every query the engine runs, along with the listener or command
+    (from query_source) that issued it. Row counts are what the driver reports, which excludes most SELECTs.
+    Statements are grouped after collapsing IN lists; past max_statements distinct statements, new ones are counted
+    together as OTHER_STATEMENTS. Statements slower than slow_threshold seconds, whether they succeeded or not, are
+    also logged as warnings. A latency histogram is also kept for each source. Recording happens on the database
+    thread while reports are read from the event loop, so access is locked.
+    """
+    def __init__(self, samples=1000, slow_threshold=None, max_statements=1000):
+        self.samples = samples
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements
+        self._statements = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def record(self, statement, source, duration, rows, error=False):
+        """Records one execution of a statement, or a failed attempt at one if error is set."""
+        statement = normalize_statement(statement)
+        with self._lock:
+            stats = self._statements.get(statement)
+            if stats is None:
+                if len(self._statements) >= self.max_statements:
+                    statement = OTHER_STATEMENTS
+                stats = self._statements.get(statement)
+                if stats is None:
+                    stats = self._statements[statement] = StatementStats(statement, self.samples)
+            stats.record(source, duration, rows, error)
+            histogram = self._sources.get(source)
+            if histogram is None:
+                histogram = self._sources[source] = Histogram()
+            histogram.record(duration, error)
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            logger.warning('Slow query (%.1f ms%s) from %s: %s', duration * 1000, ', failed' if error else '',
+                           source or 'unknown source', ' '.join(statement.split()))
+
+    def top(self, count=10):
+        """Returns the StatementStats with the highest total time, highest first."""
+        with self._lock:
+            return sorted(self._statements.values(), key=lambda stats: stats.total_time, reverse=True)[:count]
+
+    def by_source(self):
+        """Returns a copy of the latency histogram of each source's queries, as a dict of source -> Histogram."""
+        with self._lock:
+            copies = {}
+            for source, histogram in self._sources.items():
+                copies[source] = Histogram()
+                copies[source].merge(histogram)
+            return copies
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self._lock:
+            self._statements.clear()
+            self._sources.clear()
+
+
+query_stats = QueryStats()
+
+
+def _before_cursor_execute(conn, *_):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, *_):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    query_stats.record(statement, query_source.get(), duration, cursor.rowcount)
+
+
+def _handle_error(context):
+    # after_cursor_execute doesn't run for statements that raise, so their start time is popped here instead.
+    # Errors raised before the statement reached the cursor never pushed one.
+    conn = context.connection
+    if conn is None or not conn.info.get('query_start_time') or context.statement is None:
+        return
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    query_stats.record(context.statement, query_source.get(), duration, 0, error=True)
 
 
-def db_init(db_url):
+def db_init(db_url, write_batch_rows=100, write_batch_delay=0.5, slow_query_threshold=None, settings_cache_entries=50000):
     """Initializes the database connection"""
     global Session
     global DatabaseObject
+    global engine
+    global _async_session_factory
+    global _executor
     engine = sqlalchemy.create_engine(db_url)
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    query_stats.slow_threshold = slow_query_threshold
     DatabaseObject = declarative_base(bind=engine, name='DatabaseObject')
     DatabaseObject.__table_args__ = {'extend_existing': True}  # allow use of the reload command with db cogs
     Session = sessionmaker(bind=engine, class_=CtxSession)
+    _async_session_factory = sessionmaker(bind=engine, class_=CtxSession, expire_on_commit=False)
+    # A single worker serializes database access, which SQLite needs anyway, and keeps each connection on one thread
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dozer-db')
+    settings_cache.max_entries = settings_cache_entries
+    write_queue.max_rows = write_batch_rows
+    write_queue.max_delay = write_batch_delay
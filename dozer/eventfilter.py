@@ -0,0 +1,42 @@
+"""Skips parsing gateway events the bot doesn't use, such as presence updates and typing notifications"""
+
+import collections
+import logging
+
+__all__ = ['EventFilter', 'REQUIRED_EVENTS']
+
+logger = logging.getLogger('dozer')
+
+# Events that keep discord.py's guild, channel, role and member caches structurally correct; these are always parsed
+REQUIRED_EVENTS = frozenset({
+    'READY', 'RESUMED', 'GUILD_CREATE', 'GUILD_UPDATE', 'GUILD_DELETE', 'GUILD_SYNC', 'GUILD_MEMBERS_CHUNK',
+    'GUILD_MEMBER_ADD', 'GUILD_MEMBER_REMOVE', 'GUILD_MEMBER_UPDATE', 'GUILD_ROLE_CREATE', 'GUILD_ROLE_UPDATE',
+    'GUILD_ROLE_DELETE', 'CHANNEL_CREATE', 'CHANNEL_UPDATE', 'CHANNEL_DELETE', 'GUILD_EMOJIS_UPDATE', 'USER_UPDATE',
+})
+
+
+class EventFilter:
+    """
+    An allow-list of gateway events. The parsers of every other event in discord.py's connection state are replaced
+    with one that only counts the event, so it isn't turned into objects, doesn't update the caches and isn't
+    dispatched to any listener. The gateway looks parsers up in the same dict, so this takes effect right after the
+    payload is decoded.
+    """
+    def __init__(self, allowed):
+        self.allowed = frozenset(allowed) | REQUIRED_EVENTS
+        self.skipped = collections.Counter()
+
+    def install(self, state):
+        """Replaces the parsers of the events that aren't allowed in a discord.py ConnectionState."""
+        unknown = self.allowed - REQUIRED_EVENTS - set(state.parsers)
+        if unknown:
+            logger.warning('Allowed gateway events that discord.py has no parser for: %s', ', '.join(sorted(unknown)))
+        skipped = sorted(event for event in state.parsers if event not in self.allowed)
+        for event in skipped:
+            state.parsers[event] = self._skipper(event)
+        logger.info('Skipping gateway events: %s', ', '.join(skipped) or 'none')
+
+    def _skipper(self, event):
+        def skip(_data):
+            self.skipped[event] += 1
+        return skip
@@ -0,0 +1,227 @@
+"""Loads the bot's extensions, optionally deferring each one until it is first used"""
+
+import ast
+import asyncio
+import importlib
+import inspect
+import logging
+import os
+import re
+import sys
+import time
+
+from . import db
+from . import migrations
+from .cogs._utils import command
+
+__all__ = ['ExtensionManifest', 'ExtensionLoader', 'import_profile']
+
+logger = logging.getLogger('dozer')
+
+# Calls in a cog's __init__ that mean it has to be running from startup: message pipeline stages and background tasks
+EAGER_CALLS = {'add_stage', 'create_task'}
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except (ValueError, TypeError, SyntaxError):
+        return None
+
+
+def _decorator_call(function):
+    """Returns the @command(...) or @group(...) decorator of a function, if it has one"""
+    for decorator in function.decorator_list:
+        if isinstance(decorator, ast.Call) and isinstance(decorator.func, ast.Name) and decorator.func.id in ('command', 'group'):
+            return decorator
+    return None
+
+
+def _stub_signature(function):
+    """Rebuilds a command callback's parameters (minus self and ctx) without annotations, for help and argument parsing"""
+    args = function.args
+    positional = args.args[2:]
+    defaults = [None] * (len(positional) - len(args.defaults)) + list(args.defaults)
+    parameters = [inspect.Parameter('ctx', inspect.Parameter.POSITIONAL_OR_KEYWORD)]
+    for arg, default in zip(positional, defaults):
+        parameters.append(inspect.Parameter(arg.arg, inspect.Parameter.POSITIONAL_OR_KEYWORD,
+                                            default=inspect.Parameter.empty if default is None else _literal(default)))
+    if args.vararg is not None:
+        parameters.append(inspect.Parameter(args.vararg.arg, inspect.Parameter.VAR_POSITIONAL))
+    for arg, default in zip(args.kwonlyargs, args.kw_defaults):
+        parameters.append(inspect.Parameter(arg.arg, inspect.Parameter.KEYWORD_ONLY,
+                                            default=inspect.Parameter.empty if default is None else _literal(default)))
+    return inspect.Signature(parameters)
+
+
+class ExtensionManifest:
+    """
+    What an extension provides, read from its source without importing it: its top-level commands (with their
+    help and example usage), the events its cogs listen to, the database tables it defines, and whether a cog has to
+    be loaded from startup.
+    """
+    def __init__(self, extension, path):
+        self.extension = extension
+        self.commands = {}  # method name -> [command name, aliases, hidden, help, example usage, signature]
+        self.listeners = set()
+        self.tables = set()
+        self.eager = False
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read(), path)
+        for cls in tree.body:
+            if not isinstance(cls, ast.ClassDef):
+                continue
+            if any(isinstance(base, ast.Name) and base.id == 'Cog' for base in cls.bases):
+                self._read_cog(cls)
+            for node in cls.body:
+                if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == '__tablename__'
+                                                        for target in node.targets):
+                    self.tables.add(_literal(node.value))
+
+    def _read_cog(self, cls):
+        for node in cls.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                if node.name == '__init__':
+                    calls = {call.func.attr for call in ast.walk(node) if isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)}
+                    self.eager = self.eager or bool(calls & EAGER_CALLS)
+                elif node.name.startswith('on_'):
+                    self.listeners.add(node.name)
+                decorator = _decorator_call(node)
+                if decorator is not None:
+                    options = {keyword.arg: _literal(keyword.value) for keyword in decorator.keywords}
+                    self.commands[node.name] = [options.get('name') or node.name, options.get('aliases') or [], bool(options.get('hidden')),
+                                                ast.get_docstring(node), None, _stub_signature(node)]
+            elif isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Attribute):
+                target = node.targets[0]
+                if target.attr == 'example_usage' and isinstance(target.value, ast.Name) and target.value.id in self.commands:
+                    self.commands[target.value.id][4] = _literal(node.value)
+
+
+class ExtensionLoader:
+    """
+    Loads extensions. When lazy, an extension whose cogs don't need to run from startup isn't imported when it is
+    added; instead, stub commands (with the real commands' names, help and parameters) and listeners are registered
+    from its manifest. The first time one of them is used, the extension is imported on a worker thread, its stubs
+    are replaced with the real cogs, its tables are created, and the command or event is passed on to it.
+    """
+    def __init__(self, bot, lazy=False):
+        self.bot = bot
+        self.lazy = lazy
+        self.load_times = {}  # extension -> (seconds, what caused it to be loaded)
+        self._pending = {}  # extension -> (manifest, stub commands, stub listeners)
+        self._locks = {}
+
+    @property
+    def pending(self):
+        """The extensions that haven't been loaded yet."""
+        return list(self._pending)
+
+    @property
+    def pending_tables(self):
+        """The database tables defined by the extensions that haven't been loaded yet."""
+        return {table for manifest, _, _ in self._pending.values() for table in manifest.tables}
+
+    def add(self, extension):
+        """Loads an extension, or registers its stubs if it can be loaded lazily."""
+        path = os.path.join(os.path.dirname(__file__), *extension.split('.')[1:]) + '.py'
+        manifest = ExtensionManifest(extension, path) if self.lazy else None
+        if manifest is None or manifest.eager:
+            start = time.perf_counter()
+            self.bot.load_extension(extension)
+            self.load_times[extension] = (time.perf_counter() - start, 'startup')
+            return
+        stub_commands = [self._stub_command(extension, details) for details in manifest.commands.values()]
+        stub_listeners = [(event, self._stub_listener(extension, event)) for event in manifest.listeners]
+        self._register_stubs(stub_commands, stub_listeners)
+        self._pending[extension] = (manifest, stub_commands, stub_listeners)
+
+    def _register_stubs(self, stub_commands, stub_listeners):
+        for stub in stub_commands:
+            self.bot.add_command(stub)
+        for event, listener in stub_listeners:
+            self.bot.add_listener(listener, event)
+
+    def _stub_command(self, extension, details):
+        name, aliases, hidden, help_text, example_usage, signature = details
+
+        async def stub(ctx, *_args, **_kwargs):
+            await self.load(extension, 'command ' + name)
+            await self.bot.invoke(await self.bot.get_context(ctx.message))
+        stub.__signature__ = signature
+        stub_command = command(name=name, aliases=aliases, hidden=hidden, help=help_text)(stub)
+        if example_usage:
+            stub_command.example_usage = example_usage
+        return stub_command
+
+    def _stub_listener(self, extension, event):
+        async def stub(*args, **kwargs):
+            await self.load(extension, event)
+            for cog in list(self.bot.cogs.values()):
+                if type(cog).__module__ == extension and hasattr(cog, event):
+                    await getattr(cog, event)(*args, **kwargs)
+        stub.__name__ = event
+        return stub
+
+    async def load(self, extension, reason):
+        """Replaces an extension's stubs with the extension itself, if it hasn't been loaded yet."""
+        lock = self._locks.setdefault(extension, asyncio.Lock())
+        async with lock:
+            if extension not in self._pending:
+                return
+            _, stub_commands, stub_listeners = self._pending[extension]
+            start = time.perf_counter()
+            # Import on a worker thread so that slow imports don't block the event loop; load_extension reuses the module
+            await self.bot.loop.run_in_executor(None, importlib.import_module, extension)
+            for stub in stub_commands:
+                self.bot.remove_command(stub.name)
+            for event, listener in stub_listeners:
+                self.bot.remove_listener(listener, event)
+            try:
+                self.bot.load_extension(extension)
+            except Exception:
+                self._register_stubs(stub_commands, stub_listeners)
+                raise
+            del self._pending[extension]
+            await db.run_sync(migrations.ensure_tables, db.engine)
+            if self.bot.is_ready():
+                await asyncio.gather(*(cog.warm_up(self.bot.guilds) for cog in self.bot.cogs.values()
+                                       if type(cog).__module__ == extension and hasattr(cog, 'warm_up')))
+            self.load_times[extension] = (time.perf_counter() - start, reason)
+            logger.info('Loaded extension %s on first use by %s in %.0f ms', extension, reason, (time.perf_counter() - start) * 1000)
+
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+async def import_profile(extension):
+    """
+    Imports an extension in a fresh interpreter with -X importtime, and returns its cumulative import time and the
+    cumulative times of the modules it imported directly, in microseconds, slowest first. Modules that the dozer
+    package had already imported aren't included.
+    """
+    process = await asyncio.create_subprocess_exec(sys.executable, '-X', 'importtime', '-c', 'import dozer, ' + extension,
+                                                   stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    _, stderr = await process.communicate()
+    if process.returncode:
+        error = stderr.decode(errors='replace').strip().splitlines()
+        reason = error[-1] if error else f'exit status {process.returncode}'
+        raise RuntimeError(f'Importing {extension} failed: {reason}')
+    lines = []
+    for line in stderr.decode(errors='replace').splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is not None:
+            lines.append((match.group(4), int(match.group(2)), len(match.group(3))))
+    total = 0
+    extension_depth = 0
+    children = []
+    # Modules are listed when they finish importing, so the extension's imports come right before it
+    for name, cumulative, depth in reversed(lines):
+        if name == extension:
+            total, extension_depth = cumulative, depth
+        elif total:
+            if depth <= extension_depth:
+                break
+            if depth == extension_depth + 2:
+                children.append((name, cumulative))
+    return total, sorted(children, key=lambda child: child[1], reverse=True)
@@ -0,0 +1,530 @@
+"""
+A fake Discord for load testing the bot without touching the real one.
+Serves enough of the gateway and REST API for the bot to log in and receive a set of synthetic guilds and members,
+then sends it MESSAGE_CREATE, MESSAGE_REACTION_ADD, VOICE_STATE_UPDATE and GUILD_MEMBER_ADD events at the configured
+rates. REST calls are answered after a simulated latency and rate limited per route bucket the way Discord does,
+answering with 429s once a bucket is used up. Event throughput, command response latency and REST requests per route
+are reported as JSON, at /_fake/stats while running and when the run ends.
+
+Usage: python -m dozer.fakegateway [--port PORT] [--guilds N] [--members N] [--message-rate N] [--reaction-rate N]
+       [--voice-rate N] [--join-rate N] [--rest-latency-ms N] [--bucket-size N] [--bucket-seconds N] [--duration S]
+Then start the bot, or the shard launcher, with DOZER_API_BASE=http://127.0.0.1:PORT/api/v7 in its environment.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import logging
+import math
+import random
+import re
+import signal
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+from .benchmark import DISCORD_EPOCH, sentence, snowflake
+from .perf import Histogram
+
+logger = logging.getLogger('dozer')
+
+HEARTBEAT_INTERVAL_MS = 41250
+LARGE_THRESHOLD = 250
+MEMBER_CHUNK_SIZE = 1000
+RECENT_MESSAGES = 200  # per guild, for reactions to target
+STORED_MESSAGES = 100000  # for GET requests of single messages
+REACTION_EMOJI = ['\N{WHITE MEDIUM STAR}', '\N{THUMBS UP SIGN}', '\N{FACE WITH TEARS OF JOY}', '\N{EYES}']
+EVERYONE_PERMISSIONS = 104324673
+ADMINISTRATOR = 8
+# Path segments after which an id is part of the rate limit bucket, like Discord's major parameters
+MAJOR_PARAMETERS = {'channels', 'guilds', 'webhooks'}
+SNOWFLAKE_SEGMENT = re.compile(r'^\d{15,21}$')
+
+
+def timestamp():
+    """Returns the current time in the format Discord uses."""
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class FakeGuild:
+    """A synthetic guild: its roles, text and voice channels and members, as gateway payloads."""
+    def __init__(self, fake, index, members):
+        self.id = snowflake(fake.rng)  # created at random times, so that they are spread over the shards
+        self.name = f'Load test guild {index}'
+        self.roles = [{'id': str(self.id), 'name': '@everyone', 'permissions': EVERYONE_PERMISSIONS, 'position': 0}]
+        for position, name in enumerate(('Mentor', 'Student', 'Alumni', 'Dozer'), 1):
+            self.roles.append({'id': str(fake.snowflake()), 'name': name, 'position': position,
+                               'permissions': ADMINISTRATOR if name == 'Dozer' else EVERYONE_PERMISSIONS})
+        for role in self.roles:
+            role.update({'color': 0, 'hoist': False, 'managed': False, 'mentionable': True})
+        self.text_channels = [fake.snowflake() for _ in range(8)]
+        self.voice_channels = [fake.snowflake() for _ in range(2)]
+        self.members = collections.OrderedDict()  # user id -> member payload
+        self.member_ids = []
+        self.members[fake.user['id']] = self.member(fake.user, [self.roles[-1]['id']])
+        for _ in range(members):
+            self.add_member(fake.new_user(), fake.rng)
+        self.recent_messages = collections.deque(maxlen=RECENT_MESSAGES)  # (channel id, message id)
+
+    @staticmethod
+    def member(user, roles):
+        """Returns the payload of a member with the given user and role ids."""
+        return {'user': user, 'nick': None, 'roles': roles, 'joined_at': timestamp(), 'deaf': False, 'mute': False}
+
+    def add_member(self, user, rng):
+        """Adds a member with a random role, returning its payload."""
+        member = self.member(user, [rng.choice(self.roles[1:-1])['id']] if rng.random() < 0.5 else [])
+        self.members[user['id']] = member
+        self.member_ids.append(user['id'])
+        return member
+
+    @property
+    def large(self):
+        """Whether Discord would consider the guild large, and leave its offline members out of GUILD_CREATE."""
+        return len(self.members) > LARGE_THRESHOLD
+
+    def channel_payloads(self):
+        """Returns the guild's channels as gateway payloads."""
+        channels = []
+        for position, channel_id in enumerate(self.text_channels):
+            channels.append({'id': str(channel_id), 'type': 0, 'name': f'text-{position}', 'position': position,
+                             'permission_overwrites': [], 'topic': None, 'nsfw': False, 'parent_id': None,
+                             'last_message_id': None, 'rate_limit_per_user': 0})
+        for position, channel_id in enumerate(self.voice_channels):
+            channels.append({'id': str(channel_id), 'type': 2, 'name': f'Voice {position}', 'position': position,
+                             'permission_overwrites': [], 'parent_id': None, 'bitrate': 64000, 'user_limit': 0})
+        return channels
+
+    def create_payload(self, bot_user_id):
+        """Returns the GUILD_CREATE payload. Like Discord, large guilds only include the bot's own member."""
+        if self.large:
+            members = [self.members[bot_user_id]]
+        else:
+            members = list(self.members.values())
+        return {'id': str(self.id), 'name': self.name, 'icon': None, 'splash': None, 'owner_id': self.member_ids[0],
+                'region': 'us-east', 'afk_channel_id': None, 'afk_timeout': 300, 'verification_level': 0,
+                'default_message_notifications': 0, 'explicit_content_filter': 0, 'roles': self.roles, 'emojis': [],
+                'features': [], 'mfa_level': 0, 'application_id': None, 'system_channel_id': None, 'joined_at': timestamp(),
+                'large': self.large, 'unavailable': False, 'member_count': len(self.members), 'voice_states': [],
+                'members': members, 'channels': self.channel_payloads(), 'presences': []}
+
+
+class GatewayConnection:
+    """One shard's websocket connection."""
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.sequence = 0
+        self.shard_id = 0
+        self.shard_count = 1
+
+    async def send(self, op, data, event=None):
+        """Sends a gateway payload; dispatched events (op 0) get the next sequence number."""
+        payload = {'op': op, 'd': data}
+        if op == 0:
+            self.sequence += 1
+            payload.update(s=self.sequence, t=event)
+        await self.websocket.send_str(json.dumps(payload))
+
+    async def dispatch(self, event, data):
+        """Sends an event."""
+        await self.send(0, data, event)
+
+
+class FakeDiscord:
+    """The fake gateway and REST API, the synthetic traffic they send and the statistics they keep."""
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self._sequence = itertools.count()
+        self.user = {'id': str(self.snowflake()), 'username': 'Dozer', 'discriminator': '0000', 'avatar': None, 'bot': True,
+                     'verified': True, 'email': None, 'mfa_enabled': False}
+        self.owner = self.new_user()
+        self.guilds = [FakeGuild(self, index, max(1, args.members)) for index in range(args.guilds)]
+        self.guilds_by_id = {str(guild.id): guild for guild in self.guilds}
+        self.rates = {'MESSAGE_CREATE': args.message_rate, 'MESSAGE_REACTION_ADD': args.reaction_rate,
+                      'VOICE_STATE_UPDATE': args.voice_rate, 'GUILD_MEMBER_ADD': args.join_rate}
+        self.commands = [command for command in args.commands.split(',') if command]
+        self.connections = {}  # shard id -> ready connection
+        self.messages = collections.OrderedDict()  # message id -> payload
+        self.buckets = {}  # rate limit bucket -> [remaining requests, reset timestamp]
+        self.pending_commands = collections.defaultdict(collections.deque)  # channel id -> times commands were sent
+        self.started = None
+        self.events = collections.Counter()
+        self.dropped_events = 0
+        self.command_latency = Histogram()
+        self.rest_requests = collections.Counter()
+        self.rest_rate_limited = collections.Counter()
+        self.rest_latency = Histogram()
+
+    def snowflake(self):
+        """Returns a new unique snowflake for the current time."""
+        return (int(time.time() * 1000) - DISCORD_EPOCH) << 22 | next(self._sequence) % (1 << 22)
+
+    def new_user(self):
+        """Returns the payload of a new synthetic user."""
+        user_id = snowflake(self.rng)
+        return {'id': str(user_id), 'username': f'user{user_id % 100000}', 'discriminator': f'{user_id % 10000:04d}',
+                'avatar': None, 'bot': False}
+
+    def url(self, scheme):
+        """Returns the base URL of the fake server."""
+        return f'{scheme}://{self.args.host}:{self.args.port}'
+
+    # Gateway
+
+    async def gateway(self, request):
+        """Handles a shard's websocket connection."""
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        connection = GatewayConnection(websocket)
+        await connection.send(10, {'heartbeat_interval': HEARTBEAT_INTERVAL_MS, '_trace': ['fake-gateway']})
+        try:
+            async for message in websocket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                payload = json.loads(message.data)
+                if payload['op'] == 1:  # heartbeat
+                    await connection.send(11, None)
+                elif payload['op'] == 2:
+                    await self.identify(connection, payload['d'])
+                elif payload['op'] == 6:  # sessions aren't kept, so the client has to identify again
+                    await connection.send(9, False)
+                elif payload['op'] == 8:
+                    await self.request_members(connection, payload['d'])
+        finally:
+            if self.connections.get(connection.shard_id) is connection:
+                del self.connections[connection.shard_id]
+        return websocket
+
+    def shard_guilds(self, shard_id, shard_count):
+        """Returns the guilds that belong to a shard, by Discord's formula."""
+        return [guild for guild in self.guilds if (guild.id >> 22) % shard_count == shard_id]
+
+    async def identify(self, connection, data):
+        """Sends READY and a GUILD_CREATE for each of the shard's guilds."""
+        connection.shard_id, connection.shard_count = data.get('shard') or (0, 1)
+        guilds = self.shard_guilds(connection.shard_id, connection.shard_count)
+        await connection.dispatch('READY', {'v': 6, 'user': self.user, 'private_channels': [], 'relationships': [],
+                                            'guilds': [{'id': str(guild.id), 'unavailable': True} for guild in guilds],
+                                            'session_id': uuid.uuid4().hex, 'shard': [connection.shard_id, connection.shard_count],
+                                            '_trace': ['fake-gateway']})
+        for guild in guilds:
+            await connection.dispatch('GUILD_CREATE', guild.create_payload(self.user['id']))
+        self.connections[connection.shard_id] = connection
+        if self.started is None:
+            self.started = time.monotonic()
+        logger.info('Shard %d/%d identified, sent %d guilds', connection.shard_id, connection.shard_count, len(guilds))
+
+    async def request_members(self, connection, data):
+        """Sends the members of the requested guilds, in chunks like Discord."""
+        guild_ids = data['guild_id'] if isinstance(data['guild_id'], list) else [data['guild_id']]
+        for guild_id in guild_ids:
+            guild = self.guilds_by_id.get(str(guild_id))
+            if guild is None:
+                continue
+            members = list(guild.members.values())
+            for start in range(0, len(members), MEMBER_CHUNK_SIZE):
+                await connection.dispatch('GUILD_MEMBERS_CHUNK', {'guild_id': str(guild.id), 'members': members[start:start + MEMBER_CHUNK_SIZE]})
+
+    # Synthetic traffic
+
+    async def generate(self):
+        """Sends each kind of event at its configured rate, spread over the guilds of every connected shard."""
+        while self.started is None:
+            await asyncio.sleep(0.1)
+        sent = dict.fromkeys(self.rates, 0)
+        while True:
+            await asyncio.sleep(0.01)
+            elapsed = time.monotonic() - self.started
+            for event, rate in self.rates.items():
+                due = int(elapsed * rate) - sent[event]
+                sent[event] += due
+                for _ in range(due):
+                    await self.send_event(event)
+
+    async def send_event(self, event):
+        """Sends one synthetic event for a random guild, if the shard it belongs to is connected."""
+        guild = self.rng.choice(self.guilds)
+        shard_count = next(iter(self.connections.values())).shard_count if self.connections else 1
+        connection = self.connections.get((guild.id >> 22) % shard_count)
+        if connection is None:
+            self.dropped_events += 1
+            return
+        data = getattr(self, event.lower())(guild)
+        if data is None:
+            self.dropped_events += 1
+            return
+        try:
+            await connection.dispatch(event, data)
+        except (ConnectionError, RuntimeError):
+            self.dropped_events += 1
+            return
+        self.events[event] += 1
+
+    def message_payload(self, guild, channel_id, member, content, mentions=()):
+        """Returns a message payload and remembers it for GET requests and reactions."""
+        message = {'id': str(self.snowflake()), 'channel_id': str(channel_id), 'guild_id': str(guild.id),
+                   'author': member['user'], 'content': content, 'timestamp': timestamp(), 'edited_timestamp': None,
+                   'tts': False, 'mention_everyone': False, 'mentions': [mention['user'] for mention in mentions],
+                   'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0}
+        if member is not None:
+            message['member'] = {key: value for key, value in member.items() if key != 'user'}
+        self.store_message(message)
+        return message
+
+    def store_message(self, message):
+        """Keeps a message for GET requests, forgetting the oldest beyond STORED_MESSAGES."""
+        self.messages[message['id']] = message
+        if len(self.messages) > STORED_MESSAGES:
+            self.messages.popitem(last=False)
+
+    def message_create(self, guild):
+        """A message from a random member: a command, text mentioning another member, or plain text."""
+        channel_id = self.rng.choice(guild.text_channels)
+        member = guild.members[self.rng.choice(guild.member_ids)]
+        mentions = []
+        if self.commands and self.rng.random() < self.args.command_ratio:
+            content = self.args.prefix + self.rng.choice(self.commands)
+            self.pending_commands[str(channel_id)].append(time.monotonic())
+        elif self.rng.random() < self.args.mention_ratio:
+            mentions = [guild.members[self.rng.choice(guild.member_ids)]]
+            content = f"<@{mentions[0]['user']['id']}> {sentence(self.rng)}"
+        else:
+            content = sentence(self.rng, 20)
+        message = self.message_payload(guild, channel_id, member, content, mentions)
+        guild.recent_messages.append((message['channel_id'], message['id']))
+        return message
+
+    def message_reaction_add(self, guild):
+        """A random member reacting to one of the guild's recent messages."""
+        if not guild.recent_messages:
+            return None
+        channel_id, message_id = self.rng.choice(guild.recent_messages)
+        return {'user_id': self.rng.choice(guild.member_ids), 'channel_id': channel_id, 'message_id': message_id,
+                'guild_id': str(guild.id), 'emoji': {'id': None, 'name': self.rng.choice(REACTION_EMOJI)}}
+
+    def voice_state_update(self, guild):
+        """A random member joining, moving between or leaving the voice channels."""
+        user_id = self.rng.choice(guild.member_ids)
+        channel_id = self.rng.choice(guild.voice_channels + [None])
+        return {'guild_id': str(guild.id), 'channel_id': str(channel_id) if channel_id else None, 'user_id': user_id,
+                'session_id': uuid.uuid4().hex, 'deaf': False, 'mute': False, 'self_deaf': False, 'self_mute': False,
+                'suppress': False, 'member': guild.members[user_id]}
+
+    def guild_member_add(self, guild):
+        """A new user joining the guild."""
+        member = guild.add_member(self.new_user(), self.rng)
+        return dict(member, guild_id=str(guild.id))
+
+    # REST
+
+    @staticmethod
+    def routes(method, path):
+        """Returns the route a request is reported under (every id replaced) and its rate limit bucket."""
+        route, bucket = [], []
+        previous = None
+        for segment in path.strip('/').split('/'):
+            if SNOWFLAKE_SEGMENT.match(segment):
+                route.append('{id}')
+                bucket.append(segment if previous in MAJOR_PARAMETERS else '{id}')
+            else:
+                route.append(segment)
+                bucket.append(segment)
+            previous = segment
+        return method + ' /' + '/'.join(route), method + ' /' + '/'.join(bucket)
+
+    def take_token(self, bucket):
+        """Takes a request from a rate limit bucket. Returns the bucket's headers, and whether the request is allowed."""
+        size = self.args.bucket_size
+        if not size:
+            return {}, True
+        now = time.time()
+        state = self.buckets.get(bucket)
+        if state is None or now >= state[1]:
+            state = self.buckets[bucket] = [size, now + self.args.bucket_seconds]
+        allowed = state[0] > 0
+        if allowed:
+            state[0] -= 1
+        headers = {'X-RateLimit-Limit': str(size), 'X-RateLimit-Remaining': str(state[0]),
+                   'X-RateLimit-Reset': str(math.ceil(state[1])), 'X-RateLimit-Reset-After': f'{state[1] - now:.3f}',
+                   'X-RateLimit-Bucket': bucket}
+        if not allowed:
+            headers['Retry-After'] = str(math.ceil(state[1] - now))
+        return headers, allowed
+
+    async def rest(self, request):
+        """Answers a REST API request after the simulated latency, unless its bucket is rate limited."""
+        start = time.perf_counter()
+        path = request.match_info['path']
+        route, bucket = self.routes(request.method, path)
+        self.rest_requests[route] += 1
+        headers, allowed = self.take_token(bucket)
+        if not allowed:
+            self.rest_rate_limited[route] += 1
+            retry_after = max(1, int((self.buckets[bucket][1] - time.time()) * 1000))
+            return web.json_response({'message': 'You are being rate limited.', 'retry_after': retry_after, 'global': False},
+                                     status=429, headers=headers)
+        latency = self.args.rest_latency_ms / 1000
+        await asyncio.sleep(self.rng.uniform(0.5, 1.5) * latency)
+        status, body = await self.answer(request, route, path)
+        self.rest_latency.record(time.perf_counter() - start)
+        if body is None:
+            return web.Response(status=status, headers=headers)
+        return web.json_response(body, status=status, headers=headers)
+
+    async def request_json(self, request):
+        """Returns a request's JSON body, including the payload_json part of file uploads."""
+        if request.content_type == 'application/json':
+            return await request.json()
+        if request.content_type.startswith('multipart/'):
+            form = await request.post()
+            return json.loads(form.get('payload_json', '{}'))
+        return {}
+
+    async def answer(self, request, route, path):  # pylint: disable=too-many-return-statements
+        """Returns the status and JSON body for a request. Routes the bot doesn't need answers from get empty objects."""
+        segments = path.strip('/').split('/')
+        if route in ('GET /gateway', 'GET /gateway/bot'):
+            return 200, {'url': self.url('ws') + '/gateway', 'shards': 1,
+                         'session_start_limit': {'total': 1000, 'remaining': 1000, 'reset_after': 0}}
+        if route == 'GET /users/@me':
+            return 200, self.user
+        if route == 'GET /oauth2/applications/@me':
+            return 200, {'id': self.user['id'], 'name': self.user['username'], 'icon': None, 'description': '',
+                         'rpc_origins': None, 'bot_public': True, 'bot_require_code_grant': False, 'owner': self.owner}
+        if route == 'POST /channels/{id}/messages':
+            return 200, self.bot_message(segments[1], await self.request_json(request))
+        if route == 'PATCH /channels/{id}/messages/{id}':
+            message = dict(self.messages.get(segments[3]) or self.bot_message(segments[1], {}), edited_timestamp=timestamp())
+            message.update((key, value) for key, value in (await self.request_json(request)).items() if key in ('content', 'embeds'))
+            self.store_message(message)
+            return 200, message
+        if route == 'GET /channels/{id}/messages/{id}':
+            if segments[3] in self.messages:
+                return 200, self.messages[segments[3]]
+            return 404, {'message': 'Unknown Message', 'code': 10008}
+        if route == 'GET /guilds/{id}/members/{id}':
+            guild = self.guilds_by_id.get(segments[1])
+            if guild is not None and segments[3] in guild.members:
+                return 200, guild.members[segments[3]]
+            return 404, {'message': 'Unknown Member', 'code': 10007}
+        if request.method in ('PUT', 'DELETE') or route == 'POST /channels/{id}/typing':
+            return 204, None
+        return 200, {}
+
+    def bot_message(self, channel_id, data):
+        """Creates a message sent by the bot, and records how long after the oldest unanswered command in the channel it came."""
+        pending = self.pending_commands.get(channel_id)
+        if pending:
+            self.command_latency.record(time.monotonic() - pending.popleft())
+        embeds = data.get('embeds') or ([data['embed']] if data.get('embed') else [])
+        message = {'id': str(self.snowflake()), 'channel_id': channel_id, 'author': self.user, 'content': data.get('content') or '',
+                   'timestamp': timestamp(), 'edited_timestamp': None, 'tts': bool(data.get('tts')), 'mention_everyone': False,
+                   'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': embeds, 'pinned': False, 'type': 0}
+        self.store_message(message)
+        return message
+
+    # Reporting
+
+    def report(self):
+        """Returns the statistics of the run so far."""
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+
+        def latency(histogram):
+            return {'count': histogram.calls, 'p50': round(histogram.percentile(50) * 1000, 1), 'p95': round(histogram.percentile(95) * 1000, 1),
+                    'p99': round(histogram.percentile(99) * 1000, 1), 'max': round(histogram.max_time * 1000, 1)}
+        return {
+            'elapsed_seconds': round(elapsed, 1),
+            'connected_shards': sorted(self.connections),
+            'events': dict(self.events),
+            'events_per_second': round(sum(self.events.values()) / elapsed, 1) if elapsed else 0.0,
+            'dropped_events': self.dropped_events,
+            'unanswered_commands': sum(len(pending) for pending in self.pending_commands.values()),
+            'command_latency_ms': latency(self.command_latency),
+            'rest_latency_ms': latency(self.rest_latency),
+            'rest_requests': sum(self.rest_requests.values()),
+            'rest_rate_limited': sum(self.rest_rate_limited.values()),
+            'rest_routes': {route: {'requests': count, 'rate_limited': self.rest_rate_limited[route]}
+                            for route, count in self.rest_requests.most_common()},
+        }
+
+    async def stats(self, _request):
+        """Serves the statistics of the run so far."""
+        return web.json_response(self.report())
+
+    def app(self):
+        """Returns the aiohttp application serving the gateway, the REST API and the statistics."""
+        app = web.Application()
+        app.router.add_get('/gateway', self.gateway)
+        app.router.add_get('/_fake/stats', self.stats)
+        app.router.add_route('*', r'/api/{version:v\d+}/{path:.*}', self.rest)
+        return app
+
+
+async def run(args):
+    """Serves the fake Discord until the duration has passed since the first shard connected, or until interrupted, then writes the report."""
+    fake = FakeDiscord(args)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    logger.info('Fake Discord with %d guilds listening, run the bot with DOZER_API_BASE=%s/api/v7', len(fake.guilds), fake.url('http'))
+    generator = asyncio.ensure_future(fake.generate())
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_event_loop().add_signal_handler(sig, stop.set)
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), args.report_seconds)
+            except asyncio.TimeoutError:
+                pass
+            report = fake.report()
+            logger.info('%.0f events/s, %d dropped, command latency p50 %.0f ms p99 %.0f ms, %d REST requests, %d rate limited',
+                        report['events_per_second'], report['dropped_events'], report['command_latency_ms']['p50'],
+                        report['command_latency_ms']['p99'], report['rest_requests'], report['rest_rate_limited'])
+            if args.duration and fake.started is not None and time.monotonic() - fake.started >= args.duration:
+                break
+    finally:
+        generator.cancel()
+        await runner.cleanup()
+        output = json.dumps(fake.report(), indent=2)
+        if args.output == '-':
+            print(output)
+        else:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                f.write(output)
+
+
+def main():
+    """Parses arguments and runs the fake Discord."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated guilds and traffic')
+    parser.add_argument('--guilds', type=int, default=20, help='number of guilds')
+    parser.add_argument('--members', type=int, default=500, help='members per guild; guilds over 250 are large and need chunking')
+    parser.add_argument('--message-rate', type=float, default=50, help='MESSAGE_CREATE events per second')
+    parser.add_argument('--reaction-rate', type=float, default=5, help='MESSAGE_REACTION_ADD events per second')
+    parser.add_argument('--voice-rate', type=float, default=2, help='VOICE_STATE_UPDATE events per second')
+    parser.add_argument('--join-rate', type=float, default=1, help='GUILD_MEMBER_ADD events per second')
+    parser.add_argument('--prefix', default='&', help='command prefix of the bot under test')
+    parser.add_argument('--commands', default='ping,help,afk load testing,stats', help='comma separated commands to send')
+    parser.add_argument('--command-ratio', type=float, default=0.05, help='fraction of messages that are commands')
+    parser.add_argument('--mention-ratio', type=float, default=0.1, help='fraction of other messages that mention a member')
+    parser.add_argument('--rest-latency-ms', type=float, default=50, help='average simulated REST latency')
+    parser.add_argument('--bucket-size', type=int, default=5, help='requests allowed per rate limit bucket and window, 0 for no limits')
+    parser.add_argument('--bucket-seconds', type=float, default=5, help='length of a rate limit window')
+    parser.add_argument('--duration', type=float, default=0, help='seconds to run for after the first shard connects, 0 to run until interrupted')
+    parser.add_argument('--report-seconds', type=float, default=10, help='how often to log a summary')
+    parser.add_argument('--output', default='-', help='file to write the final JSON report to, or - for stdout')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
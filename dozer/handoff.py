@@ -0,0 +1,80 @@
+"""Hands the bot's in-memory state over to the process replacing it when it restarts"""
+
+import asyncio
+import logging
+import os
+import pickle
+import sys
+import time
+
+__all__ = ['HANDOFF_FILE_ENV', 'HANDOFF_PID_ENV', 'restart_args', 'export_state', 'write_state', 'read_state', 'import_state']
+
+logger = logging.getLogger('dozer')
+
+# Set for the replacement process: where to read the state from, and which process to tell once it's ready for it
+HANDOFF_FILE_ENV = 'DOZER_HANDOFF_FILE'
+HANDOFF_PID_ENV = 'DOZER_HANDOFF_PID'
+
+
+def restart_args():
+    """Returns the command line that started this process, to start another one the same way."""
+    script = sys.argv[0]
+    if script.startswith(os.getcwd()):
+        script = script[len(os.getcwd()):].lstrip(os.sep)
+
+    if script.endswith('__main__.py'):
+        args = [sys.executable, '-m', script[:-len('__main__.py')].rstrip(os.sep).replace(os.sep, '.')]
+    else:
+        args = [sys.executable, script]
+    return args + sys.argv[1:]
+
+
+def export_state(bot):
+    """
+    Collects the state of every cog with an export_state() method, keyed by cog name along with the extension it
+    came from. export_state should also stop whatever the cog is running in the background, since from then on the
+    replacement process is responsible for it.
+    """
+    state = {}
+    for name, cog in bot.cogs.items():
+        if hasattr(cog, 'export_state'):
+            try:
+                state[name] = (type(cog).__module__, cog.export_state())
+            except Exception:
+                logger.exception('Failed to export the state of %s, it will start from scratch', name)
+    return state
+
+
+def write_state(path, state):
+    """Writes state to the handoff file, atomically so a reader never sees it half written."""
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+async def read_state(path, timeout):
+    """Waits up to timeout seconds for the handoff file, then reads and deletes it. Returns None if it never appears."""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            return None
+        await asyncio.sleep(0.05)
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    os.remove(path)
+    return state
+
+
+async def import_state(bot, state):
+    """Passes each cog's exported state to its import_state() coroutine, loading lazy extensions as needed."""
+    for name, (extension, cog_state) in state.items():
+        if name not in bot.cogs and extension in bot.extension_loader.pending:
+            await bot.extension_loader.load(extension, 'handoff')
+        cog = bot.cogs.get(name)
+        if cog is None or not hasattr(cog, 'import_state'):
+            logger.warning('Dropping handed off state for %s, which is not loaded', name)
+            continue
+        try:
+            await cog.import_state(cog_state)
+        except Exception:
+            logger.exception('Failed to import the handed off state of %s', name)
@@ -0,0 +1,206 @@
+"""Communication between the shard processes started by the shard launcher"""
+
+import asyncio
+import itertools
+import json
+import logging
+
+__all__ = ['SHARD_ID_ENV', 'SHARD_COUNT_ENV', 'IPC_PORT_ENV', 'LocalIPC', 'ShardIPC', 'IPCHub']
+
+logger = logging.getLogger('dozer')
+
+# Set by the shard launcher for each shard process
+SHARD_ID_ENV = 'DOZER_SHARD_ID'
+SHARD_COUNT_ENV = 'DOZER_SHARD_COUNT'
+IPC_PORT_ENV = 'DOZER_IPC_PORT'
+
+# Messages are single lines of JSON, each with an "op":
+#   hello   shard -> hub   {shard}                    identifies a shard after it connects
+#   query   shard -> hub   {id, name, args}           asks every shard (including the sender) to run a query handler
+#           hub -> shard   {id, name, args}
+#   reply   shard -> hub   {id, data}                 a shard's answer to a query
+#   result  hub -> shard   {id, data}                 every shard's answer, ordered by shard id
+#   publish shard -> hub   {topic, data}              sends an event to every other shard
+#   event   hub -> shard   {topic, data}              also sent by the launcher itself, e.g. to shut the shards down
+
+
+class LocalIPC:
+    """
+    Stands in for ShardIPC when the bot isn't sharded: queries only run this process's handler, and there are no
+    other shards to publish to. Cogs can use bot.ipc the same way either way.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.subscribers = {}
+
+    def handler(self, name, func):
+        """Registers the coroutine function that answers a query. It takes the query's keyword arguments and returns
+        something JSON serializable."""
+        self.handlers[name] = func
+
+    def subscribe(self, topic, callback):
+        """Registers a coroutine function that is called with the keyword arguments of events other shards publish."""
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def remove_handler(self, name):
+        """Removes a query handler, e.g. when the cog that registered it is unloaded."""
+        self.handlers.pop(name, None)
+
+    def unsubscribe(self, topic, callback):
+        """Removes an event callback, e.g. when the cog that subscribed it is unloaded."""
+        self.subscribers.get(topic, []).remove(callback)
+
+    async def connect(self):
+        """Nothing to connect to."""
+
+    async def query(self, name, **args):
+        """Runs a query on every shard and returns their answers, ordered by shard id."""
+        return [await self.handlers[name](**args)]
+
+    async def publish(self, topic, **data):
+        """Sends an event to every other shard."""
+
+
+class ShardIPC(LocalIPC):
+    """A shard's connection to the launcher's IPC hub."""
+    def __init__(self, shard_id, port, timeout=5):
+        super().__init__()
+        self.shard_id = shard_id
+        self.port = port
+        self.timeout = timeout
+        self._writer = None
+        self._connected = asyncio.Event()
+        self._ids = itertools.count()
+        self._pending = {}  # query id -> future
+
+    async def connect(self):
+        """Connects to the hub, retrying until it succeeds, then handles messages from it until the connection drops."""
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_connection('127.0.0.1', self.port)
+            except OSError:
+                await asyncio.sleep(1)
+                continue
+            self._send({'op': 'hello', 'shard': self.shard_id})
+            self._connected.set()
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    asyncio.ensure_future(self._handle(json.loads(line)))
+            finally:
+                self._connected.clear()
+                self._writer = None
+            logger.warning('Lost the connection to the shard launcher, reconnecting')
+
+    def _send(self, message):
+        self._writer.write(json.dumps(message).encode() + b'\n')
+
+    async def _handle(self, message):
+        if message['op'] == 'query':
+            try:
+                data = await self.handlers[message['name']](**message['args'])
+            except Exception:
+                logger.exception('IPC query %s failed', message['name'])
+                data = None
+            self._send({'op': 'reply', 'id': message['id'], 'data': data})
+        elif message['op'] == 'result':
+            future = self._pending.pop(message['id'], None)
+            if future is not None and not future.done():
+                future.set_result(message['data'])
+        elif message['op'] == 'event':
+            for callback in self.subscribers.get(message['topic'], ()):
+                try:
+                    await callback(**message['data'])
+                except Exception:
+                    logger.exception('IPC event %s failed', message['topic'])
+
+    async def query(self, name, **args):
+        """Runs a query on every shard and returns their answers, ordered by shard id. Shards that don't answer in
+        time are left out; if the hub can't be reached, only this shard's answer is returned."""
+        if not self._connected.is_set():
+            return await super().query(name, **args)
+        query_id = next(self._ids)
+        future = self._pending[query_id] = asyncio.get_event_loop().create_future()
+        self._send({'op': 'query', 'id': query_id, 'name': name, 'args': args})
+        try:
+            return await asyncio.wait_for(future, self.timeout * 2)
+        except asyncio.TimeoutError:
+            self._pending.pop(query_id, None)
+            return await super().query(name, **args)
+
+    async def publish(self, topic, **data):
+        """Sends an event to every other shard. Events published while disconnected from the hub are dropped."""
+        if self._connected.is_set():
+            self._send({'op': 'publish', 'topic': topic, 'data': data})
+
+
+class IPCHub:
+    """Runs in the launcher, relaying queries and events between the shards."""
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self._shards = {}  # shard id -> writer
+        self._ids = itertools.count()
+        self._replies = {}  # hub query id -> {shard id: data}
+        self._waiting = {}  # hub query id -> event set once every shard has replied
+
+    async def start(self, port):
+        """Starts listening for shards on localhost."""
+        return await asyncio.start_server(self._serve, '127.0.0.1', port)
+
+    @property
+    def connected(self):
+        """The ids of the shards currently connected."""
+        return sorted(self._shards)
+
+    @staticmethod
+    def _send(writer, message):
+        writer.write(json.dumps(message).encode() + b'\n')
+
+    def broadcast(self, topic, **data):
+        """Sends an event to every shard."""
+        for writer in list(self._shards.values()):
+            self._send(writer, {'op': 'event', 'topic': topic, 'data': data})
+
+    async def _serve(self, reader, writer):
+        shard_id = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message['op'] == 'hello':
+                    shard_id = message['shard']
+                    self._shards[shard_id] = writer
+                elif message['op'] == 'query':
+                    asyncio.ensure_future(self._query(writer, message))
+                elif message['op'] == 'reply':
+                    replies = self._replies.get(message['id'])
+                    if replies is not None:
+                        replies[shard_id] = message['data']
+                        if set(replies) >= set(self._shards):
+                            self._waiting[message['id']].set()
+                elif message['op'] == 'publish':
+                    for other_id, other in list(self._shards.items()):
+                        if other_id != shard_id:
+                            self._send(other, {'op': 'event', 'topic': message['topic'], 'data': message['data']})
+        finally:
+            if shard_id is not None and self._shards.get(shard_id) is writer:
+                del self._shards[shard_id]
+            writer.close()
+
+    async def _query(self, requester, message):
+        hub_id = next(self._ids)
+        self._replies[hub_id] = {}
+        self._waiting[hub_id] = asyncio.Event()
+        for writer in list(self._shards.values()):
+            self._send(writer, {'op': 'query', 'id': hub_id, 'name': message['name'], 'args': message['args']})
+        try:
+            await asyncio.wait_for(self._waiting[hub_id].wait(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Not every shard answered IPC query %s in time', message['name'])
+        replies = self._replies.pop(hub_id)
+        del self._waiting[hub_id]
+        self._send(requester, {'op': 'result', 'id': message['id'], 'data': [replies[shard] for shard in sorted(replies)]})
@@ -0,0 +1,100 @@
+"""
+Runs the bot as several shard processes, each connected to Discord for its own share of the guilds.
+Run with `python -m dozer.launcher [--count N]` instead of `python -m dozer`.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+
+from .ipc import IPCHub, SHARD_ID_ENV, SHARD_COUNT_ENV, IPC_PORT_ENV
+
+logger = logging.getLogger('dozer')
+
+
+class ShardLauncher:
+    """
+    Starts a `python -m dozer` process for each shard, telling it its shard id and the port of the IPC hub, which the
+    launcher runs so the shards can answer queries about the whole bot. Discord only allows one identify every few
+    seconds, so the shards are started identify_interval seconds apart.
+
+    A shard that crashes is started again after respawn_delay seconds. One that exits cleanly has been shut down, or
+    has handed over to a replacement process after a restart; the launcher keeps running until none of its shards,
+    or their replacements, are connected anymore.
+    """
+    def __init__(self, count, port, ipc_timeout=5, identify_interval=5, respawn_delay=5):
+        self.count = count
+        self.port = port
+        self.identify_interval = identify_interval
+        self.respawn_delay = respawn_delay
+        self.hub = IPCHub(timeout=ipc_timeout)
+        self._processes = {}  # shard id -> process
+        self._stopping = False
+
+    async def run(self):
+        """Runs the shards until they have all exited."""
+        loop = asyncio.get_event_loop()
+        server = await self.hub.start(self.port)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        logger.info('Starting %d shards, IPC hub on port %d', self.count, self.port)
+        await asyncio.gather(*(self._run_shard(shard_id) for shard_id in range(self.count)))
+        while self.hub.connected and not self._stopping:
+            await asyncio.sleep(5)
+        server.close()
+        await server.wait_closed()
+
+    async def _run_shard(self, shard_id):
+        await asyncio.sleep(shard_id * self.identify_interval)
+        env = dict(os.environ)
+        env.update({SHARD_ID_ENV: str(shard_id), SHARD_COUNT_ENV: str(self.count), IPC_PORT_ENV: str(self.port)})
+        while not self._stopping:
+            process = self._processes[shard_id] = await asyncio.create_subprocess_exec(sys.executable, '-m', 'dozer', env=env)
+            logger.info('Started shard %d as process %d', shard_id, process.pid)
+            status = await process.wait()
+            del self._processes[shard_id]
+            if status == 0 or self._stopping:
+                logger.info('Shard %d exited', shard_id)
+                return
+            logger.error('Shard %d exited with status %d, starting it again in %d seconds', shard_id, status, self.respawn_delay)
+            await asyncio.sleep(self.respawn_delay)
+
+    def stop(self):
+        """Asks every shard to shut down, and terminates the ones that haven't after a while."""
+        if self._stopping:
+            self._terminate()
+            return
+        self._stopping = True
+        logger.info('Shutting down all shards')
+        self.hub.broadcast('shutdown')
+        asyncio.get_event_loop().call_later(30, self._terminate)
+
+    def _terminate(self):
+        for shard_id, process in self._processes.items():
+            logger.warning('Shard %d did not shut down, terminating it', shard_id)
+            process.terminate()
+
+
+def main():
+    """Reads the shard settings from the config file and the command line, then runs the shards."""
+    parser = argparse.ArgumentParser(prog='python -m dozer.launcher', description='Run Dozer as several shard processes.')
+    parser.add_argument('--count', type=int, help='number of shards (default: shards.count in config.json)')
+    parser.add_argument('--port', type=int, help='IPC hub port (default: shards.ipc_port in config.json)')
+    args = parser.parse_args()
+
+    config = {}
+    if os.path.isfile('config.json'):
+        with open('config.json', encoding='utf-8') as f:
+            config = json.load(f).get('shards', {})
+    launcher = ShardLauncher(args.count or config.get('count', 1), args.port or config.get('ipc_port', 4590),
+                             ipc_timeout=config.get('ipc_timeout_seconds', 5),
+                             identify_interval=config.get('identify_interval_seconds', 5))
+    asyncio.get_event_loop().run_until_complete(launcher.run())
+
+
+if __name__ == '__main__':
+    main()
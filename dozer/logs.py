@@ -0,0 +1,139 @@
+"""
+Logging that doesn't block the event loop: records are put on a queue, and a listener thread formats them, collapses
+repeated warnings and errors, and writes them out
+"""
+
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+__all__ = ['LogQueueHandler', 'LogListener', 'JSONFormatter', 'TEXT_FORMAT']
+
+TEXT_FORMAT = '[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s'
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the listener's queue. Only the message itself is formatted here; tracebacks are formatted by the
+    listener. If the queue is full because the output can't keep up, records are dropped and counted rather than
+    blocking the loop.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)  # other handlers may still see the original
+        record.template = record.msg
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats each record as a JSON object on one line."""
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if getattr(record, 'repeated', None):
+            entry['repeated'] = record.repeated
+        return json.dumps(entry)
+
+
+class LogListener(logging.handlers.QueueListener):
+    """
+    Writes queued records to the output handlers on its own thread. Warnings and errors that repeat (same logger,
+    message template and exception raised from the same place) are only written once every dedup_interval seconds;
+    when the interval is up, how many times the record was repeated meanwhile is written along with the last of them.
+    """
+    def __init__(self, log_queue, *handlers, dedup_interval=60, queue_handler=None):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.dedup_interval = dedup_interval
+        self.queue_handler = queue_handler
+        self._repeats = {}  # key -> [time first written, repeats since, last repeated record]
+        self._reported_drops = 0
+        self._last_sweep = time.monotonic()
+
+    def dequeue(self, block):
+        # Wake up at least once a second to write out repeats, even while nothing new is logged
+        while True:
+            try:
+                return self.queue.get(block, timeout=1)
+            except queue.Empty:
+                self._sweep()
+
+    @staticmethod
+    def _key(record):
+        exception_type, location = None, None
+        if record.exc_info and record.exc_info[1] is not None:
+            # Wrapped exceptions (like discord.py's CommandInvokeError) are told apart by what they wrap
+            exception = record.exc_info[1]
+            while exception.__cause__ is not None:
+                exception = exception.__cause__
+            exception_type = type(exception)
+            tb = exception.__traceback__
+            while tb is not None and tb.tb_next is not None:
+                tb = tb.tb_next
+            if tb is not None:
+                location = (tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+        return record.name, record.levelno, str(getattr(record, 'template', record.msg)), exception_type, location
+
+    def handle(self, record):
+        if self.dedup_interval and record.levelno >= logging.WARNING:
+            now = time.monotonic()
+            key = self._key(record)
+            repeat = self._repeats.get(key)
+            if repeat is not None and now - repeat[0] < self.dedup_interval:
+                repeat[1] += 1
+                repeat[2] = record
+                return
+            self._repeats[key] = [now, 0, None]
+        self._emit(record)
+        if time.monotonic() - self._last_sweep >= 1:
+            self._sweep()
+
+    def _emit(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _sweep(self):
+        """Writes out the records that were repeated in intervals that are now over, and reports dropped records."""
+        now = time.monotonic()
+        self._last_sweep = now
+        for key, (first, repeats, last) in list(self._repeats.items()):
+            if now - first < self.dedup_interval:
+                continue
+            del self._repeats[key]
+            if repeats:
+                last.repeated = repeats
+                last.msg = f'{last.msg} (repeated {repeats} times in {now - first:.0f} s)'
+                self._emit(last)
+        dropped = self.queue_handler.dropped if self.queue_handler is not None else 0
+        if dropped > self._reported_drops:
+            self._emit(logging.makeLogRecord({'name': 'dozer', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                              'msg': f'Dropped {dropped - self._reported_drops} log records because the '
+                                                     'output could not keep up'}))
+            self._reported_drops = dropped
+
+    def stop(self):
+        super().stop()
+        for key in list(self._repeats):
+            self._repeats[key][0] = -self.dedup_interval  # write out any repeats still being counted
+        self._sweep()
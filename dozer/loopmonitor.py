@@ -0,0 +1,116 @@
+"""Measures event loop lag, and reports what is blocking the loop when it stalls"""
+
+import asyncio
+import collections
+import inspect
+import logging
+import sys
+import threading
+import time
+import traceback
+
+__all__ = ['LoopMonitor']
+
+logger = logging.getLogger('dozer')
+
+
+class LoopMonitor:
+    """
+    Sleeps for interval seconds over and over on the event loop, and records how much later than requested each sleep
+    woke up. Since nothing else can run while a handler is blocking the loop, this scheduling delay is how long the
+    bot couldn't respond to anything.
+
+    A watchdog thread also checks that the sleeps keep waking up. If the loop hasn't gotten back to the monitor
+    within threshold seconds, the loop thread's current stack and task are logged while the loop is still stuck.
+    Each stall is only reported once.
+
+    The lag history is kept as the average and maximum lag of each minute.
+    """
+    def __init__(self, loop, interval=0.25, threshold=1.0, history_minutes=60):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.minutes = collections.deque(maxlen=history_minutes)  # (minute start timestamp, average lag, max lag)
+        self.last_lag = 0.0
+        self.stalls = 0
+        self._minute_start = None
+        self._minute_lags = []
+        self._heartbeat = time.monotonic()
+        self._reported_heartbeat = None
+        self._loop_thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        """Starts the monitor task and the watchdog thread."""
+        self._stop.clear()
+        self._task = self.loop.create_task(self._monitor())
+        self._watchdog = threading.Thread(target=self._watch, name='dozer-loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        """Stops the monitor task and the watchdog thread."""
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _monitor(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        while True:
+            expected = self.loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            self._record(max(0.0, self.loop.time() - expected))
+
+    def _record(self, lag):
+        now = time.time()
+        self.last_lag = lag
+        if self._minute_start is None:
+            self._minute_start = now
+        elif now - self._minute_start >= 60:
+            self.minutes.append((self._minute_start, sum(self._minute_lags) / len(self._minute_lags), max(self._minute_lags)))
+            self._minute_start = now
+            self._minute_lags = []
+        self._minute_lags.append(lag)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            if stalled_for >= self.threshold and heartbeat != self._reported_heartbeat and self._loop_thread_id is not None:
+                self._reported_heartbeat = heartbeat
+                self.stalls += 1
+                self._report(stalled_for)
+
+    def _report(self, stalled_for):
+        frame = sys._current_frames().get(self._loop_thread_id)  # pylint: disable=protected-access
+        if frame is None:
+            return
+        # The innermost coroutine on the stack is the one that made the blocking call
+        coroutine = frame
+        while coroutine is not None and not coroutine.f_code.co_flags & inspect.CO_COROUTINE:
+            coroutine = coroutine.f_back
+        task = asyncio.current_task(self.loop)
+        if coroutine is not None:
+            offender = f'{coroutine.f_code.co_name} ({coroutine.f_code.co_filename}:{coroutine.f_lineno})'
+        else:
+            offender = 'no coroutine'
+        logger.warning('Event loop blocked for %.1f s in %s, task %r. Loop thread stack:\n%s', stalled_for, offender, task,
+                       ''.join(traceback.format_stack(frame)).rstrip())
+
+    def history(self):
+        """Returns (minute start timestamp, average lag, max lag) for each recorded minute, including the current one."""
+        history = list(self.minutes)
+        if self._minute_lags:
+            history.append((self._minute_start, sum(self._minute_lags) / len(self._minute_lags), max(self._minute_lags)))
+        return history
+
+    def summary(self):
+        """Returns the average and maximum lag over the recorded history, in seconds."""
+        history = self.history()
+        if not history:
+            return 0.0, 0.0
+        return sum(average for _, average, _ in history) / len(history), max(maximum for _, _, maximum in history)
@@ -0,0 +1,223 @@
+"""
+Estimates of how much memory the bot's caches use, trimming of the member cache, and tracemalloc snapshots for
+finding memory leaks
+"""
+
+import asyncio
+import collections
+import contextlib
+import datetime
+import gc
+import itertools
+import logging
+import os
+import random
+import resource
+import sys
+import tracemalloc
+import types
+
+import discord
+from sqlalchemy.orm.state import InstanceState
+
+from . import db
+from . import utils
+from .perf import perf_stats
+
+__all__ = ['deep_size', 'estimate', 'cache_sizes', 'trim_members', 'offline_members', 'rss', 'SnapshotStore']
+
+logger = logging.getLogger('dozer')
+
+# Objects that are cached in their own right, or shared by everything, so sizes don't include them
+SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType, discord.Client, discord.state.ConnectionState,
+                asyncio.AbstractEventLoop, discord.Guild, discord.abc.GuildChannel, discord.abc.PrivateChannel, discord.Member,
+                discord.User, discord.ClientUser, discord.Role, discord.Emoji, discord.Message, InstanceState)
+
+
+def deep_size(obj, stop=SHARED_TYPES):
+    """Returns the size in bytes of obj and everything it references, without following objects of the stop types."""
+    seen = {id(obj)}
+    pending = [obj]
+    size = 0
+    while pending:
+        current = pending.pop()
+        size += sys.getsizeof(current)
+        for referent in gc.get_referents(current):
+            if id(referent) not in seen and not isinstance(referent, stop):
+                seen.add(id(referent))
+                pending.append(referent)
+    return size
+
+
+def estimate(items, count, sample=100):
+    """Estimates the total size of count objects from the average deep size of a sample of them."""
+    if not count:
+        return 0
+    if isinstance(items, (list, tuple)):
+        sampled = random.sample(items, min(sample, len(items)))
+    else:
+        sampled = list(itertools.islice(items, sample))
+    if not sampled:
+        return 0
+    return sum(deep_size(item) for item in sampled) * count // len(sampled)
+
+
+def cache_sizes(bot):
+    """Returns (cache name, number of entries, estimated bytes) for each of discord.py's caches and the bot's own."""
+    state = bot._connection  # pylint: disable=protected-access
+    guilds = bot.guilds
+    member_count = sum(len(guild.members) for guild in guilds)
+    channel_count = sum(len(guild.channels) for guild in guilds)
+    role_count = sum(len(guild.roles) for guild in guilds)
+    # Members are sampled from random guilds, since the first guilds' members aren't typical of the rest
+    members = (member for guild in random.sample(guilds, min(len(guilds), 20)) for member in guild.members)
+    sizes = [
+        ('messages', len(state._messages), estimate(list(state._messages), len(state._messages))),  # pylint: disable=protected-access
+        ('members', member_count, estimate(list(itertools.islice(members, 1000)), member_count)),
+        ('users', len(bot.users), estimate(bot.users, len(bot.users))),
+        ('guilds', len(guilds), estimate(guilds, len(guilds))),
+        ('channels', channel_count, estimate((channel for guild in guilds for channel in guild.channels), channel_count)),
+        ('roles', role_count, estimate((role for guild in guilds for role in guild.roles), role_count)),
+        ('emojis', len(bot.emojis), estimate(bot.emojis, len(bot.emojis))),
+        ('settings cache', len(db.settings_cache), deep_size(db.settings_cache)),
+        ('mention index', None, deep_size(utils.mention_index)),
+        ('rate limiter', len(bot.rate_limiter), deep_size(bot.rate_limiter)),
+        ('handler timings', None, deep_size(perf_stats)),
+    ]
+    return sizes
+
+
+def trim_members(bot, guilds=None, keep=frozenset()):
+    """
+    Drops offline members of large guilds (by default all of them) from the member cache, except for members in voice
+    channels, the bot itself and the ids in keep. discord.py adds them back from their presence updates when they come
+    online, which is why the bot always parses PRESENCE_UPDATE while trimming, even with a gateway event allow-list.
+    Guilds whose offline members are being used by offline_members are skipped. Returns how many were dropped.
+    """
+    dropped = 0
+    for guild in bot.guilds if guilds is None else guilds:
+        if not guild.large or (guilds is None and guild.id in _offline_member_users):
+            continue
+        for member in list(guild.members):
+            if member.status is discord.Status.offline and member.voice is None and member.id != bot.user.id \
+                    and member.id not in keep:
+                guild._remove_member(member)  # pylint: disable=protected-access
+                dropped += 1
+    return dropped
+
+
+# guild id -> [number of offline_members blocks using the guild's members, ids of the members cached before them]
+_offline_member_users = {}
+
+
+@contextlib.asynccontextmanager
+async def offline_members(bot, guild):
+    """
+    Makes guild.members complete inside the block, for commands that need every member of a large guild, by requesting
+    the members that aren't cached from Discord. Afterwards, the offline members that were requested are dropped
+    again, so a command doesn't undo the memory config's fetch_offline_members being turned off.
+    """
+    users = _offline_member_users.get(guild.id)
+    if users is None:
+        if not guild.large or len(guild.members) >= guild.member_count:
+            yield
+            return
+        users = _offline_member_users[guild.id] = [0, {member.id for member in guild.members}]
+    users[0] += 1
+    try:
+        if len(guild.members) < guild.member_count:
+            await bot.request_offline_members(guild)
+        yield
+    finally:
+        users[0] -= 1
+        if not users[0]:
+            del _offline_member_users[guild.id]
+            trim_members(bot, [guild], keep=users[1])
+
+
+def rss():
+    """Returns the process's resident set size in bytes, or its peak if the current size can't be read."""
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Allocations made by tracemalloc itself and the import machinery are left out of diffs
+SNAPSHOT_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+                    tracemalloc.Filter(False, '<unknown>'))
+
+
+class SnapshotStore:
+    """
+    Named tracemalloc snapshots. The most recent few are kept in memory, and automatic ones are written to the
+    directory so they can be compared after a restart; snapshots not in memory are loaded from there by name.
+    Taking, loading and comparing snapshots can take seconds, and is done on the default executor.
+    """
+    def __init__(self, directory='snapshots', keep=5):
+        self.directory = directory
+        self.keep = keep
+        self._snapshots = collections.OrderedDict()  # name -> (snapshot, RSS when taken)
+
+    def names(self):
+        """Returns the names of the snapshots in memory and on disk, oldest first, with the RSS when each was taken."""
+        names = collections.OrderedDict()
+        if os.path.isdir(self.directory):
+            for filename in sorted(os.listdir(self.directory)):
+                if filename.endswith('.snapshot'):
+                    names[filename[:-len('.snapshot')]] = None
+        for name, (_, size) in self._snapshots.items():
+            names[name] = size
+        return names
+
+    async def take(self, name, save=False):
+        """Takes a snapshot of the traced allocations and stores it by name; tracemalloc must be tracing."""
+        loop = asyncio.get_event_loop()
+        snapshot = await loop.run_in_executor(None, lambda: tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS))
+        self._snapshots.pop(name, None)
+        self._snapshots[name] = snapshot, rss()
+        while len(self._snapshots) > self.keep:
+            self._snapshots.popitem(last=False)
+        if save:
+            os.makedirs(self.directory, exist_ok=True)
+            await loop.run_in_executor(None, snapshot.dump, os.path.join(self.directory, name + '.snapshot'))
+        return snapshot
+
+    async def get(self, name):
+        """Returns a snapshot by name, loading it from the directory if it isn't in memory. Raises KeyError if there is none."""
+        if name in self._snapshots:
+            return self._snapshots[name][0]
+        path = os.path.join(self.directory, os.path.basename(name) + '.snapshot')
+        if not os.path.isfile(path):
+            raise KeyError(name)
+        return await asyncio.get_event_loop().run_in_executor(None, tracemalloc.Snapshot.load, path)
+
+    async def diff(self, old, new, key_type='lineno'):
+        """Returns the StatisticDiffs between two named snapshots, largest growth first."""
+        old_snapshot, new_snapshot = await self.get(old), await self.get(new)
+        return await asyncio.get_event_loop().run_in_executor(None, new_snapshot.compare_to, old_snapshot, key_type)
+
+    async def watch(self, threshold, step, interval, frames=1):
+        """
+        Checks the RSS every interval seconds. When it first passes threshold bytes, starts tracing (if it isn't already)
+        and saves a snapshot, then saves another each time it has grown by step bytes more; comparing consecutive
+        automatic snapshots shows what the growth was allocated by.
+        """
+        next_size = threshold
+        while True:
+            await asyncio.sleep(interval)
+            size = rss()
+            if size < next_size:
+                continue
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                logger.warning('RSS is %.0f MiB, started tracing allocations', size / 2 ** 20)
+            name = 'auto-' + datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+            try:
+                await self.take(name, save=True)
+            except OSError:
+                logger.exception('Could not save an automatic allocation snapshot')
+            else:
+                logger.warning('RSS is %.0f MiB, saved allocation snapshot %s', size / 2 ** 20, name)
+            next_size = size + step
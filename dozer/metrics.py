@@ -0,0 +1,235 @@
+"""
+Metrics for monitoring, served in the Prometheus text format by an HTTP server bound to localhost.
+Counters that aren't kept anywhere else (gateway events, commands, REST requests) are updated as things happen;
+everything else is read from the bot and the other stats when the metrics are scraped.
+"""
+
+import asyncio
+import collections
+import contextvars
+import functools
+import logging
+import sys
+import time
+
+from aiohttp import web
+
+from . import db
+from .perf import BUCKETS, Histogram, perf_stats
+
+__all__ = ['Metrics', 'MetricsServer']
+
+logger = logging.getLogger('dozer')
+
+# Every fourth bucket of the perf histograms (a factor of about 2.4 apart) is exported, to keep the number of series down
+EXPORTED_BUCKETS = tuple(range(0, len(BUCKETS), 4))
+
+# The REST route being requested, so that the responses the HTTP client's session receives can be attributed to it
+rest_route = contextvars.ContextVar('rest_route', default='other')
+
+
+class _CountingRequest:
+    """Wraps a request context manager of the HTTP client's session, counting the response's status."""
+    def __init__(self, request, metrics):
+        self._request = request
+        self._metrics = metrics
+
+    async def __aenter__(self):
+        response = await self._request.__aenter__()
+        self._metrics.rest_responses[rest_route.get(), response.status] += 1
+        return response
+
+    async def __aexit__(self, err_type, err, tb):
+        return await self._request.__aexit__(err_type, err, tb)
+
+
+class _CountingSession:
+    """Stands in for the HTTP client's aiohttp session. Every response is counted, including 429s that discord.py retries."""
+    def __init__(self, session, metrics):
+        self._session = session
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def request(self, method, url, **kwargs):
+        """Starts a request, like ClientSession.request."""
+        return _CountingRequest(self._session.request(method, url, **kwargs), self._metrics)
+
+
+class Metrics:
+    """The counters updated by the bot: gateway events by type, commands invoked and failed, and REST requests by route."""
+    def __init__(self):
+        self.events = collections.Counter()
+        self.commands = collections.Counter()
+        self.command_failures = collections.Counter()
+        self.rest_requests = {}  # route -> Histogram
+        self.rest_responses = collections.Counter()  # (route, status) -> count
+
+    def event(self, payload):
+        """Counts a gateway payload, if it is an event."""
+        if payload.get('op') == 0:
+            self.events[payload['t']] += 1
+
+    def command(self, name, failed):
+        """Counts an invoked command."""
+        self.commands[name] += 1
+        if failed:
+            self.command_failures[name] += 1
+
+    def instrument(self, http):
+        """Wraps a discord.py HTTP client's request method and session to time and count requests by route."""
+        request = http.request
+
+        @functools.wraps(request)
+        async def timed_request(route, *args, **kwargs):
+            name = f'{route.method} {route.path}'
+            token = rest_route.set(name)
+            start = time.perf_counter()
+            error = False
+            try:
+                return await request(route, *args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                rest_route.reset(token)
+                histogram = self.rest_requests.get(name)
+                if histogram is None:
+                    histogram = self.rest_requests[name] = Histogram()
+                histogram.record(time.perf_counter() - start, error)
+        http.request = timed_request
+        http._session = _CountingSession(http._session, self)  # pylint: disable=protected-access
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class _Exposition:
+    """Builds a page in the Prometheus text format."""
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, description, samples):
+        """Adds a counter or gauge, with samples as a list of (labels dict, value)."""
+        self.lines.append(f'# HELP {name} {description}')
+        self.lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            self.lines.append(f'{name}{_labels(labels)} {value}')
+
+    def histogram(self, name, description, histograms):
+        """Adds a histogram, with histograms as a list of (labels dict, perf.Histogram)."""
+        self.lines.append(f'# HELP {name} {description}')
+        self.lines.append(f'# TYPE {name} histogram')
+        for labels, histogram in histograms:
+            cumulative = 0
+            index = 0
+            for bucket in EXPORTED_BUCKETS:
+                while index <= bucket:
+                    cumulative += histogram.counts[index]
+                    index += 1
+                self.lines.append(f'{name}_bucket{_labels(dict(labels, le=f"{BUCKETS[bucket]:.6g}"))} {cumulative}')
+            self.lines.append(f"{name}_bucket{_labels(dict(labels, le='+Inf'))} {histogram.calls}")
+            self.lines.append(f'{name}_sum{_labels(labels)} {histogram.total_time}')
+            self.lines.append(f'{name}_count{_labels(labels)} {histogram.calls}')
+
+    def render(self):
+        """Returns the page."""
+        return '\n'.join(self.lines) + '\n'
+
+
+class MetricsServer:
+    """Serves the bot's metrics at /metrics on the given host and port."""
+    def __init__(self, bot, metrics, host='127.0.0.1', port=9590):
+        self.bot = bot
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        """Starts serving. If the port is in use, such as by the process this one is replacing, keeps trying."""
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        warned = False
+        while self._runner is not None:
+            try:
+                await web.TCPSite(self._runner, self.host, self.port).start()
+            except OSError as err:
+                if not warned:
+                    logger.warning('Could not serve metrics on %s:%d, retrying: %s', self.host, self.port, err)
+                    warned = True
+                await asyncio.sleep(5)
+            else:
+                logger.info('Serving metrics on http://%s:%d/metrics', self.host, self.port)
+                return
+
+    async def stop(self):
+        """Stops serving."""
+        runner, self._runner = self._runner, None
+        if runner is not None:
+            await runner.cleanup()
+
+    async def handle(self, request):  # pylint: disable=unused-argument
+        """Responds to a scrape."""
+        return web.Response(body=self.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    def render(self):
+        """Returns the current metrics in the Prometheus text format."""
+        bot = self.bot
+        metrics = self.metrics
+        page = _Exposition()
+        page.metric('dozer_gateway_events_total', 'counter', 'Gateway events received, by type.',
+                    [({'type': event}, count) for event, count in sorted(metrics.events.items())])
+        if bot.event_filter is not None:
+            page.metric('dozer_gateway_events_skipped_total', 'counter', 'Gateway events dropped without parsing by the allow-list, by type.',
+                        [({'type': event}, count) for event, count in sorted(bot.event_filter.skipped.items())])
+        page.metric('dozer_commands_total', 'counter', 'Commands invoked.',
+                    [({'command': name}, count) for name, count in sorted(metrics.commands.items())])
+        page.metric('dozer_command_failures_total', 'counter', 'Commands that raised an error or failed a check.',
+                    [({'command': name}, count) for name, count in sorted(metrics.command_failures.items())])
+        page.metric('dozer_commands_throttled_total', 'counter', 'Commands refused by the rate limit.',
+                    [({}, bot.rate_limiter.throttled)])
+
+        if perf_stats.enabled:
+            handlers = perf_stats.top(count=sys.maxsize)
+            page.histogram('dozer_handler_seconds', 'Time taken by event listeners, message pipeline stages and commands.',
+                           [({'cog': stats.cog, 'handler': stats.name}, histogram) for stats, histogram in handlers])
+            page.metric('dozer_handler_errors_total', 'counter', 'Event listener, pipeline stage and command calls that raised.',
+                        [({'cog': stats.cog, 'handler': stats.name}, histogram.errors) for stats, histogram in handlers])
+        page.histogram('dozer_db_query_seconds', 'Database query latency, by the listener or command that made the query.',
+                       [({'source': source or 'unknown'}, histogram) for source, histogram in sorted(
+                           db.query_stats.by_source().items(), key=lambda item: item[0] or '')])
+
+        page.histogram('dozer_rest_request_seconds', 'Discord REST requests by route, including time spent waiting on rate limits.',
+                       [({'route': route}, histogram) for route, histogram in sorted(metrics.rest_requests.items())])
+        page.metric('dozer_rest_responses_total', 'counter', 'Discord REST responses by route and status; 429s are rate limits.',
+                    [({'route': route, 'status': status}, count) for (route, status), count in sorted(metrics.rest_responses.items())])
+
+        lag_average, lag_max = bot.loop_monitor.summary()
+        page.metric('dozer_loop_lag_seconds', 'gauge', 'Most recently measured event loop lag.', [({}, bot.loop_monitor.last_lag)])
+        page.metric('dozer_loop_lag_average_seconds', 'gauge', 'Average event loop lag over the recorded history.', [({}, lag_average)])
+        page.metric('dozer_loop_lag_max_seconds', 'gauge', 'Maximum event loop lag over the recorded history.', [({}, lag_max)])
+        page.metric('dozer_loop_stalls_total', 'counter', 'Times the event loop was blocked past the stall threshold.',
+                    [({}, bot.loop_monitor.stalls)])
+        page.metric('dozer_tasks', 'gauge', 'Tasks on the event loop.', [({}, len(asyncio.all_tasks(bot.loop)))])
+
+        page.metric('dozer_settings_cache_hits_total', 'counter', 'Settings cache lookups answered from the cache.',
+                    [({}, db.settings_cache.hits)])
+        page.metric('dozer_settings_cache_misses_total', 'counter', 'Settings cache lookups that queried the database.',
+                    [({}, db.settings_cache.misses)])
+        page.metric('dozer_settings_cache_entries', 'gauge', 'Entries in the settings cache.', [({}, len(db.settings_cache))])
+        page.metric('dozer_rate_limit_buckets', 'gauge', 'Users (or users per guild or channel) tracked by the rate limit.',
+                    [({}, len(bot.rate_limiter))])
+
+        page.metric('dozer_guilds', 'gauge', 'Guilds this process is in.', [({}, len(bot.guilds))])
+        page.metric('dozer_members', 'gauge', 'Members of those guilds, as reported by Discord.',
+                    [({}, sum(guild.member_count or 0 for guild in bot.guilds))])
+        page.metric('dozer_cached_users', 'gauge', 'Users held in the cache.', [({}, len(bot.users))])
+        return page.render()
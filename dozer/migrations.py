@@ -0,0 +1,166 @@
+"""Versioned schema migrations for the Dozer database"""
+
+import datetime
+import logging
+
+import sqlalchemy
+
+from . import db
+
+__all__ = ['migrate', 'ensure_tables', 'current_version', 'latest_version']
+
+logger = logging.getLogger('dozer')
+
+_metadata = sqlalchemy.MetaData()
+schema_version = sqlalchemy.Table('schema_version', _metadata, sqlalchemy.Column('version', sqlalchemy.Integer, nullable=False))
+
+MIGRATIONS = []
+
+
+def migration(version):
+    """Registers a function as the migration step that brings the schema to a given version.
+    Steps take a connection with an open transaction and must be safe to run against a database created by create_all."""
+    def decorator(func):
+        """Adds the step to the migration list"""
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda step: step[0])
+        return func
+    return decorator
+
+
+# Version 1 used to create the tables. Which tables exist depends on which cogs are loaded, and create_all builds them
+# from the current models, so that isn't a versioned step any more: ensure_tables does it instead. The steps below
+# only change tables that already exist.
+
+
+# Lookups that event handlers and commands do on every call; these were full table scans before.
+HOT_PATH_INDEXES = [
+    ('ix_voicebinds_channel_id', 'voicebinds', ('channel_id',)),
+    ('ix_word_filters_guild_id', 'word_filters', ('guild_id',)),
+    ('ix_team_numbers_team_type_team_number', 'team_numbers', ('team_type', 'team_number')),
+    ('ix_punishment_timers_target_ts', 'punishment_timers', ('target_ts',)),
+    ('ix_word_filter_infraction_member_id', 'word_filter_infraction', ('member_id',)),
+    ('ix_missing_roles_guild_id_member_id', 'missing_roles', ('guild_id', 'member_id')),
+]
+
+
+@migration(2)
+def add_hot_path_indexes(conn):
+    """Add indexes for hot-path lookups"""
+    _create_hot_path_indexes(conn)
+
+
+def _create_hot_path_indexes(conn):
+    for name, table, columns in HOT_PATH_INDEXES:
+        if not conn.dialect.has_table(conn, table):
+            continue  # the cog that owns the table isn't installed
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+
+SNOWFLAKE_COLUMNS = [
+    ('voicebinds', 'guild_id'),
+    ('voicebinds', 'channel_id'),
+    ('voicebinds', 'role_id'),
+    ('afk_status', 'user_id'),
+    ('word_filter_role_whitelist', 'guild_id'),
+]
+
+
+@migration(3)
+def widen_snowflake_columns(conn):
+    """Widen snowflake columns declared as Integer to BigInteger"""
+    if conn.dialect.name == 'sqlite':
+        return  # SQLite stores every integer as up to 64 bits regardless of the declared type, so nothing needs rewriting
+    for table, column in SNOWFLAKE_COLUMNS:
+        if not conn.dialect.has_table(conn, table):
+            continue
+        if conn.dialect.name == 'mysql':
+            conn.execute(f'ALTER TABLE {table} MODIFY {column} BIGINT')
+        else:
+            conn.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT')
+
+
+@migration(4)
+def add_retention_timestamps(conn):
+    """Add timestamps used by the retention job to tables that had none"""
+    now = datetime.datetime.utcnow()
+    inspector = sqlalchemy.inspect(conn)
+    for table, column in (('missing_members', 'left_at'), ('nicknames', 'saved_at')):
+        if not conn.dialect.has_table(conn, table):
+            continue
+        if column not in (existing['name'] for existing in inspector.get_columns(table)):
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} DATETIME')
+        # Existing rows have no recorded time, so they are treated as saved now and age out from here
+        conn.execute(sqlalchemy.text(f'UPDATE {table} SET {column} = :now WHERE {column} IS NULL'), now=now)
+
+
+@migration(5)
+def add_upsert_conflict_targets(conn):
+    """Add the unique constraints that upserts on voicebinds and namegame_leaderboard conflict on"""
+    inspector = sqlalchemy.inspect(conn)
+    if conn.dialect.has_table(conn, 'voicebinds'):
+        # Keep the newest bind of any channel bound more than once
+        conn.execute('DELETE FROM voicebinds WHERE id NOT IN '
+                     '(SELECT id FROM (SELECT MAX(id) AS id FROM voicebinds GROUP BY channel_id) AS newest)')
+        if conn.dialect.name == 'mysql':
+            conn.execute('DROP INDEX ix_voicebinds_channel_id ON voicebinds')
+        else:
+            conn.execute('DROP INDEX IF EXISTS ix_voicebinds_channel_id')
+        conn.execute('CREATE UNIQUE INDEX ix_voicebinds_channel_id ON voicebinds (channel_id)')
+
+    # Wins are recorded per game mode, but the table was keyed on user_id alone, so a second mode's win would collide
+    if conn.dialect.has_table(conn, 'namegame_leaderboard') and \
+            inspector.get_pk_constraint('namegame_leaderboard')['constrained_columns'] == ['user_id']:
+        conn.execute('ALTER TABLE namegame_leaderboard RENAME TO namegame_leaderboard_old')
+        conn.execute('CREATE TABLE namegame_leaderboard (user_id BIGINT NOT NULL, wins BIGINT, game_mode VARCHAR(255) NOT NULL, '
+                     'PRIMARY KEY (user_id, game_mode))')
+        conn.execute('INSERT INTO namegame_leaderboard (user_id, wins, game_mode) '
+                     'SELECT user_id, wins, game_mode FROM namegame_leaderboard_old WHERE game_mode IS NOT NULL')
+        conn.execute('DROP TABLE namegame_leaderboard_old')
+
+
+def ensure_tables(engine):
+    """
+    Creates the tables of the models imported so far that don't exist yet, and the hot-path indexes of the tables that
+    do. Tables are created from the current models, so they don't need the migration steps. This runs after migrating
+    and again whenever a deferred extension is loaded, since its models aren't imported until then.
+    """
+    with engine.begin() as conn:
+        db.DatabaseObject.metadata.create_all(bind=conn)
+        _create_hot_path_indexes(conn)
+
+
+def latest_version():
+    """Returns the schema version the registered migrations bring the database to."""
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn):
+    """Returns the schema version recorded in the database, or 0 if it has never been migrated."""
+    if not conn.dialect.has_table(conn, schema_version.name):
+        return 0
+    return conn.execute(sqlalchemy.select([sqlalchemy.func.max(schema_version.c.version)])).scalar() or 0
+
+
+def migrate(engine):
+    """
+    Brings the database schema up to date, applying each pending migration in its own transaction, then creates any
+    missing tables with ensure_tables. If the schema is already current, that is all it does, instead of reflecting
+    every table on every boot.
+    """
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if version >= latest_version():
+        logger.debug('Database schema is current (version %d)', version)
+    else:
+        schema_version.create(engine, checkfirst=True)
+        for step_version, step in MIGRATIONS:
+            if step_version <= version:
+                continue
+            logger.info('Applying database migration %d: %s', step_version, step.__doc__)
+            with engine.begin() as conn:
+                step(conn)
+                conn.execute(schema_version.delete())
+                conn.execute(schema_version.insert().values(version=step_version))
+        logger.info('Database schema migrated from version %d to %d', version, latest_version())
+    ensure_tables(engine)
@@ -0,0 +1,142 @@
+"""Latency histograms for the bot's event listeners, message pipeline stages and commands"""
+
+import bisect
+import collections
+import functools
+import time
+
+__all__ = ['Histogram', 'HandlerStats', 'PerfStats', 'perf_stats', 'handler_owner']
+
+# Bucket upper bounds in seconds, growing by 25% each from 0.1 ms to about two minutes; slower calls land in a final overflow bucket
+BUCKETS = tuple(0.0001 * 1.25 ** i for i in range(64))
+
+
+class Histogram:
+    """Call and error counts and a bucketed latency distribution. Percentiles are accurate to a bucket (25%)."""
+    __slots__ = ('calls', 'errors', 'total_time', 'max_time', 'counts')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.counts = [0] * (len(BUCKETS) + 1)
+
+    def record(self, duration, error=False):
+        """Adds one call."""
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    def merge(self, other):
+        """Adds another histogram's calls to this one."""
+        self.calls += other.calls
+        self.errors += other.errors
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+    def percentile(self, pct):
+        """Returns the given percentile (0-100) of the call times, in seconds."""
+        if not self.calls:
+            return 0.0
+        rank = max(1, round(self.calls * pct / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(BUCKETS[index], self.max_time) if index < len(BUCKETS) else self.max_time
+        return self.max_time
+
+
+class HandlerStats:
+    """
+    The histograms of one handler: one since the last reset, and one for each of the most recent minutes, which
+    are merged to report on a time window.
+    """
+    def __init__(self, cog, name, window_minutes):
+        self.cog = cog
+        self.name = name
+        self.total = Histogram()
+        self._minutes = collections.deque(maxlen=window_minutes)  # (minute, Histogram)
+
+    def record(self, duration, error=False):
+        """Adds one call to the overall and current minute's histograms."""
+        self.total.record(duration, error)
+        minute = int(time.monotonic() // 60)
+        if not self._minutes or self._minutes[-1][0] != minute:
+            self._minutes.append((minute, Histogram()))
+        self._minutes[-1][1].record(duration, error)
+
+    def window(self, minutes):
+        """Returns a histogram of the calls made in the last given number of minutes, or since the last reset if None."""
+        if minutes is None:
+            return self.total
+        since = int(time.monotonic() // 60) - minutes
+        histogram = Histogram()
+        for minute, recorded in self._minutes:
+            if minute > since:
+                histogram.merge(recorded)
+        return histogram
+
+
+def handler_owner(callback):
+    """Returns the name of the cog (or the bot class) a callback belongs to."""
+    owner = getattr(callback, '__self__', None)
+    if owner is not None:
+        return type(owner).__name__
+    return getattr(callback, '__module__', None) or 'unknown'
+
+
+class PerfStats:
+    """
+    Per (cog, handler) latency histograms for everything the bot dispatches. Everything runs on the event loop,
+    so nothing is locked. When disabled, dispatch skips wrapping handlers entirely.
+    """
+    def __init__(self, enabled=True, window_minutes=60):
+        self.enabled = enabled
+        self.window_minutes = window_minutes
+        self._handlers = {}
+
+    def record(self, cog, name, duration, error=False):
+        """Records one call of a handler."""
+        stats = self._handlers.get((cog, name))
+        if stats is None:
+            stats = self._handlers[cog, name] = HandlerStats(cog, name, self.window_minutes)
+        stats.record(duration, error)
+
+    def timed(self, cog, name, func):
+        """Wraps a coroutine function so that each call of it is recorded as the given handler."""
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException:
+                self.record(cog, name, time.perf_counter() - start, error=True)
+                raise
+            self.record(cog, name, time.perf_counter() - start)
+            return result
+        return wrapper
+
+    def top(self, count=10, window=None):
+        """Returns (HandlerStats, Histogram) pairs for the handlers with the highest total time over the window
+        (in minutes, or since the last reset if None), highest first."""
+        results = []
+        for stats in self._handlers.values():
+            histogram = stats.window(window)
+            if histogram.calls:
+                results.append((stats, histogram))
+        results.sort(key=lambda result: result[1].total_time, reverse=True)
+        return results[:count]
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        self._handlers.clear()
+
+
+perf_stats = PerfStats()
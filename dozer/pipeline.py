@@ -0,0 +1,94 @@
+"""The shared pipeline that every incoming message goes through"""
+
+import logging
+import time
+import types
+import typing
+
+import discord
+
+from . import db
+from .perf import perf_stats, handler_owner
+
+__all__ = ['MessageEnvelope', 'MessagePipeline']
+
+logger = logging.getLogger('dozer')
+
+
+class MessageEnvelope(typing.NamedTuple):
+    """
+    Everything the pipeline stages need to know about a message, worked out once per message.
+    settings maps each table a stage asked for to the guild's row (or tuple of rows), and is empty outside of guilds.
+    prefix is the command prefix the message starts with, or None if it isn't a command.
+    """
+    message: discord.Message
+    guild: typing.Optional[discord.Guild]
+    author: typing.Union[discord.Member, discord.User]
+    role_ids: typing.FrozenSet[int]
+    content: str
+    folded: str
+    prefix: typing.Optional[str]
+    settings: typing.Mapping
+
+
+class MessagePipeline:
+    """
+    Runs registered stages over each message in ascending order. A stage is a coroutine function taking a
+    MessageEnvelope; if it returns True (e.g. because it deleted the message), the stages after it are skipped.
+    A stage raising an exception is logged and doesn't stop the others.
+    Stages declare the guild settings they need as (table, guild id column, many) lookups, which are fetched through
+    the settings cache into the envelope before any stage runs.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self._stages = []
+
+    def add_stage(self, name, order, callback, settings=()):
+        """Registers a stage, replacing any stage with the same name (e.g. from before a cog was reloaded)."""
+        self.remove_stage(name)
+        self._stages.append((order, name, callback, tuple(settings)))
+        self._stages.sort(key=lambda stage: stage[:2])
+
+    def remove_stage(self, name):
+        """Unregisters a stage if it's registered."""
+        self._stages = [stage for stage in self._stages if stage[1] != name]
+
+    async def _fetch_settings(self, guild):
+        settings = {}
+        for _, _, _, lookups in self._stages:
+            for table, column, many in lookups:
+                if table not in settings:
+                    getter = db.settings_cache.get_all if many else db.settings_cache.get
+                    settings[table] = await getter(table, **{column: guild.id})
+        return types.MappingProxyType(settings)
+
+    async def _parse_prefix(self, message):
+        prefixes = await self.bot.get_prefix(message)
+        if isinstance(prefixes, str):
+            prefixes = (prefixes,)
+        return next((prefix for prefix in prefixes if message.content.startswith(prefix)), None)
+
+    async def envelope(self, message):
+        """Builds the envelope for a message."""
+        guild = message.guild
+        author = message.author
+        role_ids = frozenset(role.id for role in getattr(author, 'roles', ()))
+        settings = await self._fetch_settings(guild) if guild is not None else types.MappingProxyType({})
+        return MessageEnvelope(message=message, guild=guild, author=author, role_ids=role_ids, content=message.content,
+                               folded=message.content.casefold(), prefix=await self._parse_prefix(message), settings=settings)
+
+    async def process(self, message):
+        """Runs every stage over a message, stopping early if a stage says to."""
+        envelope = await self.envelope(message)
+        for _, name, callback, _ in self._stages:
+            start = time.perf_counter() if perf_stats.enabled else None
+            error = False
+            try:
+                if await callback(envelope):
+                    return
+            except Exception:
+                error = True
+                logger.exception('Message pipeline stage %s failed on message %d', name, message.id)
+            finally:
+                if start is not None:
+                    perf_stats.record(handler_owner(callback), 'message stage ' + name, time.perf_counter() - start, error=error)
@@ -0,0 +1,63 @@
+"""Per-user command rate limiting"""
+
+import collections
+import time
+
+__all__ = ['RateLimiter', 'SCOPES']
+
+# How commands are grouped into buckets; each user always gets their own
+SCOPES = {
+    'user': lambda ctx: ctx.author.id,
+    'user_guild': lambda ctx: (ctx.author.id, ctx.guild.id if ctx.guild else None),
+    'user_channel': lambda ctx: (ctx.author.id, ctx.channel.id),
+}
+
+
+class RateLimiter:
+    """
+    A token bucket per key: each key can run up to burst commands at once, and gets rate more every per seconds.
+    Buckets are kept in least recently used order. A bucket that has been idle long enough to refill completely is the
+    same as a new one, so those are dropped as they're found, and the least recently used buckets are dropped
+    beyond max_keys, keeping memory bounded however many users there are.
+    """
+    def __init__(self, rate=1, per=1.0, burst=3, scope='user', max_keys=100000):
+        if scope not in SCOPES:
+            raise ValueError(f"Unknown rate limit scope {scope!r}, expected one of {', '.join(SCOPES)}")
+        self.refill_rate = rate / per
+        self.burst = burst
+        self.scope = scope
+        self.max_keys = max_keys
+        self.checked = 0
+        self.throttled = 0
+        self._key = SCOPES[scope]
+        self._buckets = collections.OrderedDict()  # key -> [tokens, last update]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _evict(self, now):
+        refill_time = self.burst / self.refill_rate
+        while self._buckets:
+            _, updated = next(iter(self._buckets.values()))
+            if now - updated < refill_time and len(self._buckets) < self.max_keys:
+                break
+            self._buckets.popitem(last=False)
+
+    def hit(self, ctx, now=None):
+        """Takes a token from the context's bucket. Returns 0 if there was one, or how many seconds until there is."""
+        now = time.monotonic() if now is None else now
+        self.checked += 1
+        self._evict(now)
+        key = self._key(ctx)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.refill_rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.throttled += 1
+            return (1 - bucket[0]) / self.refill_rate
+        bucket[0] -= 1
+        return 0
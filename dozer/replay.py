@@ -0,0 +1,266 @@
+"""
+Replays a capture of gateway events through the bot's cogs.
+Events recorded with the event_capture setting are fed through discord.py's own parsers in this process, at the
+recorded speed, a multiple of it, or as fast as the cogs keep up, with the REST API mocked out and a scratch SQLite
+database. Reports the events per second sustained and where the time went, by cog and by handler, as JSON that can
+be compared between releases.
+
+Usage: python -m dozer.replay CAPTURE [--speed N] [--cogs a,b,c] [--db PATH] [--output FILE] [--baseline FILE]
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import types
+
+import discord
+
+from . import db
+from . import migrations
+from .benchmark import git_revision
+from .bot import Dozer, dozer_log_handler
+from .capture import read_events
+from .config import default_config
+from .fakegateway import FakeDiscord, timestamp
+from .perf import perf_stats
+
+DEFAULT_COGS = 'filter,moderation,starboard,voice,roles,info,namegame'
+MAX_IN_FLIGHT = 1000  # handler tasks allowed to pile up before feeding more events
+STARTUP_EVENTS = ('READY', 'GUILD_CREATE')
+
+
+class MockREST:
+    """Stands in for the REST API: answers the requests the cogs make with plausible objects, and counts them per route."""
+    def __init__(self, bot, latency=0.0):
+        self.bot = bot
+        self.latency = latency
+        self.requests = collections.Counter()
+
+    def user(self):
+        """Returns the bot's user as a payload."""
+        user = self.bot.user
+        return {'id': str(user.id), 'username': user.name, 'discriminator': user.discriminator, 'avatar': None, 'bot': True}
+
+    async def request(self, route, *, files=None, **kwargs):  # pylint: disable=unused-argument
+        """Replaces HTTPClient.request."""
+        path = route.url[len(discord.http.Route.BASE):]
+        name, _ = FakeDiscord.routes(route.method, path)
+        self.requests[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        segments = path.strip('/').split('/')
+        if name in ('POST /channels/{id}/messages', 'PATCH /channels/{id}/messages/{id}'):
+            data = kwargs.get('json') or {}
+            return {'id': segments[3] if len(segments) > 3 else str(discord.utils.time_snowflake(datetime.datetime.utcnow())),
+                    'channel_id': segments[1], 'author': self.user(), 'content': data.get('content') or '', 'timestamp': timestamp(),
+                    'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [],
+                    'attachments': [], 'embeds': [data['embed']] if data.get('embed') else [], 'pinned': False, 'type': 0}
+        if name == 'GET /oauth2/applications/@me':
+            return {'id': str(self.bot.user.id), 'name': self.bot.user.name, 'icon': None, 'description': '', 'rpc_origins': None,
+                    'bot_public': True, 'bot_require_code_grant': False, 'owner': self.user()}
+        if route.method == 'GET' and name.endswith('{id}'):
+            raise discord.NotFound(types.SimpleNamespace(status=404, reason='Not Found'), {'message': 'Unknown', 'code': 10008})
+        if route.method == 'GET':
+            return []
+        return None if route.method in ('PUT', 'DELETE') else {}
+
+
+def in_flight():
+    """Returns how many event handlers are still running."""
+    return sum(1 for task in asyncio.all_tasks() if getattr(task.get_coro(), '__qualname__', '').endswith('_run_event'))
+
+
+async def drain(timeout):
+    """Waits for the running event handlers to finish, for up to timeout seconds. Returns how many are left."""
+    deadline = time.monotonic() + timeout
+    while in_flight() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return in_flight()
+
+
+async def start_up(bot, events, drain_timeout):
+    """
+    Feeds the events up to the end of the guilds being loaded, and waits until the bot is ready and its caches are
+    warmed up; the rest of the events don't mean anything before then. Returns how many events that took, and an
+    iterator over the rest, starting with the first event after the guilds, which isn't parsed here.
+    """
+    parsers = bot._connection.parsers  # pylint: disable=protected-access
+    startup = 0
+    events = iter(events)
+    for seconds, event, data in events:
+        if event not in STARTUP_EVENTS:
+            events = itertools.chain([(seconds, event, data)], events)
+            break
+        parsers[event](data)
+        startup += 1
+    await bot.wait_until_ready()
+    await bot.wait_until_warmed_up()
+    await drain(drain_timeout)
+    return startup, events
+
+
+async def replay(bot, events, speed, drain_timeout):
+    """Feeds the events through the bot's parsers and returns the replay statistics."""
+    parsers = bot._connection.parsers  # pylint: disable=protected-access
+    startup, events = await start_up(bot, events, drain_timeout)
+    perf_stats.reset()
+
+    skipped = collections.Counter()
+    counts = collections.Counter()
+    behind = 0.0
+    first = None
+    start = time.perf_counter()
+    for seconds, event, data in events:
+        parser = parsers.get(event)
+        if parser is None:
+            skipped[event] += 1
+            continue
+        if first is None:
+            first = seconds
+        if speed:
+            delay = (seconds - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+        elif counts[None] % 100 == 0:
+            while in_flight() > MAX_IN_FLIGHT:
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0)
+        try:
+            parser(data)
+        except Exception:
+            logging.getLogger('dozer').exception('Failed to parse a replayed %s', event)
+            skipped[event] += 1
+            continue
+        counts[event] += 1
+        counts[None] += 1
+    feed_time = time.perf_counter() - start
+    unfinished = await drain(drain_timeout)
+    elapsed = time.perf_counter() - start
+    total = counts.pop(None, 0)
+    return {
+        'startup_events': startup,
+        'events': total,
+        'events_by_type': dict(counts.most_common()),
+        'skipped_events': dict(skipped),
+        'feed_seconds': round(feed_time, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'events_per_second': round(total / elapsed, 1) if elapsed else 0.0,
+        'max_behind_schedule_ms': round(behind * 1000, 1) if speed else None,
+        'unfinished_handlers': unfinished,
+    }
+
+
+def breakdown():
+    """
+    Returns the recorded handler time by cog and by handler, highest first. The bot's own on_message includes the
+    message pipeline stages, which are also listed under the cogs they belong to.
+    """
+    cogs = collections.defaultdict(lambda: {'calls': 0, 'errors': 0, 'total_ms': 0.0})
+    handlers = []
+    for stats, histogram in perf_stats.top(count=sys.maxsize):
+        cog = cogs[stats.cog]
+        cog['calls'] += histogram.calls
+        cog['errors'] += histogram.errors
+        cog['total_ms'] += histogram.total_time * 1000
+        handlers.append({'cog': stats.cog, 'handler': stats.name, 'calls': histogram.calls, 'errors': histogram.errors,
+                         'total_ms': round(histogram.total_time * 1000, 1), 'p50_ms': round(histogram.percentile(50) * 1000, 3),
+                         'p99_ms': round(histogram.percentile(99) * 1000, 3)})
+    for cog in cogs.values():
+        cog['total_ms'] = round(cog['total_ms'], 1)
+    return dict(sorted(cogs.items(), key=lambda item: item[1]['total_ms'], reverse=True)), handlers
+
+
+def compare(report, baseline_file):
+    """Adds the change in throughput and in each cog's total time from a previous run's report."""
+    with open(baseline_file, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline['results']['events_per_second']:
+        report['results']['baseline_events_per_second'] = baseline['results']['events_per_second']
+        report['results']['events_per_second_change_pct'] = (report['results']['events_per_second'] /
+                                                             baseline['results']['events_per_second'] - 1) * 100
+    for name, cog in report['cogs'].items():
+        previous = baseline['cogs'].get(name)
+        if previous and previous['total_ms']:
+            cog['baseline_total_ms'] = previous['total_ms']
+            cog['total_change_pct'] = (cog['total_ms'] / previous['total_ms'] - 1) * 100
+
+
+async def run(args):
+    """Sets up a bot with the chosen cogs, a scratch database and mocked REST, then replays the capture."""
+    config = default_config()
+    config['lazy_cogs'] = False
+    config['memory']['fetch_offline_members'] = False  # there is no gateway to request members from
+    bot = Dozer(config)
+    rest = MockREST(bot, args.rest_latency_ms / 1000)
+    bot.http.request = rest.request
+
+    async def no_presence(**_kwargs):
+        pass
+    bot.change_presence = no_presence
+    for cog in args.cogs.split(','):
+        bot.load_extension('dozer.cogs.' + cog)
+    migrations.migrate(db.engine)
+
+    results = await replay(bot, read_events(args.capture), args.speed, args.drain_seconds)
+    if bot.event_filter is not None:  # gateway_events.allow is set in the config
+        results['filtered_events'] = dict(bot.event_filter.skipped.most_common())
+    results['loop_lag_ms'] = {'average': round(bot.loop_monitor.summary()[0] * 1000, 1), 'max': round(bot.loop_monitor.summary()[1] * 1000, 1),
+                              'stalls': bot.loop_monitor.stalls}
+    cogs, handlers = breakdown()
+    await db.write_queue.flush()
+    bot.loop_monitor.stop()
+    await bot.http.close()
+    return {'results': results, 'cogs': cogs, 'handlers': handlers, 'rest_requests': dict(rest.requests.most_common())}
+
+
+def main():
+    """Parses arguments, replays the capture and writes the results."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('capture', help='capture file written by the bot with event_capture.path set')
+    parser.add_argument('--speed', type=float, default=0, help='replay speed relative to the recording, e.g. 1 or 10; 0 for as fast as possible')
+    parser.add_argument('--cogs', default=DEFAULT_COGS, help='comma separated cogs to load')
+    parser.add_argument('--db', default='dozer_replay.db', help='scratch SQLite file, recreated for each run')
+    parser.add_argument('--rest-latency-ms', type=float, default=0, help='simulated latency of each REST request')
+    parser.add_argument('--drain-seconds', type=float, default=30, help='how long to wait for handlers to finish after the last event')
+    parser.add_argument('--output', default='-', help='file to write the JSON results to, or - for stdout')
+    parser.add_argument('--baseline', help='results of a previous run to compare against')
+    args = parser.parse_args()
+
+    dozer_log_handler.setLevel(logging.WARNING)
+    if os.path.isfile(args.db):
+        os.remove(args.db)
+    db.db_init('sqlite:///' + args.db)
+    perf_stats.enabled = True
+
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+    report.update({
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'discord.py': discord.__version__,
+        'capture': os.path.basename(args.capture),
+        'speed': args.speed or 'max',
+        'loaded_cogs': args.cogs.split(','),
+    })
+    if args.baseline:
+        compare(report, args.baseline)
+    output = json.dumps(report, indent='\t')
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
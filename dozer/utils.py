@@ -1,41 +1,58 @@
 """Provides some useful utilities for the Discord bot, mostly to do with cleaning."""
 
+import functools
 import re
-import discord
 
-__all__ = ['clean', 'is_clean']
+__all__ = ['clean', 'is_clean', 'mention_index']
 
-mass_mention = re.compile('@(everyone|here)')
-member_mention = re.compile(r'<@\!?(\d+)>')
-role_mention = re.compile(r'<@&(\d+)>')
-channel_mention = re.compile(r'<#(\d+)>')
+mention_patterns = {
+    'mass': r'@(?P<mass>everyone|here)',
+    'member': r'<@\!?(?P<member>\d+)>',
+    'role': r'<@&(?P<role>\d+)>',
+    'channel': r'<#(?P<channel>\d+)>',
+}
+
+
+@functools.lru_cache()
+def mention_pattern(*kinds):
+    """Compiles one pattern matching each of the given kinds of mention, so text is only scanned once."""
+    return re.compile('|'.join(mention_patterns[kind] for kind in kinds))
 
 
 def clean(ctx, text=None, *, mass=True, member=True, role=True, channel=True):
     """Cleans the message of anything specified in the parameters passed."""
     if text is None:
         text = ctx.message.content
-    if mass:
-        cleaned_text = mass_mention.sub(lambda match: '@\N{ZERO WIDTH SPACE}' + match.group(1), text)
-    if member:
-        cleaned_text = member_mention.sub(lambda match: clean_member_name(ctx, int(match.group(1))), cleaned_text)
-    if role:
-        cleaned_text = role_mention.sub(lambda match: clean_role_name(ctx, int(match.group(1))), cleaned_text)
-    if channel:
-        cleaned_text = channel_mention.sub(lambda match: clean_channel_name(ctx, int(match.group(1))), cleaned_text)
-    return cleaned_text
+    if '@' not in text and '<' not in text:
+        return text
+    kinds = tuple(kind for kind, enabled in zip(mention_patterns, (mass, member, role, channel)) if enabled)
+    if not kinds:
+        return text
+
+    def replace(match):
+        kind = match.lastgroup
+        if kind == 'mass':
+            return '@\N{ZERO WIDTH SPACE}' + match.group(kind)
+        elif kind == 'member':
+            return clean_member_name(ctx, int(match.group(kind)))
+        elif kind == 'role':
+            return clean_role_name(ctx, int(match.group(kind)))
+        else:
+            return clean_channel_name(ctx, int(match.group(kind)))
+
+    return mention_pattern(*kinds).sub(replace, text)
 
 
 def is_clean(ctx, text=None):
     """Checks if the message is clean already and doesn't need to be cleaned."""
     if text is None:
         text = ctx.message.content
-    return all(regex.search(text) is None for regex in (mass_mention, member_mention, role_mention, channel_mention))
+    return ('@' not in text and '<' not in text) or mention_pattern(*mention_patterns).search(text) is None
 
 
 def clean_member_name(ctx, member_id):
     """Cleans a member's name from the message."""
-    member = ctx.guild.get_member(member_id)
+    member = ctx.guild.get_member(member_id) if ctx.guild is not None else None
     if member is None:
         return '<@\N{ZERO WIDTH SPACE}%d>' % member_id
     elif is_clean(ctx, member.display_name):
@@ -48,24 +65,56 @@ def clean_member_name(ctx, member_id):
 
 def clean_role_name(ctx, role_id):
     """Cleans role pings from messages."""
-    role = discord.utils.get(ctx.guild.roles, id=role_id)  # Guild.get_role doesn't exist
-    if role is None:
-        return '<@&\N{ZERO WIDTH SPACE}%d>' % role_id
-    elif is_clean(ctx, role.name):
-        return '@' + role.name
-    else:
-        return '<@&\N{ZERO WIDTH SPACE}%d>' % role.id
+    if ctx.guild is not None:
+        cleaned = mention_index.roles(ctx.guild).get(role_id)
+        if cleaned is not None:
+            return cleaned
+    return '<@&\N{ZERO WIDTH SPACE}%d>' % role_id
 
 
 def clean_channel_name(ctx, channel_id):
     """Cleans channel mentions from messages."""
-    channel = ctx.guild.get_channel(channel_id)
-    if channel is None:
-        return '<#\N{ZERO WIDTH SPACE}%d>' % channel_id
-    elif is_clean(ctx, channel.name):
-        return '#' + channel.name
-    else:
-        return '<#\N{ZERO WIDTH SPACE}%d>' % channel.id
+    if ctx.guild is not None:
+        cleaned = mention_index.channels(ctx.guild).get(channel_id)
+        if cleaned is not None:
+            return cleaned
+    return '<#\N{ZERO WIDTH SPACE}%d>' % channel_id
+
+
+class MentionIndex:
+    """
+    What each guild's role and channel mentions are cleaned into, by id. A guild's maps are built the first time one of
+    its mentions is cleaned, and dropped by invalidate whenever its roles or channels change.
+    """
+    def __init__(self):
+        self._roles = {}
+        self._channels = {}
+
+    def roles(self, guild):
+        """Returns a map of role id to its cleaned mention for a guild."""
+        roles = self._roles.get(guild.id)
+        if roles is None:
+            roles = self._roles[guild.id] = {
+                role.id: '@' + role.name if is_clean(None, role.name) else '<@&\N{ZERO WIDTH SPACE}%d>' % role.id
+                for role in guild.roles}
+        return roles
+
+    def channels(self, guild):
+        """Returns a map of channel id to its cleaned mention for a guild."""
+        channels = self._channels.get(guild.id)
+        if channels is None:
+            channels = self._channels[guild.id] = {
+                channel.id: '#' + channel.name if is_clean(None, channel.name) else '<#\N{ZERO WIDTH SPACE}%d>' % channel.id
+                for channel in guild.channels}
+        return channels
+
+    def invalidate(self, guild_id):
+        """Forgets a guild's maps, so they're rebuilt the next time they're used."""
+        self._roles.pop(guild_id, None)
+        self._channels.pop(guild_id, None)
+
+
+mention_index = MentionIndex()
 
 
 def pretty_concat(strings, single_suffix='', multi_suffix=''):